@@ -0,0 +1,13 @@
+""" Benchmarks for the model layer. They run against rethinkdb_rdb.testing, an
+in-process stand-in for the server, so none of them need a database. Run them
+from the repository root, one at a time:
+
+    python -m benchmarks.bench_serialization
+    python -m benchmarks.bench_compact
+    python -m benchmarks.bench_pool
+    python -m benchmarks.bench_model
+
+or all together, with JSON output and a comparison against a baseline:
+
+    python -m benchmarks.run --baseline baseline.json --output current.json
+"""
@@ -0,0 +1,43 @@
+""" Memory per entity and hydration throughput of compact, slot backed models
+against the default dict backed layout. Doesn't need a database.
+
+Memory counts the containers each layout allocates per entity: the instance,
+its __dict__ and the property storage. The property values themselves are the
+same objects in both layouts and are left out.
+"""
+import sys
+import timeit
+
+from .bench_serialization import wide_model, WIDTH
+
+
+def entity_size(entity):
+    size = sys.getsizeof(entity) + sys.getsizeof(entity._values)
+    if not type(entity)._compact:
+        size += sys.getsizeof(entity.__dict__)
+    return size
+
+
+def run(width=WIDTH, number=2000):
+    results = []
+    for compact in (False, True):
+        cls, values = wide_model(width, compact=compact)
+        stored = cls(id='bench', **values)._to_db()
+
+        entity = cls._from_db(dict(stored))
+        seconds = min(timeit.repeat(lambda: cls._from_db(dict(stored)), number=number, repeat=5)) / number
+        results.append(('compact' if compact else 'dict', entity_size(entity), 1 / seconds))
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    width = int(argv[0]) if argv else WIDTH
+    print '%d properties per entity' % width
+    print '%-8s %16s %20s' % ('layout', 'bytes per entity', 'entities per second')
+    for name, size, rate in run(width):
+        print '%-8s %16d %20.0f' % (name, size, rate)
+
+
+if __name__ == '__main__':
+    main()
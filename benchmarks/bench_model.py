@@ -0,0 +1,65 @@
+""" End to end cost of put(), get_by_id() and all() through the connection pool,
+against the in-process stand-in server with a simulated network latency. Doesn't
+need a database. get_by_id_async_N fires N lookups at once and waits for them all.
+"""
+import sys
+import time
+import timeit
+from contextlib import contextmanager
+
+import rethinkdb_rdb as rdb
+from rethinkdb_rdb import model, testing
+
+from .bench_serialization import wide_model
+
+LATENCY = 0.0005
+WIDTH = 10
+
+
+@contextmanager
+def fake_server(latency=LATENCY):
+    """ Point the model layer at a fresh FakeServer for the duration of the block
+    """
+    previous = model.connections
+    model.connections = testing.FakePool(testing.FakeServer(latency=latency))
+    try:
+        with model.connections.get() as conn:
+            rdb.db_create(rdb.DATABASE['db']).run(conn)
+        yield model.connections.server
+    finally:
+        model.connections = previous
+
+
+def run(latency=LATENCY, width=WIDTH, number=200, page_size=50):
+    """ :return list of (operation, seconds per call)
+    """
+    cls, values = wide_model(width)
+    with fake_server(latency):
+        rdb.sync_all([cls], force=True)
+        ids = cls.put_multi([cls(**values) for _ in range(page_size)])
+        entity = cls.get_by_id(ids[0])
+
+        def put():
+            entity.p00 = str(time.time())  # a change, so put() makes the round trip
+            entity.put()
+
+        cases = [
+            ('put', put),
+            ('get_by_id', lambda: cls.get_by_id(ids[0])),
+            ('all', lambda: list(cls.all(page=0, page_size=page_size)[0])),
+            ('get_by_id_async_%d' % page_size,
+             lambda: [future.get_result() for future in [cls.get_by_id_async(id) for id in ids]]),
+        ]
+        return [(name, min(timeit.repeat(func, number=number, repeat=3)) / number) for name, func in cases]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    latency = float(argv[0]) if argv else LATENCY
+    print '%.1f ms simulated latency, microseconds per call' % (latency * 1e3)
+    for name, seconds in run(latency):
+        print '%-10s %10.1f' % (name, seconds * 1e6)
+
+
+if __name__ == '__main__':
+    main()
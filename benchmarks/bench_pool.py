@@ -0,0 +1,55 @@
+""" Throughput of ConnectionPool.get() when more threads want a connection than
+the pool holds, and how long they wait for one. Doesn't need a database.
+"""
+import sys
+import time
+import threading
+
+from rethinkdb_rdb import testing
+
+THREADS = 16
+MAX_SIZE = 4
+
+
+def run(threads=THREADS, max_size=MAX_SIZE, checkouts=2000, hold=0.0):
+    """ Each thread checks a connection out and back in checkouts times, holding it
+    for hold seconds.
+
+    :return checkouts per second, mean and max wait for a connection in seconds
+    """
+    pool = testing.FakePool(testing.FakeServer(), max_size=max_size)
+    pool.warmup(max_size)
+    start = threading.Event()
+
+    def work():
+        start.wait()
+        for _ in xrange(checkouts):
+            with pool.get():
+                if hold:
+                    time.sleep(hold)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    began = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - began
+
+    stats = pool.stats()
+    return threads * checkouts / elapsed, stats['wait_time'] / stats['checkouts'], stats['max_wait']
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    threads = int(argv[0]) if argv else THREADS
+    rate, mean_wait, max_wait = run(threads)
+    print '%d threads, %d connections' % (threads, MAX_SIZE)
+    print 'checkouts per second  %10.0f' % rate
+    print 'mean wait (us)        %10.1f' % (mean_wait * 1e6)
+    print 'max wait (ms)         %10.2f' % (max_wait * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+""" Per-entity cost of serializing and deserializing a wide model with the
+compiled property pipelines, against the per-property path that put() used
+before they existed. Doesn't need a database.
+"""
+import sys
+import timeit
+
+from datetime import datetime
+
+import rethinkdb_rdb as rdb
+
+WIDTH = 30
+
+
+def wide_model(width=WIDTH, compact=False):
+    """ A model with width properties cycling through the property types
+    """
+    kinds = [
+        (rdb.StringProperty, 'value'),
+        (rdb.TextProperty, 'a longer value ' * 4),
+        (rdb.IntegerProperty, 42),
+        (rdb.PositiveIntegerProperty, 7),
+        (rdb.FloatProperty, 1.5),
+        (rdb.BooleanProperty, True),
+        (rdb.DateTimeProperty, datetime(2014, 11, 11)),
+        (rdb.ObjectProperty, {'a': [1, 2, 3]}),
+    ]
+    attrs = {'_table': 'BenchWide', '_compact': compact}
+    values = {}
+    for i in range(width):
+        kind, value = kinds[i % len(kinds)]
+        attrs['p%02d' % i] = kind(indexed=False)
+        values['p%02d' % i] = value
+    return type('BenchWide', (rdb.Model,), attrs), values
+
+
+def legacy_to_db(entity):
+    """ The per-property path: resolve, reverse and apply the validator chain and
+    look up the db transform for every property of every entity.
+    """
+    db_doc = {}
+    for name, attr in entity._meta.iteritems():
+        value = attr._call_validation(entity._values.get(name, attr._default))
+        if attr._validator is not None:
+            new_value = attr._validator(attr, value)
+            if new_value is not None:
+                value = new_value
+        if hasattr(attr, '_to_db'):
+            value = attr._to_db(value)
+        db_doc[name] = value
+    return db_doc
+
+
+def legacy_from_db(cls, db_dict):
+    entity = cls()
+    entity.id = db_dict.pop('id')
+    for name, value in db_dict.iteritems():
+        cls._meta[name]._do_from_db(entity, value)
+    return entity
+
+
+def legacy_to_dict(entity):
+    _doc = {}
+    for name, attr in entity._meta.iteritems():
+        if hasattr(entity, attr._attr_name):
+            _doc[attr._attr_name] = getattr(entity, attr._attr_name)
+    return _doc
+
+
+def read_three(entity):
+    """ What a listing that shows a few columns of a wide entity reads
+    """
+    return entity.p00, entity.p02, entity.p06
+
+
+def per_entity(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def run(width=WIDTH, number=2000):
+    cls, values = wide_model(width)
+    entity = cls(id='bench', **values)
+    stored = entity._to_db()
+    stored['p06'] = datetime(2014, 11, 11)  # the driver returns datetimes, not ReQL terms
+
+    cases = [
+        ('to_db', lambda: legacy_to_db(entity), lambda: entity._to_db()),
+        ('from_db', lambda: legacy_from_db(cls, dict(stored)), lambda: cls._from_db(dict(stored))),
+        ('to_dict', lambda: legacy_to_dict(entity), lambda: entity.to_dict()),
+        ('from_db_read3', lambda: read_three(legacy_from_db(cls, dict(stored))),
+         lambda: read_three(cls._from_db(dict(stored)))),
+    ]
+    results = []
+    for name, legacy, compiled in cases:
+        before = per_entity(legacy, number)
+        after = per_entity(compiled, number)
+        results.append((name, before, after))
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    width = int(argv[0]) if argv else WIDTH
+    print '%d properties per entity, microseconds per entity' % width
+    print '%-10s %12s %12s %8s' % ('', 'per-property', 'compiled', 'speedup')
+    for name, before, after in run(width):
+        print '%-10s %12.1f %12.1f %7.1fx' % (name, before * 1e6, after * 1e6, before / after)
+
+
+if __name__ == '__main__':
+    main()
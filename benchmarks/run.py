@@ -0,0 +1,109 @@
+""" Run all the benchmarks, write the results as JSON and compare them with a
+baseline from an earlier run:
+
+    python -m benchmarks.run --output baseline.json
+    ... change things ...
+    python -m benchmarks.run --baseline baseline.json --output current.json
+
+Every result is a cost, seconds per operation, so lower is better. A result more
+than --threshold times its baseline is reported as a regression and makes the
+exit status 1. Compare runs from the same machine only.
+"""
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+
+from datetime import datetime
+
+from . import bench_serialization, bench_compact, bench_pool, bench_model
+
+THRESHOLD = 1.25
+
+
+def bench_validation(number=20000):
+    """ Seconds per validated value for each property type, through the compiled
+    pipeline that __set__ uses.
+    """
+    cls, values = bench_serialization.wide_model(8)  # one property of each type
+    results = {}
+    for name, attr in sorted(cls._meta.iteritems()):
+        value = values[attr._attr_name]
+        seconds = min(timeit.repeat(lambda: attr._do_validate(value), number=number, repeat=3)) / number
+        results['validate.%s' % type(attr).__name__] = seconds
+    return results
+
+
+def collect(latency=bench_model.LATENCY):
+    """ :return dict of benchmark name to seconds per operation
+    """
+    results = bench_validation()
+    for name, before, after in bench_serialization.run():
+        results['serialize.%s' % name] = after
+    for name, size, rate in bench_compact.run():
+        results['hydrate.%s' % name] = 1 / rate
+    rate, mean_wait, max_wait = bench_pool.run()
+    results['pool.checkout'] = 1 / rate
+    results['pool.wait'] = mean_wait
+    for name, seconds in bench_model.run(latency):
+        results['model.%s' % name] = seconds
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ :return list of (name, seconds, baseline seconds or None, ratio or None, regressed)
+    """
+    rows = []
+    for name in sorted(results):
+        before = baseline.get(name)
+        ratio = results[name] / before if before else None
+        rows.append((name, results[name], before, ratio, ratio is not None and ratio > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the model layer against an in-process server.')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file written by an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown ratio reported as a regression (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=bench_model.LATENCY,
+                        help='simulated server latency in seconds (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = collect(args.latency)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    rows = compare(results, baseline, args.threshold)
+    print '%-32s %12s %12s %8s' % ('benchmark', 'us per op', 'baseline', 'ratio')
+    for name, seconds, before, ratio, regressed in rows:
+        print '%-32s %12.2f %12s %8s%s' % (
+            name, seconds * 1e6,
+            '%.2f' % (before * 1e6) if before else '-',
+            '%.2f' % ratio if ratio else '-',
+            '  REGRESSION' if regressed else '')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'latency': args.latency,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        print '%d regressions: %s' % (len(regressions), ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
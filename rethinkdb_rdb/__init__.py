@@ -1,2 +1,4 @@
-
-from model import *
\ No newline at end of file
+from model import *
+from cache import context, get_context, Context, LRUCache, entity_cache, QueryCache, query_cache
+from tasklets import Future, Executor, executor, wait_all, wait_any, AutoBatcher, autobatcher
+from instrumentation import Instrument, QueryEvent, SlowQueryLog, add_instrument, remove_instrument
\ No newline at end of file
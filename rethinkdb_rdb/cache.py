@@ -0,0 +1,301 @@
+""" Entity caches used by Model.get_by_id and get_multi. Borrowed from the
+context cache and memcache layers of google/appengine/ext/ndb/context
+
+There are two levels:
+
+* A Context is an identity map scoped to a request. Inside `with rdb.context():`
+  every lookup of the same id returns the same entity object.
+* entity_cache is a process wide LRU of raw documents keyed by table and id, with
+  a time to live. It is shared by every thread and is off until it is given a size.
+
+query_cache keeps the results of Model.all and count the same way, keyed by table
+and a fingerprint of the query.
+"""
+import json
+import cPickle
+import hashlib
+import threading
+import collections
+import time as _time
+from contextlib import contextmanager
+
+from rethinkdb import ql2_pb2
+
+_TERM = ql2_pb2.Term.TermType
+# terms whose result changes from one run to the next, queries with them aren't cached
+_NONDETERMINISTIC = frozenset([_TERM.NOW, _TERM.RANDOM, _TERM.UUID, _TERM.HTTP, _TERM.JAVASCRIPT])
+
+_state = threading.local()
+
+
+class LRUCache(object):
+    """ A thread-safe, size bounded least recently used cache whose entries expire
+    after ttl seconds.
+
+    :param max_size: maximum number of entries, 0 disables the cache
+    :param ttl: seconds an entry is served for, None keeps it until it is evicted
+    """
+
+    def __init__(self, max_size=0, ttl=None):
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()  # key -> (expires, value)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_size=None, ttl=None):
+        """ Change the size and the default time to live. Shrinking the cache evicts
+        the least recently used entries.
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            key, entry = self._data.popitem(last=False)
+            self._removed(key)
+            self.evictions += 1
+
+    def _removed(self, key):
+        """ Called with the lock held for each entry that leaves the cache
+        """
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires is not None and expires < _time.time():
+                self._removed(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data[key] = entry  # move to the most recently used end
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if not self.max_size:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else _time.time() + ttl
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._removed(key)
+            self._data[key] = (expires, value)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._removed(key)
+
+    def delete_where(self, test):
+        """ Drop the entries whose key test(key) is true, e.g. those of a dropped table
+        """
+        with self._lock:
+            for key in [key for key in self._data if test(key)]:
+                del self._data[key]
+                self._removed(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._data:
+                self._removed(key)
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class Context(object):
+    """ Identity map for the duration of a request. Entities are keyed by table
+    and id, so each id is loaded from the database at most once per context.
+    """
+
+    def __init__(self):
+        self._entities = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entity = self._entities.get(key)
+        if entity is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entity
+
+    def set(self, key, entity):
+        self._entities[key] = entity
+
+    def delete(self, key):
+        self._entities.pop(key, None)
+
+    def clear(self):
+        self._entities.clear()
+
+    def stats(self):
+        return {'size': len(self._entities), 'hits': self.hits, 'misses': self.misses}
+
+
+def get_context():
+    """ The Context of the current thread, None outside of a context() block
+    """
+    return getattr(_state, 'context', None)
+
+
+@contextmanager
+def context():
+    """ Run a block, typically a request handler, with its own identity map:
+
+        with rdb.context():
+            handle(request)
+
+    Contexts nest, the innermost one is used until its block ends.
+    """
+    previous = get_context()
+    ctx = _state.context = Context()
+    try:
+        yield ctx
+    finally:
+        _state.context = previous
+
+
+entity_cache = LRUCache()
+
+
+def fingerprint(term):
+    """ A stable digest of an RQL term. The variables of lambdas are numbered in
+    the order they appear, the driver numbers them with a process wide counter.
+
+    :return hex digest, None when the term has a nondeterministic part like now()
+    """
+    names = {}
+
+    def normalize(node):
+        # a term is [type, args] or [type, args, optargs], objects are dicts of terms
+        if isinstance(node, dict):
+            return dict((key, normalize(value)) for key, value in node.iteritems())
+        if not isinstance(node, list):
+            return node
+        term_type, args = node[0], node[1]
+        if term_type in _NONDETERMINISTIC:
+            raise ValueError(term_type)
+        if term_type == _TERM.FUNC:
+            params, body = args  # params is [MAKE_ARRAY, [var ids]]
+            for var in params[1]:
+                names.setdefault(var, len(names) + 1)
+            return [term_type, [[params[0], [names[var] for var in params[1]]], normalize(body)]]
+        if term_type == _TERM.VAR:
+            return [term_type, [names.get(var, var) for var in args]]
+        return [term_type, [normalize(arg) for arg in args]] + [normalize(optargs) for optargs in node[2:]]
+
+    try:
+        built = normalize(term.build())
+    except ValueError:
+        return None
+    return hashlib.sha1(json.dumps(built, sort_keys=True, default=repr)).hexdigest()
+
+
+class QueryCache(LRUCache):
+    """ An LRUCache of query results keyed by (table, fingerprint of the query). A
+    write to a table drops the results of that table, and a query that was running
+    while the table was written isn't stored, so it can't keep a result older than
+    the write. Results are stored pickled, so each get() returns a copy the caller
+    can change, and bytes counts the size of the pickles.
+    """
+
+    def __init__(self, max_size=0, ttl=60):
+        super(QueryCache, self).__init__(max_size, ttl)
+        self._tables = collections.defaultdict(set)
+        self._generations = collections.defaultdict(int)
+        self._bytes = {}
+        self.bytes = 0
+        self.invalidations = 0
+
+    def key(self, table, term):
+        """ :return the cache key of term on table, None when it can't be cached
+        """
+        digest = fingerprint(term)
+        return None if digest is None else (table, digest)
+
+    def generation(self, table):
+        """ A counter of the writes to table, pass it back to set()
+        """
+        return self._generations[table]
+
+    def set(self, key, value, ttl=None, generation=None):
+        """ :param generation: generation() of the table before the query ran, the
+            result is dropped when the table was written since
+        """
+        if not self.max_size:
+            return
+        value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        size = len(value)
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else _time.time() + ttl
+        with self._lock:
+            if generation is not None and generation != self._generations[key[0]]:
+                return
+            if self._data.pop(key, None) is not None:
+                self._removed(key)
+            self._data[key] = (expires, value)
+            self._tables[key[0]].add(key)
+            self._bytes[key] = size
+            self.bytes += size
+            self._evict()
+
+    def get(self, key):
+        value = super(QueryCache, self).get(key)
+        return None if value is None else cPickle.loads(value)
+
+    def _removed(self, key):
+        self._tables[key[0]].discard(key)
+        self.bytes -= self._bytes.pop(key, 0)
+
+    def invalidate(self, table):
+        """ Drop the results of the queries on table
+        """
+        with self._lock:
+            self._generations[table] += 1
+            keys = self._tables.pop(table, ())
+            for key in keys:
+                self._data.pop(key, None)
+                self.bytes -= self._bytes.pop(key, 0)
+            self.invalidations += len(keys)
+
+    def stats(self):
+        stats = super(QueryCache, self).stats()
+        lookups = stats['hits'] + stats['misses']
+        stats.update(bytes=self.bytes, invalidations=self.invalidations,
+                     hit_rate=float(stats['hits']) / lookups if lookups else 0.0)
+        return stats
+
+
+query_cache = QueryCache()
@@ -0,0 +1,180 @@
+""" Hooks around every query the model layer runs, and a slow query log built on
+them:
+
+    slow = rdb.SlowQueryLog(threshold=0.05, sample_rate=0.01)
+    rdb.add_instrument(slow)
+    ...
+    slow.stats()  # {'Contact.get_by_id': {'count': ..., 'histogram': ...}, ...}
+
+An instrument subclasses Instrument and overrides before_query and after_query,
+which both receive the QueryEvent of the query. Exceptions raised by a hook are
+logged and don't affect the query.
+"""
+import random
+import logging
+import threading
+import collections
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+instruments = []
+
+
+def add_instrument(instrument):
+    if instrument not in instruments:
+        instruments.append(instrument)
+    return instrument
+
+
+def remove_instrument(instrument):
+    if instrument in instruments:
+        instruments.remove(instrument)
+
+
+class QueryEvent(object):
+    """ One query run by the model layer. Times are in seconds.
+
+    :ivar model: the Model class, None for sync_all() over several models
+    :ivar operation: the model method, e.g. 'get_by_id' or 'put'
+    :ivar term: the RQL term that was run
+    :ivar wait: time spent waiting for a pooled connection
+    :ivar duration: time the query took once it had a connection
+    :ivar size: documents returned, or written for writes, 1 for a scalar such as
+        a count and None for a cursor
+    :ivar error: the exception the query raised, if any
+    :ivar profile: set to True in before_query to have the server profile the
+        query, after_query then gets the server's profile in its place
+    """
+
+    __slots__ = ('model', 'operation', 'term', 'wait', 'duration', 'size', 'error', 'profile')
+
+    def __init__(self, model, operation, term):
+        self.model = model
+        self.operation = operation
+        self.term = term
+        self.wait = 0.0
+        self.duration = 0.0
+        self.size = 0
+        self.error = None
+        self.profile = None
+
+    @property
+    def name(self):
+        return '%s.%s' % (self.model.__name__ if self.model else '*', self.operation)
+
+    def __repr__(self):
+        return '<QueryEvent %s %.1f ms>' % (self.name, self.duration * 1e3)
+
+
+class Instrument(object):
+    """ Base class for query instrumentation, register instances with add_instrument()
+    """
+
+    def before_query(self, event):
+        pass
+
+    def after_query(self, event):
+        pass
+
+
+def before_query(event):
+    for instrument in list(instruments):
+        try:
+            instrument.before_query(event)
+        except Exception:
+            logging.exception("Error in %r.before_query", instrument)
+
+
+def after_query(event):
+    for instrument in list(instruments):
+        try:
+            instrument.after_query(event)
+        except Exception:
+            logging.exception("Error in %r.after_query", instrument)
+
+
+class Histogram(object):
+    """ Counts of durations per bucket, with their total and maximum
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.wait = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, event):
+        self.count += 1
+        if event.error is not None:
+            self.errors += 1
+        self.total += event.duration
+        self.wait += event.wait
+        self.max = max(self.max, event.duration)
+        ms = event.duration * 1e3
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'mean_wait': self.wait / self.count if self.count else 0.0,
+            'histogram': dict(('<=%gms' % bound, n) for bound, n in zip(BUCKETS, self.buckets) if n),
+        }
+
+
+class SlowQueryLog(Instrument):
+    """ Keep a duration histogram per model and operation, and log the queries
+    that take longer than threshold seconds. A sample_rate share of the queries
+    are run with profile=True so that slow ones are logged with the server's
+    profile.
+
+    :param threshold: seconds a query may take before it is logged
+    :param sample_rate: share of the queries to profile, between 0 and 1
+    :param logger: logging.Logger to log to, defaults to the rethinkdb_rdb logger
+    :param keep: number of recent slow queries kept in slow_queries
+    """
+
+    def __init__(self, threshold=0.1, sample_rate=0.0, logger=None, keep=100):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.logger = logger or logging.getLogger('rethinkdb_rdb')
+        self.slow_queries = collections.deque(maxlen=keep)
+        self._histograms = collections.defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def before_query(self, event):
+        if self.sample_rate and random.random() < self.sample_rate:
+            event.profile = True
+
+    def after_query(self, event):
+        with self._lock:
+            self._histograms[event.name].add(event)
+        if event.duration >= self.threshold:
+            self.slow_queries.append(event)
+            term = str(event.term)
+            self.logger.warning(
+                "Slow query %s took %.1f ms, waited %.1f ms for a connection%s: %s%s%s",
+                event.name, event.duration * 1e3, event.wait * 1e3,
+                ', %d documents' % event.size if event.size is not None else '',
+                term if len(term) <= 500 else term[:500] + '...',
+                ' failed: %s' % event.error if event.error is not None else '',
+                ' profile: %s' % event.profile if event.profile not in (None, True) else '')
+
+    def stats(self):
+        """ :return dict of 'Model.operation' to its counters, times in seconds
+        """
+        with self._lock:
+            return dict((name, histogram.stats()) for name, histogram in self._histograms.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+        self.slow_queries.clear()
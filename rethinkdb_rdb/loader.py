@@ -0,0 +1,302 @@
+""" Stream JSON lines or CSV into a model's table with chunked, pipelined inserts:
+
+    stats = loader.load(Contact, 'contacts.jsonl', rejects='contacts.rejects.jsonl')
+
+or from the command line:
+
+    python -m rethinkdb_rdb.loader myapp.models:Contact contacts.csv --rejects rejects.jsonl
+
+Rows are validated through the model's properties. Up to max_in_flight chunks are
+sent at once, each on its own pooled connection, and reading waits while that many
+are outstanding, so memory stays flat however large the input is. Rows that fail
+validation or are refused by the server are written to the rejects file, one JSON
+line each with the line number, the error and the row, and the load carries on.
+"""
+import sys
+import csv
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import importlib
+
+from datetime import datetime
+
+from . import utils
+from . import model as _model
+from .model import Property, ComputedProperty, BooleanProperty, IntegerProperty, FloatProperty, DateTimeProperty, ObjectProperty
+from .tasklets import Executor
+
+_DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def read_jsonl(stream):
+    """ Yield (line number, row) for the lines of stream, row is the exception for
+    lines that aren't a JSON object
+    """
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('Expected a JSON object, found %s' % type(row).__name__)
+        except ValueError as e:
+            row = e
+        yield number, row
+
+
+def read_csv(stream):
+    """ Yield (line number, row) for the rows of a CSV stream with a header line.
+    Empty cells are left out of the row.
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, dict((name, value.decode('utf-8')) for name, value in row.iteritems() if value)
+
+
+def _parse_datetime(text):
+    for fmt in _DATETIME_FORMATS:
+        try:
+            return datetime.strptime(text.rstrip('Z'), fmt)
+        except ValueError:
+            pass
+    raise ValueError('Expected an ISO 8601 date and time, got %r' % (text,))
+
+
+def coerce(attr, text):
+    """ Convert the text of a CSV cell to the type attr validates. The cell of a
+    repeated property is a JSON array, whose strings are converted like cells.
+    """
+    if attr._repeated:
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError('Expected a JSON array for repeated property %s, got %r' % (attr._attr_name, text))
+        if isinstance(attr, ObjectProperty):
+            return items
+        return [_coerce(attr, item) if isinstance(item, basestring) else item for item in items]
+    return _coerce(attr, text)
+
+
+def _coerce(attr, text):
+    if isinstance(attr, BooleanProperty):
+        lowered = text.strip().lower()
+        if lowered not in ('true', 'false', '1', '0', 'yes', 'no'):
+            raise ValueError('Expected a boolean, got %r' % (text,))
+        return lowered in ('true', '1', 'yes')
+    if isinstance(attr, IntegerProperty):
+        return int(text)
+    if isinstance(attr, FloatProperty):
+        return float(text)
+    if isinstance(attr, DateTimeProperty):
+        return _parse_datetime(text)
+    if isinstance(attr, ObjectProperty):
+        return json.loads(text)
+    return text
+
+
+def to_db(model, row, text=False):
+    """ Validate a row, keyed by attribute or stored names, into a document. Each
+    value is validated once, and the document is the one put() would send.
+
+    :param text: the values are text to convert first, as read from CSV
+    """
+    entity = model(id=str(uuid.uuid4()))
+    values = entity._values
+    for name, value in row.iteritems():
+        if name == 'id':
+            entity.id = value
+            continue
+        attr = getattr(model, name, None)
+        if not isinstance(attr, Property):
+            attr = model._meta.get(name)
+        if attr is None:
+            raise ValueError('%s is not a property of %s' % (name, model.__name__))
+        if isinstance(attr, ComputedProperty):
+            continue  # computed again from the other values, e.g. in a dump of the table
+        if text:
+            value = coerce(attr, value)
+        values[attr._name] = attr._do_validate(value)
+    if model._computed:
+        entity._update_computed()
+
+    doc = {'id': entity.id}
+    for name, default, encode in model._encoders:
+        if name in values:
+            store = model._meta[name]._store
+            doc[name] = values[name] if store is None else store(values[name])
+        else:
+            doc[name] = encode(default)
+    return doc
+
+
+class _Load(object):
+    """ The state of one load() call, shared by the reading thread and the workers
+    """
+
+    def __init__(self, model, rejects, durability, conflict):
+        self.model = model
+        self.rejects = rejects
+        self.durability = durability
+        self.conflict = conflict
+        self.lock = threading.Lock()
+        self.stats = {'read': 0, 'inserted': 0, 'replaced': 0, 'rejected': 0, 'chunks': 0}
+
+    def reject(self, number, row, error):
+        with self.lock:
+            self.stats['rejected'] += 1
+            if self.rejects is not None:
+                if isinstance(row, Exception):
+                    row = None
+                self.rejects.write(json.dumps({'line': number, 'error': str(error), 'row': row}, default=str) + '\n')
+
+    def insert(self, docs):
+        rq = _model.table(self.model._table_name()).insert(docs, durability=self.durability, conflict=self.conflict)
+        try:
+            return self.model._run('load', rq)
+        finally:
+            _model.query_cache.invalidate(self.model._table_name())
+
+    def send(self, chunk):
+        """ Insert a chunk of (line number, row, document). The server only reports
+        the first error of an insert, so the documents of a chunk with errors are
+        sent again one at a time to find those to reject. Ids are assigned before
+        the first attempt, so a document the chunk stored is unchanged the second
+        time rather than stored twice, and refused as a duplicate when conflicts
+        are errors, which it is told apart from by comparing it with the stored one.
+        """
+        result = self.insert([doc for number, row, doc in chunk])
+        self._count(result)
+        if not result.get('errors'):
+            return
+        for number, row, doc in chunk:
+            single = self.insert(doc)
+            if not single.get('errors'):
+                # unchanged when the chunk stored it, and counted with the chunk
+                self._count({'inserted': single.get('inserted', 0), 'replaced': single.get('replaced', 0)})
+            elif self.conflict != 'error' or not self._stored(doc):
+                self.reject(number, row, single.get('first_error'))
+
+    def _stored(self, doc):
+        """ Whether the table holds doc as it is
+        """
+        return self.model._run('load', _model.table(self.model._table_name()).get(doc['id']).eq(doc))
+
+    def _count(self, result):
+        with self.lock:
+            self.stats['inserted'] += result.get('inserted', 0)
+            self.stats['replaced'] += result.get('replaced', 0) + result.get('unchanged', 0)
+
+
+def _rows(source, format):
+    """ Open source if it is a path and yield the rows of its format
+    """
+    reader = read_csv if format == 'csv' else read_jsonl
+    if isinstance(source, basestring):
+        with open(source, 'rb') as stream:
+            for item in reader(stream):
+                yield item
+    else:
+        for item in reader(source):
+            yield item
+
+
+@utils.positional(2)
+def load(model, source, format=None, chunk_size=1000, max_in_flight=4, durability='soft', conflict='update',
+         rejects=None):
+    """ Load the rows of source into model's table
+
+    :param model: the Model class
+    :param source: a path, or a file object of JSON lines or CSV
+    :param format: 'jsonl' or 'csv', by default from the extension of a path and 'jsonl' otherwise
+    :param chunk_size: documents per insert
+    :param max_in_flight: inserts sent at once, keep it at most the connection pool max_size
+    :param durability: 'soft' acknowledges writes before they reach the disk, 'hard' waits for it
+    :param conflict: what to do with a document whose id exists: 'update', 'replace' or 'error'
+    :param rejects: path or file object to write the rejected rows to, as JSON lines
+    :return dict of counts of rows read, documents inserted and replaced, rows rejected and chunks sent
+    """
+    if model._partition_by is not None:
+        raise TypeError("%s is partitioned, load into one of its partitions, see Model.partition()" % model.__name__)
+    if format is None:
+        format = 'csv' if isinstance(source, basestring) and source.lower().endswith('.csv') else 'jsonl'
+    close_rejects = isinstance(rejects, basestring)
+    if close_rejects:
+        rejects = open(rejects, 'w')
+    job = _Load(model, rejects, durability, conflict)
+    executor = Executor(max_workers=max_in_flight)
+    slots = threading.BoundedSemaphore(max_in_flight)
+    futures = []
+    started = time.time()
+
+    def submit(chunk):
+        slots.acquire()  # wait while max_in_flight chunks are outstanding
+        for done in [f for f in futures if f.done()]:
+            done.check_success()  # stop on a chunk that failed as a whole, e.g. a lost connection
+            futures.remove(done)
+        future = executor.submit(job.send, chunk)
+        future.add_callback(slots.release)
+        futures.append(future)
+        job.stats['chunks'] += 1
+
+    try:
+        valid = []
+        for number, row in _rows(source, format):
+            job.stats['read'] += 1
+            if isinstance(row, Exception):
+                job.reject(number, row, row)
+                continue
+            try:
+                valid.append((number, row, to_db(model, row, format == 'csv')))
+            except (ValueError, TypeError) as e:
+                job.reject(number, row, e)
+                continue
+            if len(valid) >= chunk_size:
+                submit(valid)
+                valid = []
+        if valid:
+            submit(valid)
+        for future in futures:
+            future.check_success()
+    finally:
+        executor.shutdown()
+        if close_rejects:
+            rejects.close()
+
+    job.stats['seconds'] = time.time() - started
+    return job.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load JSON lines or CSV into the table of a model.')
+    parser.add_argument('model', help='module.path:ModelClass')
+    parser.add_argument('source', help='file to load, - for stdin')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help='defaults to the file extension')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--in-flight', type=int, default=4, help='chunks inserted at once')
+    parser.add_argument('--durability', choices=('soft', 'hard'), default='soft')
+    parser.add_argument('--conflict', choices=('update', 'replace', 'error'), default='update')
+    parser.add_argument('--rejects', help='file to write rejected rows to')
+    parser.add_argument('--host', default=_model.DATABASE['host'])
+    parser.add_argument('--port', type=int, default=_model.DATABASE['port'])
+    parser.add_argument('--db', default=_model.DATABASE['db'])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    _model.DATABASE.update(host=args.host, port=args.port, db=args.db)
+    _model.connections.configure(max_size=max(args.in_flight, _model.connections.max_size))
+    module, name = args.model.split(':')
+    model = getattr(importlib.import_module(module), name)
+
+    source = sys.stdin if args.source == '-' else args.source
+    stats = load(model, source, format=args.format, chunk_size=args.chunk_size, max_in_flight=args.in_flight,
+                 durability=args.durability, conflict=args.conflict, rejects=args.rejects)
+    logging.info('Read %(read)d rows, inserted %(inserted)d, replaced %(replaced)d and rejected %(rejected)d '
+                 'in %(chunks)d chunks, %(seconds).1f seconds', stats)
+    return 1 if stats['rejected'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,35 @@
 """ Model and Property classes. Borrowed heavily from google/appengine/ext/ndb/model
 """
 import re
+import sys
+import copy
+import uuid
+import heapq
 import types
 import pytz
+import base64
 import logging
-from json import dumps
+import itertools
+from json import dumps, loads
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 
 from . import utils
+from .cache import get_context, entity_cache, query_cache
+from .tasklets import Future, executor, autobatcher, in_worker
+from . import instrumentation
 
 # set all the imports here from rethinkdb.* with "object" import removed
 from rethinkdb.net import connect, Connection, Cursor
 from rethinkdb.query import js, http, json, args, error, random, do, row, table, db, db_create, db_drop, db_list, table_create, table_drop, table_list, branch, asc, desc, eq, ne, le, ge, lt, gt, any, all, add, sub, mul, div, mod, type_of, info, time, monday, tuesday, wednesday, thursday, friday, saturday, sunday, january, february, march, april, may, june, july, august, september, october, november, december, iso8601, epoch_time, now, literal, make_timezone, and_, or_, not_
 from rethinkdb.errors import RqlError, RqlClientError, RqlCompileError, RqlRuntimeError, RqlDriverError
-from rethinkdb.ast import expr, RqlQuery
+from rethinkdb.ast import expr, RqlQuery, Asc, Desc
 import rethinkdb.docs
 
-import Queue
+import time as _time  # time is the rethinkdb term exported above
+import socket
 import threading
+import collections
 from contextlib import contextmanager
 
 lock = threading.Lock()
@@ -31,35 +42,691 @@ DATABASE = {
 }
 
 
+SCHEMA = {
+    'sync': True  # set to False to never check tables and indexes, e.g. in production workers
+}
+
+_models = []
+_synced = set()
+_sync_lock = threading.RLock()
+
+
+class PoolTimeoutError(RqlDriverError):
+    """ Raised when no connection became available before the pool timeout
+    """
+
+
+class BatchError(IOError):
+    """ Raised by the *_multi methods when some documents failed. errors is a list
+    in the same order as the input, None for documents that succeeded and the
+    exception or server error message for those that didn't.
+    """
+
+    def __init__(self, message, errors):
+        super(BatchError, self).__init__(message)
+        self.errors = errors
+
+
+class UnprojectedPropertyError(AttributeError):
+    """ Raised when reading a property that the projection query which loaded the
+    entity didn't fetch
+    """
+
+
+class _Node(object):
+    """ A server of the cluster, with the counters the pool balances and backs off on
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.outstanding = 0  # connections checked out
+        self.connections = 0  # connections open, checked out or idle
+        self.failures = 0  # in a row, reset by a successful connect
+        self.retry_at = 0.0
+        self.errors = 0
+        self.checkouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.latency = None  # moving average of the time a connection is checked out
+
+    @property
+    def name(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def available(self, now):
+        return not self.failures or now >= self.retry_at
+
+    def record(self, duration):
+        self.checkouts += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.latency = duration if self.latency is None else 0.8 * self.latency + 0.2 * duration
+
+    def stats(self, now):
+        return {
+            'healthy': not self.failures,
+            'retry_in': max(0.0, self.retry_at - now) if self.failures else 0.0,
+            'failures': self.failures,
+            'errors': self.errors,
+            'outstanding': self.outstanding,
+            'connections': self.connections,
+            'checkouts': self.checkouts,
+            'mean': self.total_time / self.checkouts if self.checkouts else 0.0,
+            'max': self.max_time,
+            'latency': self.latency,
+        }
+
+
+def _address(node):
+    """ (host, port) of a node given as 'host:port', 'host' or a (host, port) pair
+    """
+    if isinstance(node, basestring):
+        host, _, port = node.rpartition(':') if ':' in node else (node, None, DATABASE['port'])
+        return host, int(port)
+    host, port = node
+    return host, int(port)
+
+
 class ConnectionPool(object):
-    """ Manage a pool of connections
+    """ Manage a bounded, thread-safe pool of connections.
+
+    Connections are created on demand up to max_size. When every connection is
+    checked out, get() waits up to timeout seconds for one to be released and
+    then raises PoolTimeoutError. Idle connections are handed out most recently
+    used first, so the least used ones age out and are closed after max_idle
+    seconds while more than min_size connections are open.
+
+    With several nodes, each checkout goes to the node with the fewest connections
+    checked out, or to the one with the lowest latency for get(nearest=True). A node
+    that fails to connect, or whose connection breaks, is skipped for backoff
+    seconds, doubling with each failure in a row up to max_backoff.
+
+    :param min_size: number of connections opened by warmup() and kept open when idle
+    :param max_size: maximum number of open connections
+    :param timeout: seconds to wait for a free connection, None waits forever
+    :param max_idle: seconds an idle connection is kept, None keeps it forever
+    :param max_age: seconds after which a connection is replaced, None never replaces it
+    :param nodes: list of 'host:port' or (host, port) of the servers of a cluster,
+        None connects to DATABASE['host'] and DATABASE['port']
+    :param backoff: seconds a failed node is skipped for after its first failure
+    :param max_backoff: most seconds a failed node is skipped for
     """
 
-    _idle = Queue.Queue()
+    @utils.positional(1)
+    def __init__(self, min_size=0, max_size=5, timeout=30, max_idle=300, max_age=None, nodes=None, backoff=1.0,
+                 max_backoff=60.0):
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = collections.deque()  # (connection, created, released, node)
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._closed = 0
+        self._known = {}  # (host, port) -> _Node
+        self.nodes = None
+        self.configure(min_size=min_size, max_size=max_size, timeout=timeout, max_idle=max_idle, max_age=max_age,
+                       nodes=nodes, backoff=backoff, max_backoff=max_backoff)
+
+    def configure(self, **options):
+        """ Change the pool settings, takes the same keyword arguments as the constructor.
+        Open connections are kept and are subject to the new limits as they are released.
+        """
+        for name, value in options.iteritems():
+            if name not in ('min_size', 'max_size', 'timeout', 'max_idle', 'max_age', 'nodes', 'backoff',
+                            'max_backoff'):
+                raise TypeError("Unknown pool option %r" % name)
+            if name == 'nodes' and value is not None:
+                if not value:
+                    raise ValueError("nodes must list at least one server")
+                value = [self._node(*_address(node)) for node in value]
+            setattr(self, name, value)
 
-    _active = 0
+        if self.max_size < 1:
+            raise ValueError("max_size must be at least 1; received %r" % self.max_size)
+        if self.min_size > self.max_size:
+            raise ValueError("min_size %r is larger than max_size %r" % (self.min_size, self.max_size))
 
-    _total = 5
+        with self._cond:
+            self._cond.notify_all()
 
-    @contextmanager
-    def get(self):
-        if self._idle.empty() and self._active < self._total:
-            connection = connect(host=DATABASE['host'], port=DATABASE['port'], db=DATABASE['db'])
-        else:
-            connection = self._idle.get()
+    def _node(self, host, port):
+        key = (host, port)
+        node = self._known.get(key)
+        if node is None:
+            node = self._known.setdefault(key, _Node(host, port))
+        return node
 
-        self._active += 1
+    def _node_list(self):
+        if self.nodes is not None:
+            return self.nodes
+        return [self._node(DATABASE['host'], DATABASE['port'])]
 
+    def _pick(self, now, nearest=False, exclude=(), fallback=True):
+        """ The node for the next connection. Must be called with the lock held.
+
+        :param exclude: nodes not to pick, e.g. those that just failed
+        :param fallback: when every node is backing off, pick the one that is due
+            first rather than None
+        """
+        nodes = self._node_list()
+        if len(nodes) == 1 and not exclude:
+            return nodes[0]
+        nodes = [node for node in nodes if node not in exclude]
+        ready = [node for node in nodes if node.available(now)]
+        if not ready:
+            if not fallback or not nodes:
+                return None
+            ready = [min(nodes, key=lambda node: node.retry_at)]
+        if nearest:
+            return min(ready, key=lambda node: (node.latency or 0.0, node.outstanding))
+        return min(ready, key=lambda node: (node.outstanding, node.connections, node.latency or 0.0))
+
+    def _failed(self, node, now):
+        """ Back off from a node and drop its idle connections. Must be called with
+        the lock held, returns the connections that need closing.
+        """
+        node.failures += 1
+        node.errors += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (node.failures - 1))
+        node.retry_at = now + delay
+        if len(self._node_list()) > 1:
+            logging.warning("RethinkDB node %s failed %d times in a row, retrying in %.1fs",
+                            node.name, node.failures, delay)
+        expired = [entry for entry in self._idle if entry[3] is node]
+        if expired:
+            self._idle = collections.deque(entry for entry in self._idle if entry[3] is not node)
+            self._size -= len(expired)
+            self._closed += len(expired)
+            node.connections -= len(expired)
+        return [entry[0] for entry in expired]
+
+    def _connect(self, node):
+        return connect(host=node.host, port=node.port, db=DATABASE['db'])
+
+    def _close(self, connection):
+        try:
+            connection.close(noreply_wait=False)
+        except Exception:
+            logging.exception("Error closing pooled connection")
+
+    def _is_stale(self, created, released, now):
+        if self.max_age is not None and now - created > self.max_age:
+            return True
+        return self.max_idle is not None and now - released > self.max_idle and self._size > self.min_size
+
+    def _prune(self, now):
+        """ Remove expired connections from the cold end of the idle queue. Must be
+        called with the lock held, returns the connections that need closing.
+        """
+        expired = []
+        while self._idle:
+            connection, created, released, node = self._idle[0]
+            if not self._is_stale(created, released, now):
+                break
+            self._idle.popleft()
+            self._size -= 1
+            node.connections -= 1
+            expired.append(connection)
+        return expired
+
+    def _take_idle(self, node, now, expired):
+        """ Remove the most recently used idle connection to node, or to any node
+        when it is None, from the idle queue. Must be called with the lock held.
+
+        :return (connection, created, node), None when there is none
+        """
+        idle = self._idle
+        for i in xrange(len(idle) - 1, -1, -1):
+            connection, created, released, owner = idle[i]
+            if node is not None and owner is not node:
+                continue
+            if i == len(idle) - 1:
+                idle.pop()
+            else:
+                del idle[i]
+            if connection.is_open() and not self._is_stale(created, released, now):
+                return connection, created, owner
+            self._size -= 1
+            owner.connections -= 1
+            expired.append(connection)
+        return None
+
+    def _acquire(self, timeout, nearest=False):
+        start = _time.time()
+        deadline = None if timeout is None else start + timeout
+        expired = []
+        entry = node = None
+        timed_out = False
+
+        with self._cond:
+            while True:
+                now = _time.time()
+                expired.extend(self._prune(now))
+                node = self._pick(now, nearest)
+                entry = self._take_idle(node, now, expired)
+                if entry is None and self._size >= self.max_size:
+                    entry = self._take_idle(None, now, expired)  # better another node than waiting
+                if entry is not None or self._size < self.max_size:
+                    break
+
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    timed_out = True
+                    break
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            waited = _time.time() - start
+            self._closed += len(expired)
+            if timed_out:
+                self._timeouts += 1
+            else:
+                if entry is None:
+                    self._size += 1  # reserve the slot, connect outside the lock
+                else:
+                    node = entry[2]
+                node.outstanding += 1
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_time += waited
+                self._max_wait = max(self._max_wait, waited)
+
+        for stale in expired:
+            self._close(stale)
+
+        if timed_out:
+            raise PoolTimeoutError("Timed out after %.2fs waiting for a connection; %d of %d in use" % (
+                waited, self._in_use, self.max_size))
+
+        if entry is None:
+            return self._open(node, nearest)
+        return entry
+
+    def _open(self, node, nearest):
+        """ Connect to node for a reserved slot, moving on to the other available
+        nodes while connecting fails
+        """
+        tried = []
+        while True:
+            try:
+                connection = self._connect(node)
+            except Exception:
+                with self._cond:
+                    node.outstanding -= 1
+                    tried.append(node)
+                    expired = self._failed(node, _time.time())
+                    retry = self._pick(_time.time(), nearest, tried, fallback=False)
+                    if retry is None:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    else:
+                        retry.outstanding += 1
+                for stale in expired:
+                    self._close(stale)
+                if retry is None:
+                    raise
+                node = retry
+                continue
+
+            created = _time.time()
+            with self._cond:
+                self._opened += 1
+                node.connections += 1
+                node.failures = 0
+            return connection, created, node
+
+    def _release(self, connection, created, node, checked_out, broken):
+        now = _time.time()
+        keep = not broken and connection.is_open()
+        expired = []
+        with self._cond:
+            self._in_use -= 1
+            node.outstanding -= 1
+            node.record(now - checked_out)
+            if broken:
+                expired = self._failed(node, now)
+            if keep and (self._size > self.max_size or (self.max_age is not None and now - created > self.max_age)):
+                keep = False
+            if keep:
+                self._idle.append((connection, created, now, node))
+            else:
+                self._size -= 1
+                self._closed += 1
+                node.connections -= 1
+            self._cond.notify()
+
+        if not keep:
+            self._close(connection)
+        for stale in expired:
+            self._close(stale)
+
+    @contextmanager
+    def get(self, timeout=None, nearest=False):
+        """ Check a connection out of the pool for the duration of the with block.
+        Connections that raised a socket error, or a driver error that left them
+        closed, are counted against their node and not returned to the pool. Pool
+        timeouts and query errors leave the connection and its node alone.
+
+        :param timeout: seconds to wait for a connection, defaults to the pool timeout
+        :param nearest: connect to the node with the lowest latency rather than the
+            least busy one, for reads that any replica can serve
+        """
+        connection, created, node = self._acquire(self.timeout if timeout is None else timeout, nearest)
+        checked_out = _time.time()
+        broken = False
         try:
             yield connection
+        except socket.error:
+            broken = True
+            raise
+        except PoolTimeoutError:
+            raise
+        except RqlDriverError:
+            broken = not connection.is_open()
+            raise
         finally:
-            self._idle.put(connection)
-            self._active -= 1
+            self._release(connection, created, node, checked_out, broken)
+
+    def connect(self):
+        """ Open a connection outside of the pool, for queries that hold it for a
+        long time such as changefeeds. The caller closes it.
+        """
+        with self._cond:
+            node = self._pick(_time.time())
+        try:
+            return self._connect(node)
+        except Exception:
+            with self._cond:
+                expired = self._failed(node, _time.time())
+            for stale in expired:
+                self._close(stale)
+            raise
+
+    def warmup(self, count=None):
+        """ Open connections up front so the first requests don't pay for the
+        connection handshake. Opens min_size connections unless count is given.
+        """
+        count = self.min_size if count is None else min(count, self.max_size)
+        while True:
+            with self._cond:
+                if self._size >= count:
+                    return
+                self._size += 1
+                node = self._pick(_time.time())
+                node.connections += 1  # spread the connections over the nodes
+            try:
+                connection = self._connect(node)
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    node.connections -= 1
+                    expired = self._failed(node, _time.time())
+                    self._cond.notify()
+                for stale in expired:
+                    self._close(stale)
+                raise
+            now = _time.time()
+            with self._cond:
+                self._opened += 1
+                node.failures = 0
+                self._idle.append((connection, now, now, node))
+                self._cond.notify()
+
+    def clear(self):
+        """ Close all idle connections. Connections in use are closed as they are released
+        if the pool is over size, otherwise they return to the pool.
+        """
+        with self._cond:
+            idle = [connection for connection, created, released, node in self._idle]
+            for connection, created, released, node in self._idle:
+                node.connections -= 1
+            self._idle.clear()
+            self._size -= len(idle)
+            self._closed += len(idle)
+        for connection in idle:
+            self._close(connection)
+
+    def stats(self):
+        """ A consistent snapshot of the pool counters. Wait times are in seconds. nodes
+        has the counters of each server, its times are those connections were
+        checked out for, latency being their moving average.
+        """
+        with self._cond:
+            now = _time.time()
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'wait_time': self._wait_time,
+                'max_wait': self._max_wait,
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'closed': self._closed,
+                'nodes': dict((node.name, node.stats(now)) for node in self._node_list()),
+            }
 
 
 connections = ConnectionPool()
 
 
+@contextmanager
+def _connection(conn=None, nearest=False):
+    if conn is not None:
+        yield conn
+    else:
+        with connections.get(nearest=nearest) as conn:
+            yield conn
+
+
+def _result_size(result):
+    """ Documents returned by a query, or written by a write. A scalar, such as the
+    result of count(), is one value. None for cursors, which aren't read yet.
+    """
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        if 'errors' in result and ('inserted' in result or 'deleted' in result):
+            return sum(result.get(name, 0) for name in ('inserted', 'replaced', 'unchanged', 'deleted'))
+        return 1
+    if isinstance(result, (basestring, int, long, float, bool, date)):
+        return 1
+    return None
+
+
+def _run_query(model, operation, rq, fetch=False, conn=None, nearest=False):
+    """ Run rq on conn, or on a pooled connection, and report it to the instruments
+    when there are any, see instrumentation.
+
+    :param fetch: read a sequence result into a list before the connection is released
+    :param nearest: run it on the node with the lowest latency, see ConnectionPool.get
+    """
+    if not instrumentation.instruments:
+        with _connection(conn, nearest) as conn:
+            result = rq.run(conn)
+            return list(result) if fetch else result
+
+    event = instrumentation.QueryEvent(model, operation, rq)
+    instrumentation.before_query(event)
+    optargs = {'profile': True} if event.profile else {}
+    started = _time.time()
+    try:
+        with _connection(conn, nearest) as conn:
+            event.wait = _time.time() - started
+            result = rq.run(conn, **optargs)
+            if event.profile:
+                result, event.profile = result['value'], result['profile']
+            if fetch:
+                result = list(result)
+        event.size = _result_size(result)
+        return result
+    except Exception as e:
+        event.error = e
+        raise
+    finally:
+        event.duration = _time.time() - started - event.wait
+        instrumentation.after_query(event)
+
+
+def sync_all(models=None, force=False):
+    """ Create the tables and update the simple indexes of every model that hasn't
+    been synced yet in this process. The existing tables and indexes of all the
+    models are read in a single query and the changes are sent in at most two more,
+    rather than several round trips per model. A last one waits for the indexes it
+    created to be ready, queries use them right away.
+
+    Models sync themselves on first use unless SCHEMA['sync'] is False, calling this
+    at startup moves that cost out of the first request.
+
+    :param models: list of Model classes, defaults to every model defined so far but
+        the partitions of partitioned models, which put() creates as it needs them
+    :param force: check the models again even if they were synced before
+    """
+    with _sync_lock:
+        models = [m for m in (models or _models) if force or m not in _synced]
+        # a partitioned model has no table of its own, put() creates its partitions
+        _synced.update(m for m in models if m._partition_by is not None)
+        models = [m for m in models if m._partition_by is None]
+        if not models:
+            return
+
+        names = sorted(set(m._table_name() for m in models))
+        model = models[0] if len(models) == 1 else None
+        with connections.get() as conn:
+            existing = _run_query(model, 'sync', expr(dict(
+                (name, branch(table_list().contains(name), table(name).index_list(), None)) for name in names
+            )), conn=conn)
+
+            created = [table_create(name) for name in names if existing[name] is None]
+            if created:
+                _run_query(model, 'sync', expr(created), conn=conn)
+
+            wanted, unwanted = {}, set()
+            for synced in models:
+                name = synced._table_name()
+                creates, drops = synced._indexes()
+                for index, term in creates.iteritems():
+                    wanted[(name, index)] = term
+                unwanted.update((name, index) for index in drops)
+
+            changes = []
+            building = collections.OrderedDict()  # table name -> indexes created
+            for (name, index), term in sorted(wanted.items()):
+                if index not in (existing[name] or []):
+                    changes.append(term)
+                    building.setdefault(name, []).append(index)
+            for name, index in sorted(unwanted.difference(wanted)):
+                if index in (existing[name] or []):
+                    changes.append(table(name).index_drop(index))
+            if changes:
+                _run_query(model, 'sync', expr(changes), conn=conn)
+            if building:
+                # get_all() on an index fails until it is built, on a table with documents that takes a while
+                _run_query(model, 'sync', expr([table(name).index_wait(*indexes)
+                                                for name, indexes in building.iteritems()]), conn=conn)
+
+        _synced.update(models)
+
+
+# table name suffix format and the pattern of a suffix, by _partition_period
+_PERIODS = {
+    'day': ('%Y_%m_%d', re.compile(r'\d{4}_\d\d_\d\d$')),
+    'month': ('%Y_%m', re.compile(r'\d{4}_\d\d$')),
+    'year': ('%Y', re.compile(r'\d{4}$')),
+}
+
+
+def _utc(value):
+    """ A datetime as an aware UTC datetime, naive ones are taken to be UTC already.
+    Other values are returned as they are.
+    """
+    if not isinstance(value, datetime):
+        return value
+    return value.astimezone(pytz.utc) if value.tzinfo else pytz.utc.localize(value)
+
+
+def _concurrently(calls):
+    """ Run (function, args) calls concurrently, on the executor's workers and the
+    last one on the calling thread. Called on a worker, they all run on it one after
+    the other rather than wait for the other workers.
+
+    :return list of Futures for their results in the order of calls
+    """
+    futures = []
+    inline = in_worker()
+    for n, (func, args) in enumerate(calls):
+        if inline or n == len(calls) - 1:
+            future = Future(getattr(func, '__name__', None))
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e, sys.exc_info()[2])
+        else:
+            future = executor.submit(func, *args)
+        futures.append(future)
+    return futures
+
+
+def _fan_out(calls):
+    """ Run (function, args) calls concurrently, see _concurrently()
+
+    :return list of their results in the order of calls
+    """
+    return [future.get_result() for future in _concurrently(calls)]
+
+
+class _Descending(object):
+    """ Sort key wrapper that reverses the order of the values it wraps
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _merge(streams, key):
+    """ Merge iterables that are each sorted by key into one sorted generator, reading
+    each of them only as far as the merged order has got
+    """
+    heap = []
+    for n, stream in enumerate(streams):
+        stream = iter(stream)
+        for item in stream:
+            heap.append((key(item), n, item, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        unused_key, n, item, stream = heap[0]
+        yield item
+        for following in stream:
+            heapq.heapreplace(heap, (key(following), n, following, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
 class Property(object):
 
     _attr_name = None
@@ -68,10 +735,12 @@ class Property(object):
     _default = None
     _validator = None
     _indexed = True
+    _mutable = False  # values can be changed in place, so reading one marks it modified
+    _repeated = False
     _positional = 1
 
     @utils.positional(1 + _positional)  # Add 1 for self.
-    def __init__(self, name=None, indexed=None, required=False, default=None, validator=None):
+    def __init__(self, name=None, indexed=None, required=False, default=None, validator=None, repeated=False):
         if name is not None:
             if isinstance(name, unicode):
                 name = name.encode('utf-8')
@@ -95,6 +764,14 @@ class Property(object):
                 raise TypeError("Validator must be callable or None; received %r" % validator)
             self._validator = validator
 
+        if repeated:
+            # a list of values, each validated on its own. () is a default that can be
+            # shared, __get__ swaps it for a list of the entity's own.
+            self._repeated = True
+            self._mutable = True
+            if default is None:
+                self._default = ()
+
     def _set_name(self, name):
         """ Assign a name if no name was given. The name of the class attribute is
         passed in from _map_properties as a default name. This allows assignment of a
@@ -104,13 +781,81 @@ class Property(object):
         if self._name is None:
             self._name = name
 
+    def _compile(self):
+        """ Resolve the validator chain and the db transform once and store them as
+        flat functions on the property, replacing the methods below that compile on
+        first use. Models compile their properties when the class is created.
+        """
+        methods = tuple(reversed(self._find_methods('_validate')))
+        required = self._required
+        validator = self._validator
+        to_db = getattr(self, '_to_db', None)
+        prop = self
+
+        def validate(value):
+            if value is None:
+                if required:
+                    raise ValueError("No value given for required property: %s" % prop._attr_name)
+            else:
+                for method in methods:
+                    new_value = method(prop, value)
+                    if new_value is not None:
+                        value = new_value
+            if validator is not None:
+                new_value = validator(prop, value)
+                if new_value is not None:
+                    value = new_value
+            return value
+
+        if to_db is None:
+            encode = validate
+        else:
+            def encode(value):
+                return to_db(validate(value))
+        store = to_db  # the db transform of a value that is already valid, None to store it as it is
+        decode = getattr(self, '_from_db', None)
+
+        if self._repeated:
+            validate_one, to_db_one, from_db_one = validate, to_db, decode
+
+            def validate(values):
+                if values is None:
+                    values = ()
+                if not isinstance(values, (list, tuple)):
+                    raise ValueError('Expected a list for repeated property %s, got %r' % (prop._attr_name, values))
+                if required and not values:
+                    raise ValueError("No value given for required property: %s" % prop._attr_name)
+                return [validate_one(value) for value in values]
+
+            if to_db_one is None:
+                encode = validate
+            else:
+                def encode(values):
+                    return [to_db_one(value) for value in validate(values)]
+
+                def store(values):
+                    return [to_db_one(value) for value in values]
+
+            if from_db_one is not None:
+                def decode(values):
+                    return [from_db_one(value) for value in values] if values is not None else []
+
+        self._do_validate = validate
+        self._encode = encode
+        self._store = store
+        self._decode = decode
+
     def _do_validate(self, value):
-        value = self._call_validation(value)
-        if self._validator is not None:
-            new_value = self._validator(self, value)
-            if new_value is not None:
-                value = new_value
-        return value
+        """ Run the _validate() chain and the validator function on a value
+        """
+        self._compile()
+        return self._do_validate(value)
+
+    def _encode(self, value):
+        """ Validate a value and transform it for storage in the db
+        """
+        self._compile()
+        return self._encode(value)
 
     def _call_validation(self, value):
         """ Call the initial set of _validate() methods using reverse Method Resolution Order.
@@ -131,8 +876,7 @@ class Property(object):
             else:
                 return value
 
-        validate_methods = self._find_methods('_validate')
-        validate_methods.reverse()
+        validate_methods = list(reversed(self._find_methods('_validate')))
         call = self._apply_list(validate_methods)
         return call(value)
 
@@ -185,10 +929,7 @@ class Property(object):
         """ Transform the python value for storage in the db, first running all
         validators on the property.
         """
-        value = self._do_validate(entity._values.get(self._name, self._default))
-        if hasattr(self, '_to_db'):
-            value = self._to_db(value)
-        return value
+        return self._encode(entity._values.get(self._name, self._default))
 
     def _do_from_db(self, entity, value):
         """ Set the property value from the db and transform it for python
@@ -201,16 +942,76 @@ class Property(object):
         """Descriptor protocol: get the value from the entity."""
         if entity is None:
             return self  # __get__ called on class
+        if entity._projection is not None and self._name not in entity._projection:
+            raise UnprojectedPropertyError('%s.%s was not fetched by the projection %s' % (
+                type(entity).__name__, self._attr_name, sorted(entity._projection)))
+        if self._mutable:
+            if entity._dirty is not None:
+                entity._dirty.add(self._name)
+            if entity._computed:
+                entity._forget_computed()  # the caller may change the value in place
+            if self._repeated and self._name not in entity._values:
+                entity._values[self._name] = list(self._default)
         return entity._values.get(self._name, self._default)
 
     def __set__(self, entity, value):
         """Descriptor protocol: set the value on the entity."""
         entity._values[self._name] = self._do_validate(value)
+        if entity._dirty is not None:
+            entity._dirty.add(self._name)
+        if entity._projection is not None:
+            entity._projection.add(self._name)
+        if entity._computed:
+            entity._forget_computed()
 
     def __delete__(self, entity):
         """Descriptor protocol: delete the value from the entity."""
         if self._name in entity._values:
             del entity._values[self._name]
+            if entity._dirty is not None:
+                entity._dirty.add(self._name)
+            if entity._computed:
+                entity._forget_computed()
+
+
+class ComputedProperty(Property):
+    """ A read-only property whose value is func(entity). It is stored with the
+    document, and indexed by default, so queries can filter and order on it:
+
+        class Contact(Model):
+            email = StringProperty()
+            domain = ComputedProperty(lambda self: self.email.split('@')[1])
+
+        Contact.find(domain='example.com')
+
+    The value is computed on first read and kept until one of the entity's other
+    properties is set, and it is computed again for every put().
+    """
+
+    @utils.positional(2 + Property._positional)  # Add 1 for self and 1 for func.
+    def __init__(self, func, name=None, indexed=None, repeated=False):
+        super(ComputedProperty, self).__init__(name=name, indexed=indexed, repeated=repeated)
+        if not hasattr(func, '__call__'):
+            raise TypeError("func must be callable; received %r" % (func,))
+        self._func = func
+
+    def _compute(self, entity):
+        return self._do_validate(self._func(entity))
+
+    def __get__(self, entity, unused_cls=None):
+        if entity is None:
+            return self  # __get__ called on class
+        values = entity._values
+        if self._name in values:
+            return values[self._name]
+        value = values[self._name] = self._compute(entity)
+        return value
+
+    def __set__(self, entity, value):
+        raise AttributeError('ComputedProperty %s.%s is read-only' % (type(entity).__name__, self._attr_name))
+
+    def __delete__(self, entity):
+        raise AttributeError('ComputedProperty %s.%s is read-only' % (type(entity).__name__, self._attr_name))
 
 
 class BooleanProperty(Property):
@@ -279,11 +1080,11 @@ class DateTimeProperty(Property):
     _auto_now = False
 
     @utils.positional(1 + Property._positional)  # Add 1 for self.
-    def __init__(self, name=None, indexed=None, required=False, default=None, validator=None, auto_now=False, auto_now_add=False):
+    def __init__(self, name=None, indexed=None, required=False, default=None, validator=None, auto_now=False, auto_now_add=False, repeated=False):
         self._auto_now = auto_now
         self._auto_now_add = auto_now_add
 
-        super(DateTimeProperty, self).__init__(required=required, default=default)
+        super(DateTimeProperty, self).__init__(name=name, indexed=indexed, required=required, default=default, validator=validator, repeated=repeated)
 
     def _validate(self, value):
         if not isinstance(value, date):
@@ -312,6 +1113,7 @@ class DateTimeProperty(Property):
 
 
 class ObjectProperty(Property):
+    _mutable = True
 
     def _validate(self, value):
         if type(value) is not dict and type(value) is not list:
@@ -320,31 +1122,300 @@ class ObjectProperty(Property):
         return value
 
 
+class _MissingReference(object):
+    """ Stands in the values of an entity for the id of a reference that was looked up
+    and not found, so reading it again doesn't repeat the lookup
+    """
+
+    __slots__ = ('id',)
+
+    def __init__(self, id):
+        self.id = id
+
+
+class ReferenceProperty(Property):
+    """ The id of an entity of another model. Reading the property returns the
+    entity, fetched with get_by_id on first read, and it can be set to an entity or
+    an id:
+
+        class Order(Model):
+            customer = ReferenceProperty(Customer)
+
+        order.customer = customer
+        order.customer.name
+
+    Reading it for every entity of a list is a query each, pass prefetch=['customer']
+    to Model.all or get_multi to load them all with one get_all per model. ids of
+    missing documents are left in place of their entities in repeated properties,
+    and a missing single reference reads as None without being looked up again.
+
+    :param model: the referenced Model class, or its class name for models defined later
+    """
+
+    @utils.positional(2 + Property._positional)  # Add 1 for self and 1 for model.
+    def __init__(self, model, name=None, indexed=None, required=False, default=None, validator=None, repeated=False):
+        super(ReferenceProperty, self).__init__(name=name, indexed=indexed, required=required, default=default,
+                                                validator=validator, repeated=repeated)
+        self._model = model
+
+    def _target(self):
+        """ The referenced model class
+        """
+        if isinstance(self._model, basestring):
+            for model in _models:
+                if model.__name__ == self._model:
+                    self._model = model
+                    break
+            else:
+                raise ValueError('ReferenceProperty %s refers to unknown model %s' % (self._attr_name, self._model))
+        return self._model
+
+    def _validate(self, value):
+        if isinstance(value, (_KEY_TYPES, _MissingReference)):
+            return value
+        if not isinstance(value, self._target()):
+            raise ValueError('Expected a %s or its id, got %r' % (self._target().__name__, value))
+        return value
+
+    def _to_db(self, value):
+        if isinstance(value, Model):
+            if not value.id:
+                raise ValueError('The %s referenced by %s has no id, put it first' % (
+                    type(value).__name__, self._attr_name))
+            return value.id
+        if isinstance(value, _MissingReference):
+            return value.id
+        return value
+
+    def _ids(self, value):
+        """ The ids of a value, which holds ids, entities or both
+        """
+        if self._repeated:
+            return [item.id if isinstance(item, Model) else item for item in value]
+        return value.id if isinstance(value, (Model, _MissingReference)) else value
+
+    def __get__(self, entity, unused_cls=None):
+        if entity is None:
+            return self  # __get__ called on class
+        value = super(ReferenceProperty, self).__get__(entity)
+        if self._repeated:
+            ids = [item for item in value if isinstance(item, _KEY_TYPES)]
+            if ids:
+                loaded = dict((id, found) for id, found in zip(ids, self._target().get_multi(ids)) if found is not None)
+                value[:] = [loaded.get(item, item) if isinstance(item, _KEY_TYPES) else item for item in value]
+            return value
+        if isinstance(value, _MissingReference):
+            return None
+        if isinstance(value, _KEY_TYPES):
+            loaded = self._target().get_by_id(value)
+            # not a change, both store the same id
+            entity._values[self._name] = _MissingReference(value) if loaded is None else loaded
+            return loaded
+        return value
+
+
+# values that can be looked up in an index with get_all()
+_KEY_TYPES = (basestring, int, long, float, datetime, date)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def _encode_cursor(values):
+    """ Pack index values into an opaque url safe token for fetch_page
+    """
+    def encode(value):
+        if isinstance(value, datetime):
+            if not value.tzinfo:
+                value = pytz.utc.localize(value)
+            return {'$time': (value - _EPOCH).total_seconds()}
+        return value
+    return base64.urlsafe_b64encode(dumps([encode(value) for value in values]))
+
+
+def _decode_cursor(token):
+    def decode(obj):
+        if '$time' in obj:
+            return _EPOCH + timedelta(seconds=obj['$time'])
+        return obj
+    try:
+        return loads(base64.urlsafe_b64decode(str(token)), object_hook=decode)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor %r" % (token,))
+
+
+_MISSING = object()
+
+
+class _SlotValues(list):
+    """ Positional property storage for compact models. A list with one position per
+    property, addressed by stored name through the model's _index, so an entity holds
+    a single list instead of a dict sized for all of its keys.
+    """
+    __slots__ = ()
+
+    _index = {}
+    _names = ()
+    _blank = ()
+
+    def __init__(self, data=None):
+        list.__init__(self, self._blank if data is None else data)
+
+    @classmethod
+    def _from_dict(cls, values):
+        get = values.get
+        return cls([get(name, _MISSING) for name in cls._names])
+
+    def _position(self, name):
+        i = self._index.get(name)
+        if i is None:
+            raise KeyError(name)
+        if i >= len(self):
+            # a property was added to the model after this entity was created
+            self.extend([_MISSING] * (i + 1 - len(self)))
+        return i
+
+    def get(self, name, default=None):
+        try:
+            value = list.__getitem__(self, self._index[name])
+        except (KeyError, IndexError):
+            return default
+        return default if value is _MISSING else value
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        list.__setitem__(self, self._position(name), value)
+
+    def __delitem__(self, name):
+        self[name]  # raises KeyError if there is no value
+        list.__setitem__(self, self._position(name), _MISSING)
+
+    def __contains__(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def iteritems(self):
+        for name, i in self._index.iteritems():
+            value = self.get(name, _MISSING)
+            if value is not _MISSING:
+                yield name, value
+
+    def keys(self):
+        return [name for name, value in self.iteritems()]
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class _LazyValues(dict):
+    """ Property values of an entity loaded from the database, holding the document
+    as the driver returned it. The values of properties with a decoder are decoded
+    when they are first read, so reading a few properties of a wide entity only
+    pays for those.
+    """
+    __slots__ = ('_pending', '_lazy')
+
+    def __init__(self, doc, pending, lazy):
+        dict.__init__(self, doc)
+        self._pending = pending  # names still holding their db value
+        self._lazy = lazy  # the model's decoders that aren't None
+
+    def _decode(self, name):
+        self._pending.discard(name)
+        dict.__setitem__(self, name, self._lazy[name](dict.__getitem__(self, name)))
+
+    def get(self, name, default=None):
+        if name in self._pending:
+            self._decode(name)
+        return dict.get(self, name, default)
+
+    def __getitem__(self, name):
+        if name in self._pending:
+            self._decode(name)
+        return dict.__getitem__(self, name)
+
+    def __setitem__(self, name, value):
+        self._pending.discard(name)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        self._pending.discard(name)
+        dict.__delitem__(self, name)
+
+    def iteritems(self):
+        for name in list(self._pending):
+            self._decode(name)
+        return dict.iteritems(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+
 class MetaModel(type):
 
+    def __new__(mcs, name, bases, classdict):
+        """ Give compact models __slots__ for the entity attributes, so instances don't
+        carry a __dict__ of their own.
+        """
+        if classdict.get('_compact') and not [base for base in bases if getattr(base, '_compact', False)]:
+            classdict.setdefault('__slots__', ('id', '_values', '_dirty', '_projection'))
+        return super(MetaModel, mcs).__new__(mcs, name, bases, classdict)
+
     def __init__(cls, name, bases, classdict):
-        """ Initialize the class, map properties and create the
-        database table.
+        """ Initialize the class and map properties. The database table is
+        created when the model is first used, see sync_all().
         """
         super(MetaModel, cls).__init__(name, bases, classdict)
         cls._map_properties()
-        cls._sync_table()
+        cls._compile_properties()
+        if cls._partition_by is not None:
+            cls._partition_property()  # raises for a bad partitioning option
+        if name != 'Model' and cls._partition_of is None:  # partitions are synced by the put() that creates them
+            _models.append(cls)
 
 
 class Model(object):
 
     __metaclass__ = MetaModel
+    __slots__ = ()  # subclasses get a __dict__ unless they are _compact
 
     id = None
 
     _meta = None
     _values = None
+    _dirty = None  # names of the properties changed since the entity was loaded or put
+    _projection = None  # names of the properties a projection query loaded, None when all were
+    _use_cache = True  # keep entities in the identity map of the current context
+    _use_process_cache = True  # keep documents in entity_cache when it is enabled
+    _cache_ttl = None  # seconds, None uses the entity_cache default
+    _use_query_cache = True  # keep the results of all() and count() in query_cache when it is enabled
+    _read_mode = None  # 'outdated' reads from the nearest replica, see query()
+    _encoders = ()
+    _decoders = None
+    _lazy_decoders = None
+    _known_names = frozenset()
+    _fields = ()
+    _mutable_names = ()
+    _auto_now_names = ()
+    _computed = ()  # (name, ComputedProperty) pairs
+    _references = ()  # (attribute name, ReferenceProperty) pairs
+    _batch_size = 500
+    _partition_by = None  # attribute name of a DateTimeProperty to keep a table per period of, see partition()
+    _partition_period = 'month'  # 'day', 'month' or 'year'
+    _partition_ttl = 60  # seconds the list of existing partition tables is reused for
+    _partition_of = None  # the partitioned model of a partition's model
+    _partition_suffix = None
+    _compact = False  # store property values positionally in slots, for bulk reads
+    _values_type = dict
 
     def __init__(self, **kwargs):
-        if 'id' in kwargs:
-            self.id = kwargs.pop('id')
-
-        self._values = {}
+        self.id = kwargs.pop('id', None)
+        self._values = self._values_type()
+        self._dirty = None
+        self._projection = None
         self._set_attributes(kwargs)
 
     @classmethod
@@ -362,6 +1433,44 @@ class Model(object):
                 attr._set_name(name)
                 cls._meta[attr._name] = attr
 
+    @classmethod
+    def _compile_properties(cls):
+        """ Build the flat per-property pipelines that _to_db, _from_db and to_dict
+        run, so they don't resolve validators and transforms for every entity.
+        """
+        encoders = []
+        decoders = {}
+        fields = []
+        for name, attr in cls._meta.iteritems():
+            attr._compile()
+            encoders.append((name, attr._default, attr._encode))
+            decoders[name] = attr._decode
+            if getattr(cls, attr._attr_name, None) is attr:
+                fields.append((attr._attr_name, name, attr._default))
+        cls._encoders = tuple(encoders)
+        cls._decoders = decoders
+        cls._lazy_decoders = dict((name, decode) for name, decode in decoders.iteritems() if decode is not None)
+        cls._known_names = frozenset(decoders).union(['id'])
+        cls._fields = tuple(fields)
+        cls._mutable_names = tuple(name for name, attr in cls._meta.iteritems() if attr._mutable)
+        cls._auto_now_names = tuple(name for name, attr in cls._meta.iteritems() if getattr(attr, '_auto_now', False))
+        cls._computed = tuple((name, attr) for name, attr in cls._meta.iteritems()
+                              if isinstance(attr, ComputedProperty))
+        cls._references = tuple((attr._attr_name, attr) for name, attr in cls._meta.iteritems()
+                                if isinstance(attr, ReferenceProperty))
+
+        if cls._compact:
+            values_type = cls.__dict__.get('_values_type')
+            if values_type is None:
+                values_type = type(cls.__name__ + 'Values', (_SlotValues,), {'__slots__': (), '_index': {}})
+                cls._values_type = values_type
+            # positions only ever get appended, entities already loaded keep their layout
+            index = values_type._index
+            for name in sorted(cls._meta):
+                index.setdefault(name, len(index))
+            values_type._names = tuple(sorted(index, key=index.get))
+            values_type._blank = (_MISSING,) * len(index)
+
     @classmethod
     def _table_name(cls):
         return getattr(cls, '_table', cls.__name__)
@@ -372,22 +1481,246 @@ class Model(object):
         the table name by setting _table on the class. Updates simple indexes as
         defined by the properties.
 
-        Complex indexes need to be created separately.
+        Complex indexes need to be created separately. A partitioned model syncs the
+        partitions that exist, put() creates the others as they are needed.
         """
         if cls.__name__ == 'Model':
             return  # skip call on this class
 
-        with cls._get_connection() as conn:
-            tables = table_list().run(conn)
-            if not cls._table_name() in tables:
-                table_create(cls._table_name()).run(conn)
+        if cls._partition_by is not None:
+            partitions = cls.partitions(refresh=True)
+            if partitions:
+                sync_all(partitions, force=True)
+            return
+        sync_all([cls], force=True)
+
+    @classmethod
+    def _indexes(cls):
+        """ Return a dict of index name to index_create term for the simple indexes
+        defined by the properties, and the set of names that should not be indexed.
+        """
+        wanted, unwanted = {}, set()
+        for attr in cls._meta.itervalues():
+            if attr._indexed:
+                wanted[attr._name] = table(cls._table_name()).index_create(attr._name, multi=attr._repeated)
+            else:
+                unwanted.add(attr._name)
+        return wanted, unwanted
+
+    @classmethod
+    def _partition_property(cls):
+        attr = getattr(cls, cls._partition_by, None)
+        if not isinstance(attr, DateTimeProperty) or attr._repeated:
+            raise TypeError("_partition_by of %s must name a DateTimeProperty, got %r" % (cls.__name__, cls._partition_by))
+        if attr._auto_now:
+            raise TypeError("%s can't be partitioned by %s, an auto_now property changes with every put" % (
+                cls.__name__, cls._partition_by))
+        if cls._partition_period not in _PERIODS:
+            raise ValueError("_partition_period must be one of %s; received %r" % (
+                ', '.join(sorted(_PERIODS)), cls._partition_period))
+        return attr
+
+    @classmethod
+    def _suffix(cls, when):
+        """ The table name suffix of the period when falls in, in UTC
+        """
+        if isinstance(when, datetime) and when.tzinfo:
+            when = when.astimezone(pytz.utc)
+        return when.strftime(_PERIODS[cls._partition_period][0])
+
+    @classmethod
+    def _id_suffix(cls, id):
+        """ The partition suffix an id generated by put() starts with, None for other ids
+        """
+        if isinstance(id, basestring):
+            suffix = id.split('-', 1)[0]
+            if _PERIODS[cls._partition_period][1].match(suffix):
+                return suffix
+        return None
+
+    @classmethod
+    def _partition_model(cls, suffix):
+        """ The model of the partition table with suffix, a subclass made on first use
+        """
+        models = cls.__dict__.get('_partition_models')
+        model = models.get(suffix) if models else None
+        if model is not None:
+            return model
+        with _sync_lock:
+            if '_partition_models' not in cls.__dict__:
+                cls._partition_models = {}
+            model = cls._partition_models.get(suffix)
+            if model is None:
+                model = type(cls)('%s_%s' % (cls.__name__, suffix), (cls,), {
+                    '__module__': cls.__module__,
+                    '__slots__': (),
+                    '_table': '%s_%s' % (cls._table_name(), suffix),
+                    '_values_type': cls._values_type,
+                    '_partition_by': None,
+                    '_partition_of': cls,
+                    '_partition_suffix': suffix,
+                })
+                cls._partition_models[suffix] = model
+            return model
+
+    @classmethod
+    def _partition_suffixes(cls, refresh=False):
+        """ The set of suffixes of the partition tables that exist, read with
+        table_list() at most every _partition_ttl seconds
+        """
+        state = cls.__dict__.get('_partition_tables')
+        now = _time.time()
+        if refresh or state is None or state[0] + cls._partition_ttl < now:
+            prefix = cls._table_name() + '_'
+            pattern = _PERIODS[cls._partition_period][1]
+            names = _run_query(cls, 'partitions', table_list())
+            state = cls._partition_tables = (now, set(
+                name[len(prefix):] for name in names if name.startswith(prefix) and pattern.match(name[len(prefix):])))
+        return state[1]
+
+    @classmethod
+    def _partition_exists(cls, suffix):
+        return suffix in cls._partition_suffixes() or suffix in cls._partition_suffixes(refresh=True)
+
+    @classmethod
+    def partition(cls, when):
+        """ The model of the partition that holds the documents of when, e.g. with
+        monthly partitions Event.partition(datetime(2014, 11, 5)) reads and writes the
+        Event_2014_11 table. It is a subclass of the partitioned model and works like
+        any other model, for the queries that all() and count() don't fan out.
+        """
+        if cls._partition_by is None:
+            raise TypeError("%s is not partitioned" % cls.__name__)
+        return cls._partition_model(cls._suffix(when))
+
+    @classmethod
+    def partitions(cls, start=None, end=None, refresh=False):
+        """ The models of the partition tables that exist, oldest first
+
+        :param start: only the partitions from the one of this datetime
+        :param end: only the partitions up to the one of this datetime, included
+        :param refresh: list the tables again rather than use the list of the last _partition_ttl seconds
+        """
+        if cls._partition_by is None:
+            raise TypeError("%s is not partitioned" % cls.__name__)
+        low = cls._suffix(start) if start is not None else None
+        high = cls._suffix(end) if end is not None else None
+        return [cls._partition_model(suffix) for suffix in sorted(cls._partition_suffixes(refresh))
+                if (low is None or suffix >= low) and (high is None or suffix <= high)]
+
+    @classmethod
+    def _partitions_for(cls, predicate):
+        """ The partitions a predicate can match documents in: the one of an equality
+        term on the partition property, those of a (start, end) range term, or all
+        """
+        name = cls._partition_property()._name
+        value = predicate.get(name) if isinstance(predicate, dict) else None
+        if isinstance(value, tuple):
+            return cls.partitions(*value)
+        if isinstance(value, date):
+            return cls.partitions(value, value)
+        return cls.partitions()
+
+    @classmethod
+    def _partitions_of_ids(cls, ids):
+        """ Group ids by the partition their prefix names. Ids without one could be in
+        any partition, they are looked for in all of them.
+
+        :return OrderedDict of partition model to list of ids
+        """
+        groups = collections.OrderedDict()
+        anywhere = []
+        for id in ids:
+            if not id:
+                continue
+            suffix = cls._id_suffix(id)
+            if suffix is None:
+                anywhere.append(id)
+            elif cls._partition_exists(suffix):
+                groups.setdefault(cls._partition_model(suffix), []).append(id)
+        if anywhere:
+            for model in cls.partitions():
+                groups.setdefault(model, []).extend(anywhere)
+        return groups
+
+    def _partition_for_put(self):
+        """ The model whose table put() stores this entity in: its own, or the partition
+        of the partition property for an entity of a partitioned model. The table is
+        created the first time a partition is written to. A new entity gets an id that
+        starts with the partition suffix, so get_by_id() and delete() go straight to
+        its table. That makes the partition part of the id, changing the property to
+        another period raises ValueError, delete the entity and put a new one instead.
+        """
+        cls = type(self)
+        if cls._partition_of is not None:  # loaded from a partition
+            self._check_period(cls._partition_of, cls._partition_suffix)
+            return cls
+        if cls._partition_by is None:
+            return cls
+        suffix = cls._id_suffix(self.id)
+        if suffix is not None:
+            self._check_period(cls, suffix)
+        else:
+            attr = cls._partition_property()
+            when = self._values.get(attr._name)
+            if when is None:
+                if not attr._auto_now_add:
+                    raise ValueError("%s.%s must be set to pick a partition" % (cls.__name__, cls._partition_by))
+                when = datetime.utcnow()  # the server sets the stored value, close enough to pick the period
+            suffix = cls._suffix(when)
+            if not self.id:
+                self.id = '%s-%s' % (suffix, uuid.uuid4())
+        model = cls._partition_model(suffix)
+        if model not in _synced:
+            sync_all([model])
+            with _sync_lock:
+                state = cls.__dict__.get('_partition_tables')
+                if state is not None:
+                    state[1].add(suffix)
+        return model
+
+    def _check_period(self, partitioned, suffix):
+        """ Raise ValueError when the partition property was set to a period other
+        than the one of the partition with suffix
+        """
+        when = self._values.get(partitioned._partition_property()._name)
+        if when is not None and partitioned._suffix(when) != suffix:
+            raise ValueError("%s %s is stored in the %s partition, %s=%s belongs to another one; delete it and "
+                             "put a new entity to move it" % (partitioned.__name__, self.id, suffix,
+                                                               partitioned._partition_by, when))
+
+    @classmethod
+    def drop_partitions(cls, before):
+        """ Drop the partitions whose whole period is before a datetime, for retention:
+
+            Event.drop_partitions(datetime.utcnow() - timedelta(days=365))
+
+        Dropping a table takes the same short time however many documents it holds,
+        where deleting them rewrites every one and then leaves the table to compact.
+
+        :return list of the names of the tables dropped
+        """
+        limit = cls._suffix(before)
+        models = [model for model in cls.partitions(refresh=True) if model._partition_suffix < limit]
+        if not models:
+            return []
+        names = [model._table_name() for model in models]
+        _run_query(cls, 'drop_partitions', expr([table_drop(name) for name in names]))
+        with _sync_lock:
+            _synced.difference_update(models)
+            cls._partition_suffixes().difference_update(model._partition_suffix for model in models)
+            for model in models:
+                cls._partition_models.pop(model._partition_suffix, None)
+        for name in names:
+            query_cache.invalidate(name)
+            entity_cache.delete_where(lambda key: key[0] == name)
+        return names
 
-            indexes = table(cls._table_name()).index_list().run(conn)
-            for name, attr in cls._meta.iteritems():
-                if attr._indexed and attr._name not in indexes:
-                    table(cls._table_name()).index_create(attr._name).run(conn)
-                elif not attr._indexed and attr._name in indexes:
-                    table(cls._table_name()).index_drop(attr._name).run(conn, noreply=True)
+    @classmethod
+    def _check_unpartitioned(cls, operation):
+        if cls._partition_by is not None:
+            raise TypeError("%s is partitioned, run %s on one of %s.partitions()" % (
+                cls.__name__, operation, cls.__name__))
 
     def _set_attributes(self, kwargs):
         cls = self.__class__
@@ -398,80 +1731,891 @@ class Model(object):
             setattr(self, name, value)
 
     @classmethod
-    def _get_connection(cls):
-        return connections.get()
+    def _get_connection(cls, nearest=False):
+        if SCHEMA['sync'] and cls not in _synced and cls.__name__ != 'Model' and cls._partition_of is None:
+            sync_all()
+        return connections.get(nearest=nearest)
+
+    @classmethod
+    def _run(cls, operation, rq, fetch=False, nearest=False):
+        """ Run rq on a pooled connection, see _run_query
+        """
+        if SCHEMA['sync'] and cls not in _synced and cls.__name__ != 'Model' and cls._partition_of is None:
+            sync_all()
+        return _run_query(cls, operation, rq, fetch, nearest=nearest)
 
     @classmethod
-    def query(cls):
+    def query(cls, read_mode=None):
         """ The rethinkdb query object. Exposes RQL queries for this table
+
+        :param read_mode: 'outdated' to let any replica answer, with data that may
+            lag behind the primary, or 'single'. Defaults to the model's _read_mode.
         """
+        if cls._outdated(read_mode):
+            return table(cls._table_name(), use_outdated=True)
         return table(cls._table_name())
 
     @classmethod
-    def _deserializer(cls, results):
+    def _outdated(cls, read_mode=None):
+        read_mode = read_mode or cls._read_mode
+        if read_mode not in (None, 'single', 'outdated'):
+            raise ValueError("read_mode must be 'single' or 'outdated'; received %r" % (read_mode,))
+        return read_mode == 'outdated'
+
+    @classmethod
+    def _cache_get(cls, id):
+        """ Look an entity up in the context identity map and then in entity_cache
+        """
+        key = (cls._table_name(), id)
+        ctx = get_context() if cls._use_cache else None
+        if ctx is not None:
+            entity = ctx.get(key)
+            if isinstance(entity, cls._partition_of or cls):
+                return entity
+
+        if cls._use_process_cache and entity_cache.enabled:
+            doc = entity_cache.get(key)
+            if doc is not None:
+                entity = cls._from_db(copy.deepcopy(doc))
+                if ctx is not None:
+                    ctx.set(key, entity)
+                return entity
+        return None
+
+    @classmethod
+    def _cache_set(cls, entity, doc):
+        key = (cls._table_name(), entity.id)
+        ctx = get_context() if cls._use_cache else None
+        if ctx is not None:
+            ctx.set(key, entity)
+        if cls._use_process_cache and entity_cache.enabled:
+            entity_cache.set(key, copy.deepcopy(doc), cls._cache_ttl)
+
+    @classmethod
+    def _cache_invalidate(cls, id, entity=None):
+        """ Drop a document from both cache levels after a write. The identity map
+        keeps the entity that was written, entity_cache refetches it because the
+        server may have changed it, e.g. with auto_now.
+        """
+        key = (cls._table_name(), id)
+        ctx = get_context()
+        if ctx is not None:
+            if entity is not None and entity._projection is None and cls._use_cache:
+                ctx.set(key, entity)
+            else:
+                ctx.delete(key)
+        entity_cache.delete(key)
+        if query_cache.enabled:
+            query_cache.invalidate(key[0])
+
+    @classmethod
+    def _run_cached(cls, operation, rq, fetch=False, nearest=False):
+        """ Run rq like _run, through query_cache when it is enabled
+        """
+        if not (cls._use_query_cache and query_cache.enabled):
+            return cls._run(operation, rq, fetch, nearest)
+        table_name = cls._table_name()
+        key = query_cache.key(table_name, rq)
+        if key is None:
+            return cls._run(operation, rq, fetch, nearest)
+        result = query_cache.get(key)  # a copy, the entities made of it can't change the cached result
+        if result is not None:
+            return result
+        generation = query_cache.generation(table_name)
+        result = cls._run(operation, rq, fetch, nearest)
+        query_cache.set(key, result, generation=generation)
+        return result
+
+    @classmethod
+    def _deserializer(cls, results, projection=None):
         for result in results:
-            yield cls._from_db(result)
+            yield cls._from_db(result, projection)
+
+    @classmethod
+    def _projected_names(cls, fields):
+        """ Map the property names of a projection to the names they are stored under
+        """
+        names = set()
+        for field in fields:
+            if field == 'id':
+                continue
+            attr = getattr(cls, field, None)
+            if not isinstance(attr, Property):
+                attr = cls._meta.get(field)
+            if attr is None:
+                raise ValueError("%s is not a property of %s" % (field, cls.__name__))
+            names.add(attr._name)
+        return frozenset(names)
+
+    @classmethod
+    def _stored_name(cls, name):
+        """ The name a property is stored under, given its attribute or stored name
+        """
+        attr = getattr(cls, name, None)
+        if isinstance(attr, Property):
+            return attr._name
+        if name == 'id' or name in cls._meta:
+            return name
+        raise ValueError("%s is not a property of %s" % (name, cls.__name__))
+
+    @classmethod
+    def _indexed(cls, name):
+        """ True if name is the primary key or a property with a simple index of its name
+        """
+        return name == 'id' or (name in cls._meta and cls._meta[name]._indexed)
+
+    @classmethod
+    def _order_key(cls, index):
+        """ The (field, descending) that an order_by index sorts on, None for indexes
+        that aren't a property of the same name
+        """
+        descending = False
+        if isinstance(index, (Asc, Desc)):
+            descending = isinstance(index, Desc)
+            index = getattr(index.args[0], 'data', None)
+        if isinstance(index, basestring) and cls._indexed(index) and not cls._is_repeated(index):
+            return index, descending
+        return None
+
+    @classmethod
+    def _is_repeated(cls, name):
+        return name in cls._meta and cls._meta[name]._repeated
+
+    @classmethod
+    def _filter(cls, rq, terms):
+        """ Filter rq by a dict of terms. A single value for a repeated property
+        matches the documents whose list contains it, a (start, end) tuple the values
+        from start up to but not including end, either of them None for no bound.
+        """
+        plain = {}
+        members = []
+        ranges = []
+        for name, value in terms.iteritems():
+            if isinstance(value, tuple):
+                ranges.append((name, value))
+            elif cls._is_repeated(name) and isinstance(value, _KEY_TYPES):
+                members.append((name, value))
+            else:
+                plain[name] = value
+        if plain:
+            rq = rq.filter(plain)
+        for name, value in sorted(members):
+            rq = rq.filter(row[name].contains(value))
+        for name, (start, end) in sorted(ranges):
+            if start is not None:
+                rq = rq.filter(row[name] >= _utc(start))
+            if end is not None:
+                rq = rq.filter(row[name] < _utc(end))
+        return rq
+
+    @classmethod
+    def _plan_query(cls, predicate=None, order_by=None, use_index=True, read_mode=None):
+        """ Build the query for a predicate and an order. An equality term on the
+        primary key or an indexed property runs as get_all() on its index, with the
+        other terms as a filter() and the order sorting what get_all() returned. A
+        (start, end) range term on one runs as between() when the order, if any, is
+        on the same index. Otherwise the table is read in index order or scanned, and
+        filtered. A term on a repeated property is a membership test, on its multi
+        index if it has one.
+
+        :param use_index: False to always filter, e.g. for changefeeds
+        :param read_mode: see query()
+        :return the query, and a dict describing the path taken, see explain()
+        """
+        rq = cls.query(read_mode)
+        plan = {'path': 'scan', 'index': None, 'filter': None, 'order_by': None}
+        index = span = None
+        if use_index and isinstance(predicate, dict):
+            keys = sorted(name for name, value in predicate.iteritems()
+                          if cls._indexed(name) and isinstance(value, _KEY_TYPES))
+            order = cls._order_key(order_by.get('index')) if order_by else None
+            if keys and (order is not None or not order_by):
+                index = 'id' if 'id' in keys else keys[0]
+            elif not keys:
+                spans = sorted(name for name, value in predicate.iteritems()
+                               if isinstance(value, tuple) and cls._indexed(name) and not cls._is_repeated(name))
+                if order_by and order is not None and order[0] in spans:
+                    span = order[0]
+                elif spans and not order_by:
+                    span = spans[0]
+
+        if span is not None:
+            start, end = predicate[span]
+            rq = rq.between(_utc(start), _utc(end), index=span)
+            plan.update(path='between', index=span)
+            rest = dict((name, value) for name, value in predicate.iteritems() if name != span)
+            if rest:
+                rq = cls._filter(rq, rest)
+                plan['filter'] = sorted(rest)
+            if order_by:
+                rq = rq.order_by(index=desc(span) if order[1] else span)
+                plan['order_by'] = span
+            return rq, plan
+
+        if index is not None:
+            rq = rq.get_all(predicate[index], index=index)
+            plan.update(path='get_all', index=index)
+            rest = dict((name, value) for name, value in predicate.iteritems() if name != index)
+            if rest:
+                rq = cls._filter(rq, rest)
+                plan['filter'] = sorted(rest)
+            if order_by and order[0] != index:
+                rq = rq.order_by(desc(order[0]) if order[1] else order[0])
+                plan['order_by'] = order[0]
+            return rq, plan
+
+        if order_by:
+            rq = rq.order_by(**order_by)
+            plan.update(path='order_by', order_by=order_by.get('index'))
+            if isinstance(plan['order_by'], RqlQuery):
+                plan['order_by'] = str(plan['order_by'])
+        if isinstance(predicate, dict):
+            rq = cls._filter(rq, predicate)
+            plan['filter'] = sorted(predicate) or None
+        elif predicate:
+            rq = rq.filter(predicate)
+            plan['filter'] = 'function'
+        return rq, plan
+
+    @classmethod
+    def _build_query(cls, predicate=None, order_by=None, use_index=True, read_mode=None):
+        return cls._plan_query(predicate, order_by, use_index, read_mode)[0]
+
+    @classmethod
+    def explain(cls, predicate=None, order_by=None):
+        """ Describe how all() would run a predicate and order, without running it:
+
+            >>> Contact.explain({'last_name': 'Smith', 'age': 30})
+            {'path': 'get_all', 'index': 'last_name', 'filter': ['age'], 'order_by': None, 'query': "r.table..."}
+
+        path is 'get_all' when an index narrows the documents read, 'between' when an
+        index range does, 'order_by' when the table is read in index order and 'scan'
+        when every document is read.
+        """
+        rq, plan = cls._plan_query(predicate, order_by)
+        plan['query'] = str(rq)
+        return plan
+
+    @classmethod
+    def count(cls, predicate=None, read_mode=None):
+        """ Count the documents that match predicate on the server, through an index
+        when the predicate has an equality term on one, see explain(). A partitioned
+        model counts in the partitions the predicate can touch concurrently.
+        """
+        if cls._partition_by is not None:
+            return sum(_fan_out([(model.count, (predicate, read_mode)) for model in cls._partitions_for(predicate)]))
+        return cls._run_cached('count', cls._build_query(predicate, read_mode=read_mode).count(),
+                               nearest=cls._outdated(read_mode))
+
+    @classmethod
+    def aggregate(cls, group_by=None, predicate=None, sum=None, avg=None, min=None, max=None):
+        """ Count and total the documents that match predicate on the server, in one
+        round trip. sum, avg, min and max each take a property name or a list of them:
+
+            >>> Order.aggregate(sum='total', max=['total', 'created'])
+            {'count': 120, 'sum': {'total': 5230.5}, 'max': {'total': 310.0, 'created': datetime(...)}}
+            >>> Order.aggregate(group_by='status', sum='total')
+            {'open': {'count': 20, 'sum': {'total': 830.0}}, 'paid': {'count': 100, 'sum': {'total': 4400.5}}}
+
+        avg, min and max are None when no document has the property. Groups are read
+        from the index of group_by when there is no predicate and it has one.
+
+        :param group_by: property name to total the documents by
+        :param predicate: a dictionary of filter terms {'attribute': 'val'}
+        :return dict of the totals, or of the totals per group_by value
+        """
+        cls._check_unpartitioned('aggregate')
+        rq = cls._build_query(predicate)
+        if group_by is not None:
+            group = cls._stored_name(group_by)
+            if predicate is None and group != 'id' and cls._indexed(group):
+                rq = rq.group(index=group)
+            else:
+                rq = rq.group(group)
+
+        terms = {'count': rq.count()}
+        for operation, names in (('sum', sum), ('avg', avg), ('min', min), ('max', max)):
+            if names is None:
+                continue
+            if isinstance(names, basestring):
+                names = [names]
+            terms[operation] = {}
+            for name in names:
+                term = getattr(rq[cls._stored_name(name)], operation)()
+                if group_by is None and operation != 'sum':
+                    term = term.default(None)  # an empty stream has no average, min or max
+                terms[operation][name] = term
+
+        if group_by is None:
+            return cls._run('aggregate', expr(terms))
+
+        for operation, term in terms.items():
+            if operation == 'count':
+                terms[operation] = term.ungroup()
+            else:
+                terms[operation] = dict((name, t.ungroup()) for name, t in term.iteritems())
+        result = cls._run('aggregate', expr(terms))
+
+        groups = {}
+        key = lambda group: tuple(group) if isinstance(group, list) else group
+        for row in result.pop('count'):
+            groups[key(row['group'])] = {'count': row['reduction']}
+        for operation, totals in result.iteritems():
+            for name, rows in totals.iteritems():
+                for row in rows:
+                    groups[key(row['group'])].setdefault(operation, {})[name] = row['reduction']
+        return groups
+
+    @classmethod
+    def find(cls, predicate=None, **terms):
+        """ Start a Query, terms are property names and the values they must equal:
+
+            Contact.find(last_name='Smith').order('first_name').fetch(20)
+        """
+        return Query(cls).filter(predicate, **terms)
 
     @classmethod
-    def all(cls, predicate=None, order_by=None, page=None, page_size=None):
+    def all(cls, predicate=None, order_by=None, page=None, page_size=None, fields=None, read_mode=None, prefetch=None):
         """ Wrap REQL into one function and return generator that serializes
         each result into an instance of the class.
 
         :param predicate: a dictionary of filter terms {'attribute': 'val'}
         :param order_by: a dictionary of order terms {'index': rdb.desc('created')}
+        :param fields: only fetch these properties, see get_by_id
+        :param read_mode: 'outdated' to read from the nearest replica, see query()
+        :param prefetch: names of ReferenceProperty properties to load the entities of,
+            with one query per referenced model. The entities are then a list.
         :return generator, more (bool)
         """
-        rq = cls.query()
-        if order_by:
-            rq = rq.order_by(**order_by)
-        if predicate:
-            rq = rq.filter(predicate)
+        if cls._partition_by is not None:
+            return cls._all_partitions(predicate, order_by, page, page_size, fields, read_mode, prefetch)
+        rq = cls._build_query(predicate, order_by, read_mode=read_mode)
         if page is not None and page_size:
             rq = rq.skip(page * page_size).limit(page_size+1)
+        projection = None
+        if fields is not None:
+            projection = cls._projected_names(fields)
+            rq = rq.pluck('id', *projection)
 
-        with cls._get_connection() as conn:
-            results = list(rq.run(conn))
+        results = cls._run_cached('all', rq, fetch=True, nearest=cls._outdated(read_mode))
         c = len(results)
-        return cls._deserializer(results[:min(c, page_size)]), c > page_size
+        entities = cls._deserializer(results[:min(c, page_size)], projection)
+        if prefetch:
+            entities = list(entities)
+            cls._prefetch(entities, prefetch)
+        return entities, c > page_size
+
+    @classmethod
+    def _merge_key(cls, order_by):
+        """ The sort key of entities for an order_by, None without one
+        """
+        if not order_by:
+            return None
+        order = cls._order_key(order_by.get('index'))
+        if order is None:
+            raise ValueError("Can't merge the partitions of %s in the order of %r" % (cls.__name__, order_by))
+        name, descending = order
+
+        def key(entity):
+            value = entity.id if name == 'id' else entity._values.get(name)
+            value = (value is not None, value)  # None sorts first, without comparing it to a datetime
+            return _Descending(value) if descending else value
+        return key
 
     @classmethod
-    def get_by_id(cls, id):
+    def _all_partitions(cls, predicate, order_by, page, page_size, fields, read_mode, prefetch):
+        """ all() for a partitioned model. The partitions the predicate can touch are
+        queried concurrently, each for its first (page + 1) * page_size entities, and
+        their ordered results are merged before the page is cut. Without an order
+        the partitions follow each other, oldest first.
+        """
+        key = cls._merge_key(order_by)
+        size = (page + 1) * page_size if page is not None and page_size else None
+
+        def fetch(model):
+            entities, more = model.all(predicate, order_by, 0 if size else None, size, fields, read_mode)
+            return list(entities), more
+
+        results = _fan_out([(fetch, (model,)) for model in cls._partitions_for(predicate)])
+        streams = [entities for entities, more in results]
+        entities = list(itertools.chain(*streams) if key is None else _merge(streams, key))
+        more = False
+        if size:
+            more = len(entities) > size or True in [more for unused, more in results]
+            entities = entities[page * page_size:size]
+        if prefetch:
+            cls._prefetch(entities, prefetch)
+        return entities, more
+
+    @classmethod
+    def iter(cls, predicate=None, order_by=None, limit=None, fields=None, read_mode=None):
+        """ Generator that yields entities as the driver cursor delivers each batch.
+        Unlike all() the results are never collected into a list, so memory stays
+        flat however large the table is. A pooled connection is held until the
+        generator is exhausted or closed.
+
+        :param predicate: a dictionary of filter terms {'attribute': 'val'}
+        :param order_by: a dictionary of order terms {'index': rdb.desc('created')}
+        :param limit: maximum number of entities
+        :param fields: only fetch these properties, see get_by_id
+        :param read_mode: 'outdated' to read from the nearest replica, see query()
+        """
+        if cls._partition_by is not None:
+            for entity in cls._iter_partitions(predicate, order_by, limit, fields, read_mode):
+                yield entity
+            return
+        rq = cls._build_query(predicate, order_by, read_mode=read_mode)
+        if limit:
+            rq = rq.limit(limit)
+        projection = None
+        if fields is not None:
+            projection = cls._projected_names(fields)
+            rq = rq.pluck('id', *projection)
+
+        with cls._get_connection(cls._outdated(read_mode)) as conn:
+            cursor = _run_query(cls, 'iter', rq, conn=conn)
+            try:
+                for result in cursor:
+                    yield cls._from_db(result, projection)
+            finally:
+                if hasattr(cursor, 'close'):
+                    cursor.close()
+
+    @classmethod
+    def _iter_partitions(cls, predicate, order_by, limit, fields, read_mode):
+        """ iter() for a partitioned model. Without an order the partitions are read
+        one after the other, oldest first. With one each partition is read in pages
+        of _batch_size with all(), which holds a pooled connection only while a page
+        is fetched, and the pages are merged in order.
+        """
+        key = cls._merge_key(order_by)
+        models = cls._partitions_for(predicate)
+        if key is None:
+            streams = [model.iter(predicate, order_by, limit, fields, read_mode) for model in models]
+        else:
+            size = min(limit, cls._batch_size) if limit else cls._batch_size
+
+            def pages(model):
+                page = 0
+                while True:
+                    entities, more = model.all(predicate, order_by, page, size, fields, read_mode)
+                    for entity in entities:
+                        yield entity
+                    if not more:
+                        return
+                    page += 1
+            streams = [pages(model) for model in models]
+        try:
+            entities = itertools.chain(*streams) if key is None else _merge(streams, key)
+            for entity in itertools.islice(entities, limit or None):
+                yield entity
+        finally:
+            for stream in streams:
+                stream.close()
+
+    @classmethod
+    def fetch_page(cls, page_size, index='id', cursor=None, descending=False, predicate=None, fields=None):
+        """ Keyset pagination along an index. Each page continues from the index value
+        of the last entity of the previous page with between(), so deep pages cost the
+        same as the first one, where all() has to skip() over every earlier page.
+
+        Entities that share an index value are ordered by id, the token remembers both
+        so no entity is skipped or repeated at a page boundary.
+
+        :param page_size: number of entities per page
+        :param index: 'id' or the stored name of an indexed property
+        :param cursor: token returned with the previous page, None for the first page
+        :param descending: walk the index from the highest value down
+        :param predicate: a dictionary of filter terms applied within the index range
+        :param fields: only fetch these properties, see get_by_id. The index is always fetched
+        :return list of entities, cursor for the next page or None, more (bool)
+        """
+        cls._check_unpartitioned('fetch_page')
+        if index != 'id' and (index not in cls._meta or not cls._meta[index]._indexed):
+            raise ValueError("%s is not an indexed property of %s" % (index, cls.__name__))
+
+        rq = cls.query()
+        if cursor is not None:
+            last_value, last_id = _decode_cursor(cursor)
+            bound = 'open' if index == 'id' else 'closed'
+            if descending:
+                rq = rq.between(None, last_value, index=index, right_bound=bound)
+            else:
+                rq = rq.between(last_value, None, index=index, left_bound=bound)
+        rq = rq.order_by(index=desc(index) if descending else index)
+        if cursor is not None and index != 'id':
+            # skip the entities with the last value that the previous page already returned
+            if descending:
+                rq = rq.filter(lambda doc: doc[index].ne(last_value) | (doc['id'] < last_id))
+            else:
+                rq = rq.filter(lambda doc: doc[index].ne(last_value) | (doc['id'] > last_id))
+        if predicate:
+            rq = rq.filter(predicate)
+        rq = rq.limit(page_size + 1)
+        projection = None
+        if fields is not None:
+            projection = cls._projected_names(fields) | {index} - {'id'}
+            rq = rq.pluck('id', *projection)
+
+        results = cls._run('fetch_page', rq, fetch=True)
+        more = len(results) > page_size
+        entities = [cls._from_db(result, projection) for result in results[:page_size]]
+        next_cursor = None
+        if more:
+            last = entities[-1]
+            value = last.id if index == 'id' else last._values.get(index)
+            next_cursor = _encode_cursor([value, last.id])
+        return entities, next_cursor, more
+
+    @classmethod
+    def get_by_id(cls, id, fields=None):
+        """ Fetch one entity by id, from the caches when it is in one.
+
+        Pass fields to only fetch those properties. The entity that comes back is
+        partial: reading a property that wasn't fetched raises
+        UnprojectedPropertyError, and put() only sends the properties that were set
+        since, so the others are left as they are in the database. Partial entities
+        bypass the caches.
+
+        A partitioned model looks in the partition an id generated by put() names,
+        and in every partition for other ids.
+
+        :param id: the document id
+        :param fields: list of property names
+        """
         if not id:
             return None
 
-        with cls._get_connection() as conn:
-            result = cls.query().get(id).run(conn)
+        if cls._partition_by is not None:
+            calls = [(model.get_by_id, (id, fields)) for model in cls._partitions_of_ids([id])]
+            found = [entity for entity in _fan_out(calls) if entity is not None]
+            return found[0] if found else None
+
+        if fields is not None:
+            projection = cls._projected_names(fields)
+            results = cls._run('get_by_id', cls.query().get_all(id).pluck('id', *projection), fetch=True,
+                               nearest=cls._outdated())
+            return cls._from_db(results[0], projection) if results else None
+
+        entity = cls._cache_get(id)
+        if entity is not None:
+            return entity
+
+        result = cls._run('get_by_id', cls.query().get(id), nearest=cls._outdated())
         if result:
-            result = cls._from_db(result)
+            doc = result
+            result = cls._from_db(doc)
+            cls._cache_set(result, doc)
         return result
 
     @classmethod
     def delete(cls, id):
         if not id:
             return None
-        with cls._get_connection() as conn:
-            return cls.query().get(id).delete().run(conn)
-
-    @classmethod
-    def _from_db(cls, db_dict):
-        entity = cls()
-        entity.id = db_dict.pop('id')
-        for name, value in db_dict.iteritems():
-            attr = cls._meta.get(name)
-            if not attr:
-                # maybe it was removed during class refactor, or
-                # added via some other means.
-                attr = ObjectProperty()
-                attr._set_name(name)
-                cls._meta[name] = attr
-            attr._do_from_db(entity, value)
+        if get_batch() is not None:
+            get_batch().delete(cls, id)
+            return None
+        if cls._partition_by is not None:
+            return cls.delete_multi([id])
+        result = cls._run('delete', table(cls._table_name()).get(id).delete())
+        cls._cache_invalidate(id)
+        return result
+
+    @classmethod
+    def get_multi(cls, ids, batch_size=None, prefetch=None):
+        """ Fetch many documents with one get_all round trip per batch.
+
+        :param ids: list of ids
+        :param batch_size: number of ids per query, defaults to _batch_size
+        :param prefetch: names of ReferenceProperty properties to load the entities of, see all()
+        :return list of entities in the same order as ids, None where there is no document
+        """
+        if cls._partition_by is not None:
+            groups = cls._partitions_of_ids(ids)
+            found = {}
+            results = _fan_out([(model.get_multi, (keys, batch_size)) for model, keys in groups.iteritems()])
+            for keys, entities in zip(groups.itervalues(), results):
+                found.update((id, entity) for id, entity in zip(keys, entities) if entity is not None)
+            entities = [found.get(id) if id else None for id in ids]
+            if prefetch:
+                cls._prefetch([entity for entity in entities if entity is not None], prefetch)
+            return entities
+
+        cached = {}
+        for id in ids:
+            if id and id not in cached:
+                entity = cls._cache_get(id)
+                if entity is not None:
+                    cached[id] = entity
+
+        found = {}
+        keys = [id for id in set(ids) if id and id not in cached]
+        for chunk in utils.chunks(keys, batch_size or cls._batch_size):
+            for result in cls._run('get_multi', cls.query().get_all(*chunk), fetch=True, nearest=cls._outdated()):
+                entity = cls._from_db(result)
+                cls._cache_set(entity, result)
+                found[result['id']] = entity
+
+        found.update(cached)
+        entities = [found.get(id) if id else None for id in ids]
+        if prefetch:
+            cls._prefetch([entity for entity in entities if entity is not None], prefetch)
+        return entities
+
+    @classmethod
+    def _prefetch(cls, entities, names):
+        """ Replace the ids held by the reference properties names of entities with the
+        entities they refer to, fetched with one get_multi per referenced model
+        """
+        targets = collections.OrderedDict()  # model -> stored names of the properties referring to it
+        for name in names:
+            attr = cls._meta.get(cls._stored_name(name))
+            if not isinstance(attr, ReferenceProperty):
+                raise ValueError("%s is not a ReferenceProperty of %s" % (name, cls.__name__))
+            targets.setdefault(attr._target(), []).append(attr._name)
+
+        for model, stored_names in targets.iteritems():
+            ids = set()
+            for entity in entities:
+                values = entity._values
+                for name in stored_names:
+                    value = values.get(name)
+                    for item in (value if isinstance(value, list) else [value]):
+                        if isinstance(item, _KEY_TYPES):
+                            ids.add(item)
+            if not ids:
+                continue
+            ids = list(ids)
+            loaded = dict((id, found) for id, found in zip(ids, model.get_multi(ids)) if found is not None)
+            for entity in entities:
+                values = entity._values
+                for name in stored_names:
+                    value = values.get(name)
+                    if isinstance(value, list):
+                        value[:] = [loaded.get(item, item) if isinstance(item, _KEY_TYPES) else item for item in value]
+                    elif isinstance(value, _KEY_TYPES):
+                        values[name] = loaded[value] if value in loaded else _MissingReference(value)
+
+    @classmethod
+    def put_multi(cls, entities, batch_size=None):
+        """ Store many entities with one insert round trip per batch. Entities without
+        an id are given a uuid4 before they are sent, like the server would. Entities
+        loaded from the database send the properties that were modified, like put(),
+        with one round trip of update() queries per batch, and none when unmodified.
+
+        Entities that fail validation are not sent. Batches are not atomic, so when
+        BatchError is raised every entity without an error in its errors list has been
+        stored. The server only reports the first failure of an insert, the documents
+        of a batch with errors are sent again one at a time, see _insert_chunk().
+
+        :param entities: list of entities of this model
+        :param batch_size: number of documents per insert, defaults to _batch_size
+        :return list of ids in the same order as entities
+        """
+        if cls._partition_by is not None:
+            return cls._put_partitions(entities, batch_size)
+        errors = [None] * len(entities)
+        pending = []
+        updates = []
+        for i, entity in enumerate(entities):
+            try:
+                if cls._partition_of is not None:
+                    entity._check_period(cls._partition_of, cls._partition_suffix)
+                if entity._dirty is not None and entity.id:
+                    if entity._dirty:
+                        updates.append((i, entity, entity._changes()))
+                    continue
+                doc = entity._to_db()
+            except (ValueError, TypeError) as e:
+                errors[i] = e
+                continue
+            if not entity.id:
+                entity.id = doc['id'] = str(uuid.uuid4())
+            pending.append((i, entity, doc))
+
+        for chunk in utils.chunks(updates, batch_size or cls._batch_size):
+            results = cls._run('put_multi', expr([table(cls._table_name()).get(entity.id).update(changes)
+                                                  for i, entity, changes in chunk]))
+            for (i, entity, changes), result in zip(chunk, results):
+                if result.get('errors'):
+                    errors[i] = result.get('first_error')
+                elif not result.get('skipped'):
+                    entity._dirty = set()
+                    cls._cache_invalidate(entity.id, entity)
+                elif entity._projection is not None:
+                    errors[i] = UnprojectedPropertyError('%s %s was deleted, a partial entity can\'t store all of it '
+                                                         'again' % (type(entity).__name__, entity.id))
+                else:
+                    try:  # the document was deleted since it was loaded, store all of it again
+                        pending.append((i, entity, entity._to_db()))
+                    except (ValueError, TypeError) as e:
+                        errors[i] = e
+
+        for chunk in utils.chunks(pending, batch_size or cls._batch_size):
+            for (i, entity, doc), error in zip(chunk, cls._insert_chunk([doc for i, entity, doc in chunk])):
+                if error is None:
+                    entity._dirty = set()
+                else:
+                    errors[i] = error
+                cls._cache_invalidate(entity.id, entity)
+
+        failed = len(errors) - errors.count(None)
+        if failed:
+            raise BatchError('%d of %d entities were not stored' % (failed, len(entities)), errors)
+        return [entity.id for entity in entities]
+
+    @classmethod
+    def _insert_chunk(cls, docs):
+        """ Insert docs, which all have ids, and find the ones that failed. The server
+        only reports the first error of an insert, so when there were errors each doc
+        is sent again on its own to tell which. A doc the chunk stored is unchanged
+        the second time, its id was assigned before the first attempt.
+
+        :return list of the error message of each doc, None for those stored
+        """
+        result = cls._run('put_multi', table(cls._table_name()).insert(docs, conflict="update"))
+        if not result.get('errors'):
+            return [None] * len(docs)
+        errors = []
+        for doc in docs:
+            single = cls._run('put_multi', table(cls._table_name()).insert(doc, conflict="update"))
+            errors.append(single.get('first_error') if single.get('errors') else None)
+        return errors
+
+    @classmethod
+    def _put_partitions(cls, entities, batch_size):
+        """ put_multi() for a partitioned model, one put_multi() per partition run
+        concurrently
+        """
+        errors = [None] * len(entities)
+        groups = collections.OrderedDict()
+        for i, entity in enumerate(entities):
+            try:
+                groups.setdefault(entity._partition_for_put(), []).append(i)
+            except (ValueError, TypeError) as e:
+                errors[i] = e
+
+        futures = _concurrently([(model.put_multi, ([entities[i] for i in positions], batch_size))
+                                 for model, positions in groups.iteritems()])
+        for positions, future in zip(groups.itervalues(), futures):
+            e = future.get_exception()
+            if e is not None:
+                per_entity = e.errors if isinstance(e, BatchError) else [e] * len(positions)
+                for i, error in zip(positions, per_entity):
+                    errors[i] = error
+
+        failed = len(errors) - errors.count(None)
+        if failed:
+            raise BatchError('%d of %d entities were not stored' % (failed, len(entities)), errors)
+        return [entity.id for entity in entities]
+
+    @classmethod
+    def _delete_batches(cls, ids, batch_size):
+        """ Delete ids in batches. The server only reports the first error of a delete,
+        so the ids of a batch with errors are deleted again one at a time to tell which
+        failed.
+
+        :return list of the server result of each batch, dict of the error of each id that failed
+        """
+        results, failed = [], {}
+        keys = [id for id in ids if id]
+        for chunk in utils.chunks(keys, batch_size or cls._batch_size):
+            result = cls._run('delete_multi', table(cls._table_name()).get_all(*chunk).delete())
+            if result.get('errors'):
+                result = dict(result, errors=0, first_error=None)
+                for id in chunk:
+                    single = cls._run('delete_multi', table(cls._table_name()).get(id).delete())
+                    result['deleted'] = result.get('deleted', 0) + single.get('deleted', 0)
+                    if single.get('errors'):
+                        result['errors'] += single['errors']
+                        result['first_error'] = result['first_error'] or single.get('first_error')
+                        failed[id] = single.get('first_error')
+            for id in chunk:
+                cls._cache_invalidate(id)
+            results.append(result)
+        return results, failed
+
+    @classmethod
+    def delete_multi(cls, ids, batch_size=None):
+        """ Delete many documents with one get_all().delete() round trip per batch.
+
+        :param ids: list of ids
+        :param batch_size: number of ids per query, defaults to _batch_size
+        :return the server results summed over all batches
+        :raises BatchError: when some ids failed, its errors follow the order of ids
+            with None for those that were deleted
+        """
+        if cls._partition_by is not None:
+            futures = _concurrently([(model._delete_batches, (keys, batch_size))
+                                     for model, keys in cls._partitions_of_ids(ids).iteritems()])
+            results, failed = [], {}
+            for future in futures:
+                partition_results, partition_failed = future.get_result()
+                results.extend(partition_results)
+                failed.update(partition_failed)
+        else:
+            results, failed = cls._delete_batches(ids, batch_size)
+        totals = {}
+        for result in results:
+            for name, value in result.iteritems():
+                if isinstance(value, (int, long, float)):
+                    totals[name] = totals.get(name, 0) + value
+                elif value is not None:
+                    totals.setdefault(name, value)
+
+        if failed:
+            raise BatchError(dumps(totals), [failed.get(id) if id else None for id in ids])
+        return totals
+
+    @classmethod
+    def _from_db(cls, db_dict, projection=None):
+        """ Make an entity of a document from the driver without running __init__.
+        The document becomes the entity's values, and is decoded as properties are
+        read, see _LazyValues. Compact models decode it into their slots right away.
+        """
+        if not cls._known_names.issuperset(db_dict):
+            for name in db_dict:
+                if name not in cls._known_names:
+                    # maybe it was removed during class refactor, or
+                    # added via some other means.
+                    attr = ObjectProperty()
+                    attr._set_name(name)
+                    cls._meta[name] = attr
+                    cls._compile_properties()
+
+        entity = cls.__new__(cls)
+        entity.id = db_dict.get('id')
+        lazy = cls._lazy_decoders
+        pending = [name for name in lazy if name in db_dict] if lazy else None
+        if cls._values_type is not dict:
+            if pending:
+                db_dict = dict(db_dict)
+                for name in pending:
+                    db_dict[name] = lazy[name](db_dict[name])
+            entity._values = cls._values_type._from_dict(db_dict)
+        elif pending:
+            entity._values = _LazyValues(db_dict, set(pending), lazy)
+        else:
+            entity._values = db_dict
+        entity._dirty = set()
+        entity._projection = None if projection is None else set(projection)
         return entity
 
     def to_dict(self):
         _doc = {}
-        for name, attr in self._meta.iteritems():
-            if hasattr(self, attr._attr_name):
-                _doc[attr._attr_name] = getattr(self, attr._attr_name)
+        values = self._values
+        if self._dirty is not None:
+            self._dirty.update(self._mutable_names)  # the caller may change them in place
+        projection = self._projection
+        for name, attr in self._computed:
+            if name not in values and (projection is None or name in projection):
+                attr.__get__(self)
+        for attr_name, name, default in self._fields:
+            if projection is None or name in projection:
+                _doc[attr_name] = values.get(name, default)
+        for attr_name, attr in self._references:
+            if _doc.get(attr_name) is not None:
+                _doc[attr_name] = attr._ids(_doc[attr_name])
 
         if self.id:
             _doc['id'] = self.id
@@ -482,21 +2626,472 @@ class Model(object):
         db_doc = {}
 
         # Validate any defined fields and set any defaults
-        for name, attr in self._meta.iteritems():
-            db_doc[name] = attr._do_to_db(self)
+        values = self._values
+        projection = self._projection
+        if self._computed:
+            self._update_computed(projection)
+        for name, default, encode in self._encoders:
+            if projection is None or name in projection:
+                db_doc[name] = encode(values.get(name, default))
 
         if self.id:
             db_doc['id'] = self.id
 
         return db_doc
 
+    def _forget_computed(self):
+        """ Drop the computed values, an input of theirs may have changed
+        """
+        values = self._values
+        for name, attr in self._computed:
+            if name in values:
+                del values[name]
+
+    def _update_computed(self, projection=None):
+        """ Compute the computed properties again for storage. Those whose inputs
+        a projection didn't load are left as they are.
+
+        :return the names of the properties that were computed
+        """
+        computed = {}
+        for name, attr in self._computed:
+            if projection is None or name in projection:
+                try:
+                    computed[name] = attr._compute(self)
+                except UnprojectedPropertyError:
+                    pass
+        # set them once all are computed, reading mutable inputs forgets them
+        for name, value in computed.iteritems():
+            self._values[name] = value
+        return computed.keys()
+
+    def _changes(self):
+        """ The validated db values of the properties modified since the entity was
+        loaded, plus auto_now properties. Objects are sent as literals so update()
+        replaces them rather than merging them into the stored value.
+        """
+        changed = self._dirty.union(self._auto_now_names)
+        if self._computed:
+            changed.update(self._update_computed())
+        db_doc = {}
+        values = self._values
+        for name, default, encode in self._encoders:
+            if name in changed:
+                value = encode(values.get(name, default))
+                db_doc[name] = literal(value) if isinstance(value, dict) else value
+        return db_doc
+
     def put(self):
-        """ Serialize this document to JSON and put it in the database
+        """ Serialize this document to JSON and put it in the database. Entities that
+        were loaded from the database only send the properties that were modified,
+        and make no round trip at all when nothing was. An entity of a partitioned
+        model is stored in the partition of its partition property.
         """
-        with self._get_connection() as conn:
-            result = table(self._table_name()).insert(self._to_db(), conflict="update").run(conn)
+        if self._dirty is not None and self.id:
+            if not self._dirty:
+                return {'inserted': 0, 'replaced': 0, 'unchanged': 1, 'errors': 0, 'skipped': 0, 'deleted': 0}
+        if get_batch() is not None:
+            get_batch().put(self)
+            return None
+        model = self._partition_for_put()
+        if self._dirty is not None and self.id:
+            result = model._run('put', table(model._table_name()).get(self.id).update(self._changes()))
+            if result.get('errors'):
+                raise IOError(dumps(result))
+            if not result.get('skipped'):
+                self._dirty = set()
+                model._cache_invalidate(self.id, self)
+                return result
+            if self._projection is not None:
+                raise UnprojectedPropertyError('%s %s was deleted, a partial entity can\'t store all of it again' % (
+                    type(self).__name__, self.id))
+            # the document was deleted since it was loaded, store all of it again
+
+        result = model._run('put', table(model._table_name()).insert(self._to_db(), conflict="update"))
         if 'errors' in result and result['errors'] > 0:
             raise IOError(dumps(result))
         elif result['inserted'] == 1.0:
             self.id = result.get('generated_keys', [self.id])[0]
-        return result
\ No newline at end of file
+        self._dirty = set()
+        model._cache_invalidate(self.id, self)
+        return result
+
+    @classmethod
+    def watch(cls, predicate=None, include_initial=True):
+        """ Follow the changes to the documents that match predicate, see ChangeFeed
+
+        :param predicate: a dictionary of filter terms {'attribute': 'val'}
+        :param include_initial: start with the documents that already match
+        :return ChangeFeed of (old entity, new entity) pairs
+        """
+        cls._check_unpartitioned('watch')
+        return ChangeFeed(cls, predicate, include_initial)
+
+    @classmethod
+    def mirror(cls, predicate=None):
+        """ A local copy of the documents that match predicate, see Mirror
+        """
+        cls._check_unpartitioned('mirror')
+        return Mirror(cls, predicate)
+
+    # Futures for the blocking calls above, see tasklets. Validation errors of
+    # put_async are raised by get_result() like any other error.
+
+    @classmethod
+    def get_by_id_async(cls, id, fields=None):
+        """ Like get_by_id(). Lookups without fields are sent by autobatcher, with the
+        others made within its window as one get_multi() per model, except on an
+        executor worker where they run right away.
+        """
+        if fields is None and id and autobatcher.enabled and not in_worker():
+            entity = cls._cache_get(id)
+            if entity is not None:
+                future = Future('%s.get' % cls.__name__)
+                future.set_result(entity)
+                return future
+            return autobatcher.get(cls, id)
+        return executor.submit(cls.get_by_id, id, fields=fields)
+
+    @classmethod
+    def get_multi_async(cls, ids, batch_size=None, prefetch=None):
+        return executor.submit(cls.get_multi, ids, batch_size, prefetch)
+
+    @classmethod
+    def all_async(cls, predicate=None, order_by=None, page=None, page_size=None, fields=None, read_mode=None,
+                  prefetch=None):
+        """ Like all(), the future's result is a list of entities and more (bool)
+        """
+        def fetch():
+            entities, more = cls.all(predicate, order_by, page, page_size, fields, read_mode, prefetch)
+            return list(entities), more
+        return executor.submit(fetch)
+
+    @classmethod
+    def delete_async(cls, id):
+        return executor.submit(cls.delete, id)
+
+    def put_async(self):
+        """ Like put(), the future's result is the entity's id. Puts are sent by
+        autobatcher, with the others made within its window as one put_multi() per
+        model. Partial entities and entities with nothing to store are not batched,
+        nor are puts made on an executor worker, which run right away.
+        """
+        if autobatcher.enabled and self._projection is None and not in_worker():
+            if self._dirty is not None and self.id and not self._dirty:
+                future = Future('%s.put' % type(self).__name__)
+                future.set_result(self.id)
+                return future
+            return autobatcher.put(self)
+        return executor.submit(self._put_id)
+
+    def _put_id(self):
+        self.put()
+        return self.id
+
+
+_batch_state = threading.local()
+
+
+def get_batch():
+    """ The Batch of the current thread, None outside of a batch() block
+    """
+    return getattr(_batch_state, 'batch', None)
+
+
+@contextmanager
+def batch():
+    """ Queue the put() and delete() calls of a block and send them when it ends:
+
+        with rdb.batch():
+            contact.put()
+            address.put()
+            Note.delete(note_id)
+
+    On exit the queue is flushed as one insert and one get_all().delete() per
+    table, see Batch.flush. Nothing is sent when the block raises. A batch()
+    block inside another one joins it.
+    """
+    current = get_batch()
+    if current is not None:
+        yield current
+        return
+    current = _batch_state.batch = Batch()
+    try:
+        yield current
+    finally:
+        _batch_state.batch = None
+    current.flush()
+
+
+class Batch(object):
+    """ The writes queued by a batch() block. put() returns None inside the block
+    and a new entity gets its id when the batch is flushed.
+
+    :ivar operations: the queued ('put', model, entity) and ('delete', model, id)
+        operations, in the order they were made
+    """
+
+    def __init__(self):
+        self.operations = []
+
+    def put(self, entity):
+        self.operations.append(('put', type(entity), entity))
+
+    def delete(self, model, id):
+        self.operations.append(('delete', model, id))
+
+    def _groups(self, operations):
+        """ Group the operations by model into the puts and the deletes to send. The
+        last operation on an id wins, so putting an entity and then deleting it
+        only deletes it.
+
+        :return list of (model, [(position, entity)], [(position, id)])
+        """
+        last = {}
+        for i, (op, model, target) in enumerate(operations):
+            key = target if op == 'delete' else target.id or target
+            last[model, key] = i
+
+        groups = collections.OrderedDict()
+        for i, (op, model, target) in enumerate(operations):
+            key = target if op == 'delete' else target.id or target
+            if last[model, key] != i:
+                continue
+            puts, deletes = groups.setdefault(model, ([], []))
+            (deletes if op == 'delete' else puts).append((i, target))
+        return [(model, puts, deletes) for model, (puts, deletes) in groups.iteritems()]
+
+    def flush(self):
+        """ Send the queued operations, the groups of different models concurrently
+        on the executor's workers. batch() calls it once, when its block ends.
+
+        :raises BatchError: when some failed, its errors follow the order of
+            operations with None for those that succeeded
+        """
+        operations = self.operations
+        jobs = []
+        for model, puts, deletes in self._groups(operations):
+            if puts:
+                jobs.append(([i for i, entity in puts], model.put_multi, [entity for i, entity in puts]))
+            if deletes:
+                jobs.append(([i for i, id in deletes], model.delete_multi, [id for i, id in deletes]))
+
+        futures = _concurrently([(method, (targets,)) for positions, method, targets in jobs])
+        exceptions = [future.get_exception() for future in futures]
+
+        errors = [None] * len(operations)
+        for (positions, method, targets), e in zip(jobs, exceptions):
+            if e is None:
+                continue
+            per_target = e.errors if isinstance(e, BatchError) else [e] * len(targets)
+            for i, error in zip(positions, per_target):
+                errors[i] = error
+
+        failed = [(operation, error) for operation, error in zip(operations, errors) if error is not None]
+        if failed:
+            details = '; '.join('%s %s %s: %s' % (op, model.__name__, target if op == 'delete' else target.id, error)
+                                for (op, model, target), error in failed[:5])
+            raise BatchError('%d of %d operations failed: %s%s' % (
+                len(failed), len(operations), details, '; ...' if len(failed) > 5 else ''), errors)
+
+
+class ChangeFeed(object):
+    """ Iterator of (old, new) entity pairs for the changes to a model's table, from
+    a changefeed on a connection of its own. old is None for inserts and new is None
+    for deletes. Every change drops the document from the caches of the model.
+
+    The feed is opened before the documents that already match are read, so no
+    change is lost in between, but one that raced the read can be seen twice.
+
+        for old, new in Contact.watch({'last_name': 'Smith'}):
+            ...
+
+    Close the feed when done with it, or use start() to follow it on a thread.
+    """
+
+    def __init__(self, model, predicate=None, include_initial=True):
+        self.model = model
+        self.predicate = predicate
+        self.ready = threading.Event()  # set once the initial documents were consumed
+        self.error = None
+        self._closed = False
+        self._thread = None
+
+        if SCHEMA['sync'] and model not in _synced and model._partition_of is None:
+            sync_all()
+        self._conn = connections.connect()
+        try:
+            self._cursor = model._build_query(predicate, use_index=False).changes().run(self._conn)
+        except Exception:
+            connections._close(self._conn)
+            raise
+        self._changes = self._iter(include_initial)
+
+    def _iter(self, include_initial):
+        if include_initial:
+            for entity in self.model.iter(self.predicate):
+                yield None, entity
+        self.ready.set()
+
+        for change in self._cursor:
+            old_val, new_val = change.get('old_val'), change.get('new_val')
+            old = self.model._from_db(old_val) if old_val is not None else None
+            new = self.model._from_db(new_val) if new_val is not None else None
+            self.model._cache_invalidate((new or old).id)
+            yield old, new
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._changes)
+        except (RqlDriverError, socket.error):
+            if self._closed:
+                raise StopIteration
+            raise
+
+    __next__ = next
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self, callback=None):
+        """ Follow the feed on a daemon thread, calling callback(old, new) for each
+        change. An exception stops the thread and is kept in error.
+        """
+        self._thread = threading.Thread(target=self._follow, args=(callback,), name='rethinkdb-rdb-feed')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _follow(self, callback):
+        try:
+            for old, new in self:
+                if callback is not None:
+                    callback(old, new)
+        except Exception as e:
+            self.error = e
+            logging.exception("Changefeed of %s stopped", self.model.__name__)
+        finally:
+            self.ready.set()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._cursor.close()
+        except Exception:
+            pass
+        connections._close(self._conn)
+
+
+class Mirror(ChangeFeed):
+    """ The documents of a model that match a predicate, loaded once and then kept
+    up to date by a ChangeFeed on a daemon thread:
+
+        smiths = Contact.mirror({'last_name': 'Smith'})
+        smiths.ready.wait()
+        smiths.get(id)
+
+    Entities in the mirror are replaced, never changed in place, and shouldn't be
+    modified by the caller.
+    """
+
+    def __init__(self, model, predicate=None):
+        super(Mirror, self).__init__(model, predicate, include_initial=True)
+        self.entities = {}
+        self.start(self._apply)
+
+    def _apply(self, old, new):
+        if new is None:
+            self.entities.pop(old.id, None)
+        else:
+            self.entities[new.id] = new
+
+    def get(self, id):
+        return self.entities.get(id)
+
+    def __contains__(self, id):
+        return id in self.entities
+
+    def __len__(self):
+        return len(self.entities)
+
+    def values(self):
+        return list(self.entities.values())
+
+
+class Query(object):
+    """ A query on a model built up one clause at a time. Each method returns a new
+    Query, so a partial query can be kept and reused. It runs like all(), using an
+    index for equality terms where there is one, see Model.explain().
+    """
+
+    def __init__(self, model, predicate=None, order_by=None, limit=None, fields=None, read_mode=None):
+        self.model = model
+        self.predicate = predicate
+        self.order_by = order_by
+        self._limit = limit
+        self.fields = fields
+        self._read_mode = read_mode
+
+    def _copy(self, **changes):
+        query = Query(self.model, self.predicate, self.order_by, self._limit, self.fields, self._read_mode)
+        query.__dict__.update(changes)
+        return query
+
+    def filter(self, predicate=None, **terms):
+        """ Add equality terms, by property name, or a dict of stored names. A
+        function or RQL predicate replaces the terms so far.
+        """
+        if predicate is not None and not isinstance(predicate, dict):
+            if terms or self.predicate:
+                raise ValueError("A function predicate can't be combined with other terms")
+            return self._copy(predicate=predicate)
+        merged = dict(self.predicate or {})
+        merged.update(predicate or {})
+        for name, value in terms.iteritems():
+            merged[self.model._stored_name(name)] = value
+        return self._copy(predicate=merged or None)
+
+    def order(self, name, descending=False):
+        """ Order by the index of a property
+        """
+        index = self.model._stored_name(name)
+        return self._copy(order_by={'index': desc(index) if descending else index})
+
+    def limit(self, count):
+        return self._copy(_limit=count)
+
+    def project(self, *fields):
+        """ Only fetch these properties, see Model.get_by_id
+        """
+        return self._copy(fields=list(fields))
+
+    def read_mode(self, read_mode):
+        """ 'outdated' to read from the nearest replica, see Model.query
+        """
+        self.model._outdated(read_mode)  # raises ValueError for unknown modes
+        return self._copy(_read_mode=read_mode)
+
+    def explain(self):
+        return self.model.explain(self.predicate, self.order_by)
+
+    def fetch(self, limit=None):
+        """ :return list of entities
+        """
+        return list(self.model.iter(self.predicate, self.order_by, limit or self._limit, self.fields, self._read_mode))
+
+    def get(self):
+        """ :return the first entity, or None
+        """
+        entities = self.fetch(1)
+        return entities[0] if entities else None
+
+    def __iter__(self):
+        return self.model.iter(self.predicate, self.order_by, self._limit, self.fields, self._read_mode)
\ No newline at end of file
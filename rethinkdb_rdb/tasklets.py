@@ -0,0 +1,331 @@
+""" Futures for the *_async model methods, in the style of NDB's tasklets.
+
+The driver only has blocking connections, so the queries of async calls run on
+a bounded pool of worker threads, each holding a pooled connection only for as
+long as its query runs. The caller gets a Future right away and can start more
+work before it collects the results:
+
+    f1 = Contact.get_by_id_async(id1)
+    f2 = Contact.get_by_id_async(id2)
+    a, b = f1.get_result(), f2.get_result()
+
+Size the executor like the connection pool, a worker without a connection to
+use just waits for one.
+
+The gets and puts of get_by_id_async() and put_async() go through autobatcher,
+which sends the ones made within a short window of each other together, as one
+get_multi() or put_multi() per model, and resolves each future from the result.
+"""
+import sys
+import time
+import Queue
+import threading
+
+from . import cache
+
+_state = threading.local()
+
+
+def in_worker():
+    """ True on the worker threads of an Executor. Code that runs there must not wait
+    on work it queues to the executor, the worker it holds may be the one the work
+    needs.
+    """
+    return getattr(_state, 'executor', None) is not None
+
+
+class Future(object):
+    """ The result of an operation that may not have finished yet
+    """
+
+    def __init__(self, info=None):
+        self.info = info
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        state = 'done' if self.done() else 'pending'
+        return '<%s %s %s>' % (type(self).__name__, self.info or '', state)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the result is available or timeout seconds have passed
+
+        :return True when the future is done
+        """
+        return self._done.wait(timeout)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception, tb=None):
+        self._exc_info = (type(exception), exception, tb)
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            if self._done.is_set():
+                raise RuntimeError('%r is already done' % self)
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+
+    def add_callback(self, callback, *args, **kwargs):
+        """ Call callback(*args, **kwargs) once the future is done, right away when
+        it already is. Callbacks run on the thread that completes the future.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, args, kwargs))
+                return
+        callback(*args, **kwargs)
+
+    def get_exception(self):
+        self.wait()
+        return self._exc_info[1] if self._exc_info else None
+
+    def check_success(self):
+        """ Wait for the future and raise its exception, if it has one
+        """
+        self.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def get_result(self):
+        """ Wait for the future and return its result, or raise its exception
+        """
+        self.check_success()
+        return self._result
+
+
+def wait_any(futures):
+    """ Block until one of the futures is done and return it, None when there are none
+    """
+    futures = list(futures)
+    if not futures:
+        return None
+    event = threading.Event()
+    for future in futures:
+        future.add_callback(event.set)
+    event.wait()
+    for future in futures:
+        if future.done():
+            return future
+
+
+def wait_all(futures):
+    """ Block until all the futures are done
+    """
+    for future in futures:
+        future.wait()
+
+
+class Executor(object):
+    """ Run functions on a bounded set of worker threads and return Futures for
+    their results. Workers are started as work arrives, and run each function in
+    the cache.context() of the thread that submitted it. Work submitted by one of
+    the workers runs right away on that worker, which could otherwise wait for a
+    result queued behind every other worker waiting the same way.
+    """
+
+    def __init__(self, max_workers=5):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def configure(self, max_workers):
+        with self._lock:
+            self.max_workers = max_workers
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func(*args, **kwargs) to run on a worker
+
+        :return Future for its result
+        """
+        future = Future(getattr(func, '__name__', None))
+        if getattr(_state, 'executor', None) is self:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e, sys.exc_info()[2])
+            return future
+        self._queue.put((future, cache.get_context(), func, args, kwargs))
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            if self._idle < self._queue.qsize() and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name='rethinkdb-rdb-worker')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return future
+
+    def _work(self):
+        _state.executor = self
+        while True:
+            with self._lock:
+                self._idle += 1
+            item = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if item is None:
+                return
+            future, ctx, func, args, kwargs = item
+            previous = cache.get_context()
+            cache._state.context = ctx
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e, sys.exc_info()[2])
+            else:
+                future.set_result(result)
+            finally:
+                cache._state.context = previous
+
+    def shutdown(self, wait=True):
+        """ Stop the workers once the queued work is done. The executor starts new
+        workers if more work is submitted.
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def stats(self):
+        with self._lock:
+            return {'workers': len(self._workers), 'idle': self._idle,
+                    'queued': self._queue.qsize(), 'max_workers': self.max_workers}
+
+
+executor = Executor()
+
+
+class AutoBatcher(object):
+    """ Coalesce the gets and puts made within window seconds of each other into one
+    get_multi() or put_multi() per model, sent on the executor. The first call of a
+    batch has a worker wait out the window, a batch that reaches max_batch is sent
+    at once. Calls made in different cache contexts are batched apart.
+
+    :param window: seconds to wait for more calls, 0 sends each call on its own
+    :param max_batch: calls per batch
+    """
+
+    def __init__(self, window=0.001, max_batch=500, executor=None):
+        self.window = window
+        self.max_batch = max_batch
+        self._executor = executor
+        self._queues = {}  # (operation, model, context) -> [(future, id or entity)]
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.calls = 0
+
+    def configure(self, window=None, max_batch=None):
+        with self._lock:
+            if window is not None:
+                self.window = window
+            if max_batch is not None:
+                self.max_batch = max_batch
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def get(self, model, id):
+        """ Queue model.get_by_id(id)
+
+        :return Future for the entity, None when there is no document
+        """
+        return self._add('get', model, id)
+
+    def put(self, entity):
+        """ Queue entity.put()
+
+        :return Future for the entity's id
+        """
+        return self._add('put', type(entity), entity)
+
+    def _add(self, operation, model, target):
+        future = Future('%s.%s' % (model.__name__, operation))
+        key = (operation, model, cache.get_context())
+        with self._lock:
+            self.calls += 1
+            queue = self._queues.get(key)
+            first = queue is None
+            if first:
+                queue = self._queues[key] = []
+            queue.append((future, target))
+            if len(queue) >= self.max_batch:
+                del self._queues[key]
+            else:
+                queue = None
+        if queue is not None:
+            self._executor.submit(self._send, key, queue)
+        elif first:
+            self._executor.submit(self._send_later, key)
+        return future
+
+    def _send_later(self, key):
+        time.sleep(self.window)
+        with self._lock:
+            queue = self._queues.pop(key, None)
+        if queue:
+            self._send(key, queue)
+
+    def _send(self, key, queue):
+        """ Send a batch and resolve its futures. A put_multi() error is set on the
+        futures of the entities it names, any other error on every future.
+        """
+        operation, model, ctx = key
+        with self._lock:
+            self.batches += 1
+        targets = [target for future, target in queue]
+        previous = cache.get_context()
+        cache._state.context = ctx
+        try:
+            if operation == 'get':
+                results = model.get_multi(targets)
+            else:
+                results = model.put_multi(targets)
+        except Exception as e:
+            tb = sys.exc_info()[2]
+            errors = getattr(e, 'errors', None) if operation == 'put' else None
+            for i, (future, target) in enumerate(queue):
+                error = errors[i] if errors is not None else e
+                if error is None:
+                    future.set_result(target.id)
+                elif isinstance(error, Exception):
+                    future.set_exception(error, tb if error is e else None)
+                else:
+                    future.set_exception(IOError(error))
+            return
+        finally:
+            cache._state.context = previous
+        for (future, target), result in zip(queue, results):
+            future.set_result(result)
+
+    def flush(self):
+        """ Send the queued calls now rather than at the end of their window
+        """
+        with self._lock:
+            queues, self._queues = self._queues, {}
+        for key, queue in queues.iteritems():
+            self._send(key, queue)
+
+    def stats(self):
+        with self._lock:
+            return {'window': self.window, 'max_batch': self.max_batch, 'calls': self.calls,
+                    'batches': self.batches, 'queued': sum(len(queue) for queue in self._queues.itervalues())}
+
+
+autobatcher = AutoBatcher(executor=executor)
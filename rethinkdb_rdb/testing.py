@@ -0,0 +1,1033 @@
+""" An in-process stand-in for a RethinkDB server. It evaluates the query terms
+built by the driver against dictionaries in memory, so the model layer can be
+tested and benchmarked without a running database:
+
+    server = testing.FakeServer(latency=0.001)
+    rethinkdb_rdb.model.connections = testing.FakePool(server)
+
+A cluster is a list of servers made with replica(), which share their tables.
+Setting down on one makes connecting to it and running queries on it fail.
+
+Only the subset of ReQL used by the model layer is implemented. Unsupported
+terms raise RqlCompileError naming the term. Recorder is an instrument that
+keeps the queries the model layer ran, to check which ones some code makes.
+"""
+import re
+import copy
+import uuid
+import threading
+import collections
+import time as _time
+
+from datetime import datetime, timedelta
+
+from rethinkdb import ast
+from rethinkdb.errors import RqlCompileError, RqlRuntimeError, RqlDriverError
+
+from .model import ConnectionPool
+from .instrumentation import Instrument
+
+
+_ISO8601 = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?)?(Z|[+-]\d\d:\d\d)?$')
+
+_ADDRESSES = iter(xrange(1, 1 << 30))
+
+
+def _parse_iso8601(value):
+    match = _ISO8601.match(value)
+    if not match:
+        raise RqlRuntimeError("Invalid ISO 8601 string %r" % value, None, [])
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    micro = int((fraction or '0')[:6].ljust(6, '0'))
+    if offset in (None, 'Z'):
+        offset = '+00:00'
+    hours, minutes = offset[1:].split(':')
+    tz = ast.RqlTzinfo('%s%s:%s' % (offset[0], hours, minutes))
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), micro, tz)
+
+
+class _LiteralValue(object):
+    """ A value wrapped in r.literal(), which replaces rather than merges into the
+    value it updates. Without a value it removes the field.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def __deepcopy__(self, memo):
+        return _LiteralValue(copy.deepcopy(self.value, memo))
+
+
+_REMOVE = object()
+
+
+def _unwrap(value):
+    """ A value with the r.literal() markers taken out
+    """
+    if isinstance(value, _LiteralValue):
+        return _unwrap(value.value)
+    if isinstance(value, dict):
+        return dict((k, _unwrap(v)) for k, v in value.items()
+                    if not (isinstance(v, _LiteralValue) and v.value is _REMOVE))
+    if isinstance(value, list):
+        return [_unwrap(v) for v in value]
+    return value
+
+
+def _merged(old, changes):
+    """ old updated with changes the way update() and insert(conflict='update') do:
+    objects are merged into the objects they update, recursively, unless wrapped in
+    r.literal()
+    """
+    new = dict(old)
+    for key, value in changes.items():
+        if isinstance(value, _LiteralValue) and value.value is _REMOVE:
+            new.pop(key, None)
+        elif isinstance(value, dict) and isinstance(new.get(key), dict):
+            new[key] = _merged(new[key], value)
+        else:
+            new[key] = _unwrap(value)
+    return new
+
+
+class _Table(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = collections.OrderedDict()
+        self.indexes = {}  # name -> (function or None, multi)
+        self.feeds = []
+
+
+class _Selection(object):
+    """ Documents that still belong to a table, so writes can be applied to them
+    """
+
+    def __init__(self, table, docs, ordered=False):
+        self.table = table
+        self.docs = docs
+        self.ordered = ordered
+
+
+class _Single(object):
+
+    def __init__(self, table, key, doc):
+        self.table = table
+        self.key = key
+        self.doc = doc
+
+
+class FakeCursor(object):
+    """ Iterates a sequence result in batches, sleeping for the server latency
+    before each batch like a driver cursor fetching the next response.
+    """
+
+    def __init__(self, server, items, batch_size):
+        self.server = server
+        self.items = items
+        self.batch_size = batch_size
+        self.closed = False
+        self.it = self._it()
+
+    def _it(self):
+        items = iter(self.items)
+        while not self.closed:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+            if not batch:
+                break
+            for item in batch:
+                yield copy.deepcopy(item)
+            self.server._delay()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.it)
+
+    __next__ = next
+
+    def close(self):
+        self.closed = True
+
+
+class FakeFeed(FakeCursor):
+    """ A changefeed cursor. Changes are queued by writes to the table and
+    block the reader until they arrive or the feed is closed.
+    """
+
+    def __init__(self, server, table, initial, filter_func):
+        self.server = server
+        self.table = table
+        self.filter_func = filter_func
+        self.changes = collections.deque({'new_val': doc} for doc in initial)
+        self.cond = threading.Condition(server.lock)
+        self.closed = False
+        self.it = self._it()
+
+    def _push(self, old_val, new_val):
+        if self.filter_func is not None:
+            old_val = old_val if old_val is not None and self.filter_func(old_val) else None
+            new_val = new_val if new_val is not None and self.filter_func(new_val) else None
+            if old_val is None and new_val is None:
+                return
+        self.changes.append({'old_val': copy.deepcopy(old_val), 'new_val': copy.deepcopy(new_val)})
+        self.cond.notify_all()
+
+    def _it(self):
+        while True:
+            with self.cond:
+                while not self.changes and not self.closed:
+                    self.cond.wait(0.05)
+                if self.closed:
+                    return
+                change = self.changes.popleft()
+            yield change
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            if self in self.table.feeds:
+                self.table.feeds.remove(self)
+            self.cond.notify_all()
+
+
+class FakeServer(object):
+    """ Tables held in memory, shared by all the connections made to it.
+
+    :param latency: seconds slept for every query and for every cursor batch after the first
+    :param batch_size: number of documents returned per cursor batch
+    """
+
+    def __init__(self, latency=0.0, batch_size=1000):
+        self.latency = latency
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.dbs = set()
+        self.tables = {}
+        self.queries = 0
+        self.down = False
+        self.address = next(_ADDRESSES)
+
+    def replica(self, latency=None):
+        """ Another server of the same cluster, holding the same tables
+        """
+        server = FakeServer(self.latency if latency is None else latency, self.batch_size)
+        server.lock, server.dbs, server.tables = self.lock, self.dbs, self.tables
+        return server
+
+    def connect(self, db=None):
+        if self.down:
+            raise RqlDriverError("Could not connect to fake:%d." % self.address)
+        return FakeConnection(self, db)
+
+    def reset(self):
+        with self.lock:
+            self.dbs.clear()
+            self.tables.clear()
+            self.queries = 0
+
+    def _delay(self):
+        if self.latency:
+            _time.sleep(self.latency)
+
+    def run(self, term, optargs):
+        self._delay()
+        if self.down:
+            raise RqlDriverError("Connection is closed.")
+        with self.lock:
+            self.queries += 1
+            result = _Evaluator(self).run(term)
+        if isinstance(result, (_Selection, list, tuple)):
+            items = result.docs if isinstance(result, _Selection) else result
+            result = FakeCursor(self, list(items), self.batch_size)
+        elif not isinstance(result, FakeCursor):
+            result = copy.deepcopy(_Evaluator.value(result))
+        if optargs.get('profile'):
+            return {'value': result, 'profile': [{'description': 'Evaluated in memory', 'duration(ms)': 0.0}]}
+        return result
+
+
+class FakeConnection(object):
+    """ Quacks like rethinkdb.net.Connection for RqlQuery.run()
+    """
+
+    def __init__(self, server, db=None):
+        self.server = server
+        self.db = db
+        self.host = 'fake'
+        self.port = server.address
+        self._open = True
+
+    def is_open(self):
+        return self._open
+
+    def close(self, noreply_wait=True):
+        self._open = False
+
+    def reconnect(self, noreply_wait=True):
+        self._open = True
+        return self
+
+    def use(self, db):
+        self.db = db
+
+    def _start(self, term, **global_optargs):
+        if not self._open:
+            raise RqlDriverError("Connection is closed.")
+        result = self.server.run(term, global_optargs)
+        if global_optargs.get('noreply'):
+            return None
+        return result
+
+
+class FakePool(ConnectionPool):
+    """ A ConnectionPool whose connections go to a FakeServer, or to the nodes of a
+    list of them
+    """
+
+    def __init__(self, server, **options):
+        servers = server if isinstance(server, (list, tuple)) else [server]
+        self.server = servers[0]
+        self.servers = dict((server.address, server) for server in servers)
+        options.setdefault('nodes', [('fake', server.address) for server in servers])
+        super(FakePool, self).__init__(**options)
+
+    def _connect(self, node):
+        return self.servers[node.port].connect()
+
+
+class Recorder(Instrument):
+    """ An instrument that keeps the names of the queries about to run and the
+    events of those that ran, to check which queries some code makes:
+
+        recorder = rdb.add_instrument(testing.Recorder())
+        Contact.get_multi(ids)
+        recorder.names  # ['Contact.get_multi']
+    """
+
+    def __init__(self):
+        self.before = []
+        self.after = []
+
+    def before_query(self, event):
+        self.before.append(event.name)
+
+    def after_query(self, event):
+        self.after.append(event)
+
+    @property
+    def names(self):
+        return [event.name for event in self.after]
+
+    def clear(self):
+        del self.before[:]
+        del self.after[:]
+
+
+class _Evaluator(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.vars = {}
+        self.rows = []
+
+    def run(self, term):
+        return self.eval(term)
+
+    @staticmethod
+    def value(result):
+        if isinstance(result, _Selection):
+            return list(result.docs)
+        if isinstance(result, _Single):
+            return result.doc
+        if isinstance(result, _Table):
+            return list(result.docs.values())
+        if isinstance(result, tuple):
+            return list(result)
+        if isinstance(result, _Grouped):
+            return dict(result.groups)
+        return result
+
+    def eval(self, term):
+        handler = getattr(self, '_' + type(term).__name__, None)
+        if handler is None:
+            raise RqlCompileError("%s is not supported by the fake server" % type(term).__name__, term, [])
+        return handler(term)
+
+    def arg(self, term, i):
+        return self.value(self.eval(term.args[i]))
+
+    def opt(self, term, name, default=None):
+        if name not in term.optargs:
+            return default
+        return self.value(self.eval(term.optargs[name]))
+
+    def seq(self, result):
+        if isinstance(result, _Table):
+            return list(result.docs.values())
+        if isinstance(result, _Selection):
+            return list(result.docs)
+        if isinstance(result, FakeCursor):
+            return list(result)
+        return list(result)
+
+    def table_of(self, result):
+        if isinstance(result, _Table):
+            return result
+        if isinstance(result, _Selection):
+            return result.table
+        return None
+
+    def call(self, func_term, *values):
+        """ Apply a Func term, or any other term with r.row bound to the values
+        """
+        if isinstance(func_term, ast.Func):
+            var_ids = [v.data for v in func_term.args[0].args]
+            saved = [self.vars.get(v) for v in var_ids]
+            for var_id, value in zip(var_ids, values):
+                self.vars[var_id] = value
+            self.rows.append(values[0] if values else None)
+            try:
+                return self.value(self.eval(func_term.args[1]))
+            finally:
+                self.rows.pop()
+                for var_id, value in zip(var_ids, saved):
+                    self.vars[var_id] = value
+        if isinstance(func_term, ast.MakeObj):
+            # filter({'field': value}) matches on equality of every field
+            expected = self.value(self.eval(func_term))
+            return all(values[0].get(k) == v for k, v in expected.items())
+        self.rows.append(values[0] if values else None)
+        try:
+            return self.value(self.eval(func_term))
+        finally:
+            self.rows.pop()
+
+    def index_values(self, table, index, doc):
+        func, multi = table.indexes.get(index, (None, False))
+        if index == 'id':
+            values = [doc.get('id')]
+        elif func is not None:
+            values = [self.call(func, doc)]
+        else:
+            values = [doc.get(index)]
+        if multi and values and isinstance(values[0], list):
+            values = values[0]
+        return [v for v in values if v is not None]
+
+    def check_index(self, table, index):
+        if index != 'id' and index not in table.indexes:
+            raise RqlRuntimeError("Index `%s` was not found on table `%s`." % (index, table.name), None, [])
+
+    # Values
+    def _Datum(self, term):
+        return term.data
+
+    def _MakeArray(self, term):
+        return [self.value(self.eval(a)) for a in term.args]
+
+    def _MakeObj(self, term):
+        return dict((k, self.value(self.eval(v))) for k, v in term.optargs.items())
+
+    def _Var(self, term):
+        return self.vars[term.args[0].data]
+
+    def _ImplicitVar(self, term):
+        return self.rows[-1]
+
+    def _Func(self, term):
+        return term
+
+    def _ISO8601(self, term):
+        return _parse_iso8601(self.arg(term, 0))
+
+    def _Now(self, term):
+        return datetime.utcnow().replace(tzinfo=ast.RqlTzinfo('+00:00'))
+
+    def _EpochTime(self, term):
+        return datetime(1970, 1, 1, tzinfo=ast.RqlTzinfo('+00:00')) + timedelta(seconds=self.arg(term, 0))
+
+    def _Literal(self, term):
+        return _LiteralValue(self.arg(term, 0) if term.args else _REMOVE)
+
+    def _DB(self, term):
+        return None
+
+    def _Asc(self, term):
+        return ('asc', term.args[0])
+
+    def _Desc(self, term):
+        return ('desc', term.args[0])
+
+    # Administration
+    def _DbCreate(self, term):
+        name = self.arg(term, 0)
+        if name in self.server.dbs:
+            raise RqlRuntimeError("Database `%s` already exists." % name, term, [])
+        self.server.dbs.add(name)
+        return {'created': 1}
+
+    def _DbDrop(self, term):
+        # every database shares the one set of tables
+        self.server.dbs.discard(self.arg(term, 0))
+        self.server.tables.clear()
+        return {'dropped': 1}
+
+    def _DbList(self, term):
+        return sorted(self.server.dbs)
+
+    def _TableList(self, term):
+        return sorted(self.server.tables)
+
+    def _TableListTL(self, term):
+        return self._TableList(term)
+
+    def _TableCreate(self, term):
+        name = self.arg(term, len(term.args) - 1)
+        if name in self.server.tables:
+            raise RqlRuntimeError("Table `%s` already exists." % name, term, [])
+        self.server.tables[name] = _Table(name)
+        return {'created': 1}
+
+    _TableCreateTL = _TableCreate
+
+    def _TableDrop(self, term):
+        name = self.arg(term, len(term.args) - 1)
+        if name not in self.server.tables:
+            raise RqlRuntimeError("Table `%s` does not exist." % name, term, [])
+        table = self.server.tables.pop(name)
+        for feed in list(table.feeds):
+            feed.close()
+        return {'dropped': 1}
+
+    _TableDropTL = _TableDrop
+
+    def _Table(self, term):
+        name = self.arg(term, len(term.args) - 1)
+        if name not in self.server.tables:
+            raise RqlRuntimeError("Table `%s` does not exist." % name, term, [])
+        return self.server.tables[name]
+
+    def _IndexList(self, term):
+        return sorted(self.eval(term.args[0]).indexes)
+
+    def _IndexCreate(self, term):
+        table = self.eval(term.args[0])
+        name = self.arg(term, 1)
+        if name in table.indexes:
+            raise RqlRuntimeError("Index `%s` already exists on table `%s`." % (name, table.name), term, [])
+        func = term.args[2] if len(term.args) > 2 else None
+        table.indexes[name] = (func, bool(self.opt(term, 'multi', False)))
+        return {'created': 1}
+
+    def _IndexDrop(self, term):
+        table = self.eval(term.args[0])
+        name = self.arg(term, 1)
+        self.check_index(table, name)
+        del table.indexes[name]
+        return {'dropped': 1}
+
+    def _IndexWait(self, term):
+        table = self.eval(term.args[0])
+        names = [self.arg(term, i) for i in range(1, len(term.args))] or sorted(table.indexes)
+        return [{'index': name, 'ready': True} for name in names]
+
+    _IndexStatus = _IndexWait
+
+    def _Sync(self, term):
+        return {'synced': 1}
+
+    # Selections
+    def _Get(self, term):
+        table = self.eval(term.args[0])
+        key = self.arg(term, 1)
+        return _Single(table, key, table.docs.get(key))
+
+    def _GetAll(self, term):
+        table = self.eval(term.args[0])
+        index = self.opt(term, 'index', 'id')
+        self.check_index(table, index)
+        keys = [self.arg(term, i) for i in range(1, len(term.args))]
+        if index == 'id':
+            return _Selection(table, [table.docs[k] for k in keys if k in table.docs])
+        docs = []
+        seen = set()
+        for key in keys:
+            for doc in table.docs.values():
+                if key in self.index_values(table, index, doc) and id(doc) not in seen:
+                    seen.add(id(doc))
+                    docs.append(doc)
+        return _Selection(table, docs)
+
+    def _Between(self, term):
+        source = self.eval(term.args[0])
+        table = self.table_of(source)
+        lower, upper = self.arg(term, 1), self.arg(term, 2)
+        index = self.opt(term, 'index', 'id')
+        self.check_index(table, index)
+        left_open = self.opt(term, 'left_bound', 'closed') == 'open'
+        right_closed = self.opt(term, 'right_bound', 'open') == 'closed'
+
+        def inside(value):
+            if lower is not None and (value < lower or (left_open and value == lower)):
+                return False
+            if upper is not None and (value > upper or (value == upper and not right_closed)):
+                return False
+            return True
+
+        docs = [doc for doc in self.seq(source) if any(inside(v) for v in self.index_values(table, index, doc))]
+        return _Selection(table, docs)
+
+    def _Filter(self, term):
+        source = self.eval(term.args[0])
+        docs = [doc for doc in self.seq(source) if self.call(term.args[1], doc)]
+        table = self.table_of(source)
+        return _Selection(table, docs) if table else docs
+
+    def _OrderBy(self, term):
+        source = self.eval(term.args[0])
+        table = self.table_of(source)
+        docs = self.seq(source)
+        keys = []
+        index = term.optargs.get('index')
+        if index is not None:
+            direction, name = self.eval(index) if isinstance(index, (ast.Asc, ast.Desc)) else ('asc', index)
+            name = self.value(self.eval(name))
+            self.check_index(table, name)
+            # secondary index entries are ordered by value and then primary key
+            keys.append((direction, lambda doc, name=name: ((self.index_values(table, name, doc) or [None])[0], doc['id'])))
+        for arg in term.args[1:]:
+            direction, field = self.eval(arg) if isinstance(arg, (ast.Asc, ast.Desc)) else ('asc', arg)
+            if isinstance(field, ast.Func):
+                keys.append((direction, lambda doc, f=field: self.call(f, doc)))
+            else:
+                name = self.value(self.eval(field))
+                keys.append((direction, lambda doc, name=name: doc.get(name)))
+        for direction, key in reversed(keys):
+            docs.sort(key=key, reverse=direction == 'desc')
+        return _Selection(table, docs, ordered=True) if table else docs
+
+    def _Skip(self, term):
+        source = self.eval(term.args[0])
+        n = self.arg(term, 1)
+        return self._slice(source, n, None)
+
+    def _Limit(self, term):
+        source = self.eval(term.args[0])
+        n = self.arg(term, 1)
+        return self._slice(source, 0, n)
+
+    def _Slice(self, term):
+        source = self.eval(term.args[0])
+        return self._slice(source, self.arg(term, 1), self.arg(term, 2))
+
+    def _slice(self, source, start, end):
+        table = self.table_of(source)
+        docs = self.seq(source)[start:end]
+        return _Selection(table, docs) if table else docs
+
+    def _Nth(self, term):
+        docs = self.seq(self.eval(term.args[0]))
+        i = self.arg(term, 1)
+        try:
+            return docs[i]
+        except IndexError:
+            raise RqlRuntimeError("Index out of bounds.", term, [])
+
+    def _Union(self, term):
+        docs = []
+        for arg in term.args:
+            docs.extend(self.seq(self.eval(arg)))
+        return docs
+
+    def _Changes(self, term):
+        source = self.eval(term.args[0])
+        table = self.table_of(source)
+        filter_func = None
+        if isinstance(source, _Selection):
+            selected = set(id(doc) for doc in source.docs)
+            filter_term = term.args[0]
+            if isinstance(filter_term, ast.Filter):
+                filter_func = lambda doc: self.call(filter_term.args[1], doc)
+            elif isinstance(filter_term, ast.GetAll):
+                keys = set(self.arg(filter_term, i) for i in range(1, len(filter_term.args)))
+                index = self.opt(filter_term, 'index', 'id')
+                filter_func = lambda doc: bool(keys.intersection(self.index_values(table, index, doc)))
+        initial = self.seq(source) if self.opt(term, 'include_initial', False) else []
+        feed = FakeFeed(self.server, table, copy.deepcopy(initial), filter_func)
+        table.feeds.append(feed)
+        return feed
+
+    # Writes
+    def _notify(self, table, old_val, new_val):
+        for feed in table.feeds:
+            feed._push(old_val, new_val)
+
+    def _Insert(self, term):
+        table = self.eval(term.args[0])
+        docs = self.arg(term, 1)
+        if isinstance(docs, dict):
+            docs = [docs]
+        conflict = self.opt(term, 'conflict', 'error')
+        result = {'inserted': 0, 'replaced': 0, 'unchanged': 0, 'errors': 0, 'deleted': 0, 'skipped': 0}
+        changes = []
+        generated = []
+        for doc in docs:
+            doc = copy.deepcopy(doc)
+            if doc.get('id') is None:
+                doc['id'] = str(uuid.uuid4())
+                generated.append(doc['id'])
+            if isinstance(doc['id'], basestring) and len(doc['id']) > 127:
+                result['errors'] += 1
+                result.setdefault('first_error', "Primary key too long (max 127 characters): %r" % doc['id'])
+                continue
+            old = table.docs.get(doc['id'])
+            if old is None:
+                doc = _unwrap(doc)
+                table.docs[doc['id']] = doc
+                result['inserted'] += 1
+                changes.append({'old_val': None, 'new_val': copy.deepcopy(doc)})
+                self._notify(table, None, doc)
+            elif conflict == 'error':
+                result['errors'] += 1
+                result.setdefault('first_error', "Duplicate primary key `id`: %r" % doc['id'])
+            else:
+                new = _merged(old, doc) if conflict == 'update' else _unwrap(doc)
+                if new == old:
+                    result['unchanged'] += 1
+                else:
+                    table.docs[doc['id']] = new
+                    result['replaced'] += 1
+                    changes.append({'old_val': copy.deepcopy(old), 'new_val': copy.deepcopy(new)})
+                    self._notify(table, old, new)
+        if generated:
+            result['generated_keys'] = generated
+        if self.opt(term, 'return_changes'):
+            result['changes'] = changes
+        return result
+
+    def _targets(self, source):
+        if isinstance(source, _Single):
+            return source.table, [source.doc] if source.doc is not None else []
+        if isinstance(source, _Table):
+            return source, list(source.docs.values())
+        if isinstance(source, _Selection):
+            return source.table, list(source.docs)
+        raise RqlRuntimeError("Expected a table, selection or single row", None, [])
+
+    def _Update(self, term):
+        table, docs = self._targets(self.eval(term.args[0]))
+        result = {'replaced': 0, 'unchanged': 0, 'skipped': 0, 'errors': 0, 'inserted': 0, 'deleted': 0}
+        for doc in docs:
+            arg = term.args[1]
+            changes = self.call(arg, doc) if isinstance(arg, ast.Func) else self.arg(term, 1)
+            new = _merged(doc, changes)
+            if new == doc:
+                result['unchanged'] += 1
+            else:
+                table.docs[doc['id']] = new
+                result['replaced'] += 1
+                self._notify(table, doc, new)
+        if not docs:
+            result['skipped'] += 1
+        return result
+
+    def _Replace(self, term):
+        table, docs = self._targets(self.eval(term.args[0]))
+        result = {'replaced': 0, 'unchanged': 0, 'skipped': 0, 'errors': 0, 'inserted': 0, 'deleted': 0}
+        for doc in docs:
+            new = self.call(term.args[1], doc) if isinstance(term.args[1], ast.Func) else self.arg(term, 1)
+            new = _unwrap(new)
+            table.docs[doc['id']] = new
+            result['replaced'] += 1
+            self._notify(table, doc, new)
+        return result
+
+    def _Delete(self, term):
+        table, docs = self._targets(self.eval(term.args[0]))
+        result = {'deleted': 0, 'skipped': 0, 'errors': 0, 'inserted': 0, 'replaced': 0, 'unchanged': 0}
+        for doc in docs:
+            if table.docs.pop(doc['id'], None) is not None:
+                result['deleted'] += 1
+                self._notify(table, doc, None)
+        if not docs:
+            result['skipped'] += 1
+        return result
+
+    # Transformations and aggregation
+    def _Pluck(self, term):
+        source = self.value(self.eval(term.args[0]))
+        fields = [self.arg(term, i) for i in range(1, len(term.args))]
+
+        def pluck(doc):
+            return dict((k, doc[k]) for k in fields if k in doc)
+
+        if isinstance(source, dict):
+            return pluck(source)
+        return [pluck(doc) for doc in self.seq(source)]
+
+    def _Without(self, term):
+        source = self.value(self.eval(term.args[0]))
+        fields = set(self.arg(term, i) for i in range(1, len(term.args)))
+
+        def without(doc):
+            return dict((k, v) for k, v in doc.items() if k not in fields)
+
+        if isinstance(source, dict):
+            return without(source)
+        return [without(doc) for doc in self.seq(source)]
+
+    def _Map(self, term):
+        return [self.call(term.args[1], doc) for doc in self.seq(self.eval(term.args[0]))]
+
+    def _ConcatMap(self, term):
+        docs = []
+        for doc in self.seq(self.eval(term.args[0])):
+            docs.extend(self.call(term.args[1], doc))
+        return docs
+
+    def _Count(self, term):
+        source = self.value(self.eval(term.args[0]))
+        if len(term.args) > 1:
+            return len([doc for doc in self.seq(source) if self.call(term.args[1], doc)])
+        return len(self.seq(source))
+
+    def _field_values(self, term):
+        docs = self.seq(self.eval(term.args[0]))
+        if len(term.args) > 1:
+            arg = term.args[1]
+            if isinstance(arg, ast.Func):
+                return [self.call(arg, doc) for doc in docs]
+            name = self.arg(term, 1)
+            return [doc[name] for doc in docs if doc.get(name) is not None]
+        return docs
+
+    def _Sum(self, term):
+        return sum(self._field_values(term))
+
+    def _Avg(self, term):
+        values = self._field_values(term)
+        if not values:
+            raise RqlRuntimeError("Cannot take the average of an empty stream.", term, [])
+        return float(sum(values)) / len(values)
+
+    def _Min(self, term):
+        values = self._field_values(term)
+        if not values:
+            raise RqlRuntimeError("Cannot take the min of an empty stream.", term, [])
+        return min(values)
+
+    def _Max(self, term):
+        values = self._field_values(term)
+        if not values:
+            raise RqlRuntimeError("Cannot take the max of an empty stream.", term, [])
+        return max(values)
+
+    def _Group(self, term):
+        source = self.eval(term.args[0])
+        table = self.table_of(source)
+        index = self.opt(term, 'index')
+        groups = collections.OrderedDict()
+        for doc in self.seq(source):
+            if index is not None:
+                keys = self.index_values(table, index, doc)
+            else:
+                key = []
+                for arg in term.args[1:]:
+                    key.append(self.call(arg, doc) if isinstance(arg, ast.Func) else doc.get(self.value(self.eval(arg))))
+                keys = [key[0] if len(key) == 1 else tuple(key)]
+            for key in keys:
+                groups.setdefault(key, []).append(doc)
+        return _Grouped(groups)
+
+    def _Ungroup(self, term):
+        grouped = self.eval(term.args[0])
+        return [{'group': list(k) if isinstance(k, tuple) else k, 'reduction': v} for k, v in grouped.groups.items()]
+
+    def _Bracket(self, term):
+        source = self.eval(term.args[0])
+        key = self.arg(term, 1)
+        if isinstance(source, _Grouped):
+            return source.apply(lambda docs: [doc[key] for doc in docs if key in doc])
+        source = self.value(source)
+        if isinstance(key, int):
+            return self.seq(source)[key]
+        if isinstance(source, dict):
+            if key not in source:
+                raise RqlRuntimeError("No attribute `%s` in object" % key, term, [])
+            return source[key]
+        return [doc[key] for doc in self.seq(source) if key in doc]
+
+    _GetField = _Bracket
+
+    def _HasFields(self, term):
+        source = self.value(self.eval(term.args[0]))
+        fields = [self.arg(term, i) for i in range(1, len(term.args))]
+        if isinstance(source, dict):
+            return all(source.get(f) is not None for f in fields)
+        return [doc for doc in self.seq(source) if all(doc.get(f) is not None for f in fields)]
+
+    def _Default(self, term):
+        try:
+            value = self.value(self.eval(term.args[0]))
+        except (RqlRuntimeError, KeyError):
+            value = None
+        return self.arg(term, 1) if value is None else value
+
+    def _Contains(self, term):
+        source = self.seq(self.value(self.eval(term.args[0])))
+        for arg in term.args[1:]:
+            if isinstance(arg, ast.Func):
+                if not any(self.call(arg, item) for item in source):
+                    return False
+            elif self.value(self.eval(arg)) not in source:
+                return False
+        return True
+
+    def _IsEmpty(self, term):
+        return not self.seq(self.value(self.eval(term.args[0])))
+
+    def _Keys(self, term):
+        return sorted(self.arg(term, 0).keys())
+
+    def _Merge(self, term):
+        doc = dict(self.arg(term, 0))
+        for arg in term.args[1:]:
+            doc.update(self.call(arg, doc) if isinstance(arg, ast.Func) else self.value(self.eval(arg)))
+        return doc
+
+    def _EqJoin(self, term):
+        source = self.eval(term.args[0])
+        field = term.args[1]
+        right = self.eval(term.args[2])
+        index = self.opt(term, 'index', 'id')
+        joined = []
+        for doc in self.seq(source):
+            key = self.call(field, doc) if isinstance(field, ast.Func) else doc.get(self.value(self.eval(field)))
+            if key is None:
+                continue
+            for other in right.docs.values():
+                if key in self.index_values(right, index, other):
+                    joined.append({'left': doc, 'right': other})
+        return joined
+
+    def _Zip(self, term):
+        docs = []
+        for pair in self.seq(self.eval(term.args[0])):
+            doc = dict(pair['left'])
+            doc.update(pair['right'])
+            docs.append(doc)
+        return docs
+
+    def _FunCall(self, term):
+        values = [self.arg(term, i) for i in range(1, len(term.args))]
+        return self.call(term.args[0], *values)
+
+    def _Branch(self, term):
+        return self.arg(term, 1) if self.arg(term, 0) else self.arg(term, 2)
+
+    def _CoerceTo(self, term):
+        source = self.value(self.eval(term.args[0]))
+        kind = self.arg(term, 1).lower()
+        if kind == 'array':
+            return self.seq(source)
+        if kind == 'object':
+            return dict(source)
+        if kind == 'string':
+            return unicode(source)
+        if kind == 'number':
+            return float(source)
+        raise RqlRuntimeError("Cannot coerce to %s" % kind, term, [])
+
+    def _Downcase(self, term):
+        return self.arg(term, 0).lower()
+
+    def _Upcase(self, term):
+        return self.arg(term, 0).upper()
+
+    def _Year(self, term):
+        return self.arg(term, 0).year
+
+    def _Month(self, term):
+        return self.arg(term, 0).month
+
+    # Operators
+    def _compare(op):
+        def compare(self, term):
+            values = [self.arg(term, i) for i in range(len(term.args))]
+            return all(op(a, b) for a, b in zip(values, values[1:]))
+        return compare
+
+    _Eq = _compare(lambda a, b: a == b)
+    _Ne = _compare(lambda a, b: a != b)
+    _Lt = _compare(lambda a, b: a < b)
+    _Le = _compare(lambda a, b: a <= b)
+    _Gt = _compare(lambda a, b: a > b)
+    _Ge = _compare(lambda a, b: a >= b)
+
+    def _All(self, term):
+        return all(self.arg(term, i) for i in range(len(term.args)))
+
+    def _Any(self, term):
+        return any(self.arg(term, i) for i in range(len(term.args)))
+
+    def _Not(self, term):
+        return not self.arg(term, 0)
+
+    def _arith(op):
+        def arith(self, term):
+            values = [self.arg(term, i) for i in range(len(term.args))]
+            return reduce(op, values)
+        return arith
+
+    _Add = _arith(lambda a, b: a + b)
+    _Sub = _arith(lambda a, b: a - b)
+    _Mul = _arith(lambda a, b: a * b)
+    _Div = _arith(lambda a, b: float(a) / b)
+    _Mod = _arith(lambda a, b: a % b)
+
+
+class _Grouped(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def apply(self, func):
+        return _Grouped(collections.OrderedDict((k, func(v)) for k, v in self.groups.items()))
+
+
+def _grouped(name, reducer):
+    original = getattr(_Evaluator, name)
+
+    def handler(self, term):
+        source = self.eval(term.args[0])
+        if not isinstance(source, _Grouped):
+            return original(self, term)
+        field = term.args[1] if len(term.args) > 1 else None
+
+        def reduce_group(docs):
+            if field is None:
+                values = docs
+            elif isinstance(field, ast.Func):
+                values = [self.call(field, doc) for doc in docs]
+            else:
+                name = self.value(self.eval(field))
+                values = [doc[name] for doc in docs if isinstance(doc, dict) and doc.get(name) is not None]
+            return reducer(values)
+
+        return source.apply(reduce_group)
+    setattr(_Evaluator, name, handler)
+
+
+_grouped('_Count', len)
+_grouped('_Sum', sum)
+_grouped('_Avg', lambda values: float(sum(values)) / len(values) if values else None)
+_grouped('_Min', lambda values: min(values) if values else None)
+_grouped('_Max', lambda values: max(values) if values else None)
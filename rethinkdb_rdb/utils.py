@@ -45,4 +45,10 @@ def positional(max_pos_args):
 
         return positional_wrapper
 
-    return positional_decorator
\ No newline at end of file
+    return positional_decorator
+
+
+def chunks(items, size):
+    """Yield successive lists of at most size items from a sequence."""
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,209 @@
+import threading
+import time
+import unittest
+
+import rethinkdb_rdb as rdb
+from rethinkdb_rdb import testing
+
+from nose.tools import *
+
+
+class StubConnection(object):
+
+    def __init__(self):
+        self.open = True
+
+    def is_open(self):
+        return self.open
+
+    def close(self, noreply_wait=True):
+        self.open = False
+
+
+class StubPool(rdb.ConnectionPool):
+
+    def _connect(self, node):
+        return StubConnection()
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = StubPool(max_size=2)
+        with pool.get() as conn:
+            first = conn
+        with pool.get() as conn:
+            self.assertIs(conn, first)
+        self.assertEqual(pool.stats()['opened'], 1)
+
+    def test_bounded(self):
+        pool = StubPool(max_size=2, timeout=0.05)
+        with pool.get():
+            with pool.get():
+                stats = pool.stats()
+                self.assertEqual(stats['in_use'], 2)
+                self.assertEqual(stats['size'], 2)
+                self.assertRaises(rdb.PoolTimeoutError, pool.get().__enter__)
+        stats = pool.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 2)
+
+    def test_wait_for_release(self):
+        pool = StubPool(max_size=1, timeout=5)
+        acquired = []
+
+        def worker():
+            with pool.get() as conn:
+                acquired.append(conn)
+
+        with pool.get() as conn:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(pool.stats()['waiting'], 1)
+        thread.join()
+
+        self.assertEqual(acquired, [conn])
+        self.assertTrue(pool.stats()['max_wait'] > 0)
+
+    def test_dead_connection_discarded(self):
+        pool = StubPool(max_size=2)
+        with pool.get() as conn:
+            first = conn
+        first.close()
+
+        with pool.get() as conn:
+            self.assertIsNot(conn, first)
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['closed'], 1)
+
+    def test_broken_connection_not_returned(self):
+        pool = StubPool(max_size=2)
+        try:
+            with pool.get() as conn:
+                conn.close()
+                raise rdb.RqlDriverError("Connection is closed.")
+        except rdb.RqlDriverError:
+            pass
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['idle'], 0)
+
+    def test_idle_recycled(self):
+        pool = StubPool(min_size=1, max_size=3, max_idle=0.01)
+        with pool.get():
+            with pool.get():
+                pass
+        time.sleep(0.02)
+        with pool.get():
+            pass
+        # the idle connections expired, but min_size is kept open
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_warmup(self):
+        pool = StubPool(min_size=3, max_size=5)
+        pool.warmup()
+        stats = pool.stats()
+        self.assertEqual(stats['idle'], 3)
+        self.assertEqual(stats['opened'], 3)
+
+        pool.clear()
+        self.assertEqual(pool.stats()['size'], 0)
+
+    @raises(ValueError)
+    def test_invalid_configuration(self):
+        StubPool(min_size=6, max_size=5)
+
+
+class TestClusterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.first = testing.FakeServer()
+        self.second = self.first.replica()
+        self.third = self.first.replica()
+        self.pool = testing.FakePool([self.first, self.second, self.third], max_size=6, backoff=0.05)
+
+    def test_least_outstanding(self):
+        with self.pool.get() as a:
+            with self.pool.get() as b:
+                with self.pool.get() as c:
+                    self.assertEqual(set(conn.server for conn in (a, b, c)), set([self.first, self.second, self.third]))
+        nodes = self.pool.stats()['nodes']
+        self.assertEqual(sorted(node['connections'] for node in nodes.values()), [1, 1, 1])
+        self.assertEqual(sorted(node['checkouts'] for node in nodes.values()), [1, 1, 1])
+
+    def test_failed_node_backoff(self):
+        self.pool.configure(nodes=[('fake', self.first.address), ('fake', self.second.address)])
+        self.first.down = True
+        with self.pool.get() as conn:
+            self.assertIs(conn.server, self.second)
+        first = self.pool.stats()['nodes']['fake:%d' % self.first.address]
+        self.assertFalse(first['healthy'])
+        self.assertEqual(first['failures'], 1)
+
+        # skipped while it backs off, even though it has the fewest connections
+        with self.pool.get() as conn:
+            self.assertIs(conn.server, self.second)
+        self.first.down = False
+        time.sleep(0.06)
+        with self.pool.get() as a:
+            with self.pool.get() as b:
+                self.assertEqual(set([a.server, b.server]), set([self.first, self.second]))
+        self.assertTrue(self.pool.stats()['nodes']['fake:%d' % self.first.address]['healthy'])
+
+    def test_broken_connection_marks_node(self):
+        try:
+            with self.pool.get() as conn:
+                server = conn.server
+                conn.close()
+                raise rdb.RqlDriverError("Connection is closed.")
+        except rdb.RqlDriverError:
+            pass
+        self.assertEqual(self.pool.stats()['nodes']['fake:%d' % server.address]['errors'], 1)
+        with self.pool.get() as conn:
+            self.assertIsNot(conn.server, server)
+
+    def test_errors_on_open_connection_keep_node(self):
+        self.pool.configure(nodes=[('fake', self.first.address), ('fake', self.second.address)], max_size=2)
+        try:
+            with self.pool.get() as a:
+                with self.pool.get() as b:
+                    with self.pool.get(timeout=0.01) as c:
+                        pass
+        except rdb.PoolTimeoutError:
+            pass
+        try:
+            with self.pool.get() as conn:
+                raise rdb.RqlDriverError("Cannot convert object to JSON")
+        except rdb.RqlDriverError:
+            pass
+        try:
+            with self.pool.get() as conn:
+                raise rdb.RqlRuntimeError("Table `test.missing` does not exist.", None, [])
+        except rdb.RqlRuntimeError:
+            pass
+        nodes = self.pool.stats()['nodes'].values()
+        self.assertTrue(all(node['healthy'] for node in nodes))
+        self.assertEqual(sum(node['errors'] for node in nodes), 0)
+        self.assertEqual(self.pool.stats()['size'], 2)
+
+    def test_all_nodes_down(self):
+        for server in (self.first, self.second, self.third):
+            server.down = True
+        self.assertRaises(rdb.RqlDriverError, self.pool.get().__enter__)
+        self.assertEqual(self.pool.stats()['size'], 0)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_nearest(self):
+        with self.pool.get() as conn:
+            time.sleep(0.03)
+            slow = conn.server
+        with self.pool.get() as conn:
+            fast = conn.server
+        self.assertIsNot(fast, slow)
+        for _ in range(3):
+            with self.pool.get(nearest=True) as conn:
+                self.assertIsNot(conn.server, slow)
+
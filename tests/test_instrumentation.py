@@ -0,0 +1,99 @@
+import logging
+import unittest
+
+import rethinkdb_rdb as rdb
+from rethinkdb_rdb import model, testing
+
+from nose.tools import *
+
+
+class InstrumentedModel(rdb.Model):
+    name = rdb.StringProperty()
+
+
+class OtherInstrumentedModel(rdb.Model):
+    name = rdb.StringProperty()
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = model.connections
+        model.connections = testing.FakePool(testing.FakeServer())
+        with model.connections.get() as conn:
+            rdb.db_create(rdb.DATABASE['db']).run(conn)
+        self.recorder = rdb.add_instrument(testing.Recorder())
+        rdb.sync_all([InstrumentedModel], force=True)
+
+    def tearDown(self):
+        rdb.remove_instrument(self.recorder)
+        model.connections = self.connections
+
+    def test_hooks(self):
+        self.assertEqual(self.recorder.after[0].name, 'InstrumentedModel.sync')
+
+        entity = InstrumentedModel(name='a')
+        entity.put()
+        InstrumentedModel.get_by_id(entity.id)
+        InstrumentedModel.all()
+        InstrumentedModel.delete(entity.id)
+
+        events = self.recorder.after[-4:]
+        self.assertEqual([e.name for e in events], [
+            'InstrumentedModel.put', 'InstrumentedModel.get_by_id',
+            'InstrumentedModel.all', 'InstrumentedModel.delete'])
+        self.assertEqual(self.recorder.before[-4:], [e.name for e in events])
+        self.assertEqual([e.size for e in events], [1, 1, 1, 1])
+        for event in events:
+            self.assertIsNone(event.error)
+            self.assertGreaterEqual(event.duration, 0)
+            self.assertGreaterEqual(event.wait, 0)
+
+    def test_error(self):
+        self.assertRaises(rdb.RqlRuntimeError, rdb.Model._run, 'all', rdb.table('Missing'))
+        self.assertIsInstance(self.recorder.after[-1].error, rdb.RqlRuntimeError)
+
+    def test_slow_query_log(self):
+        slow = rdb.add_instrument(rdb.SlowQueryLog(threshold=0, sample_rate=1, logger=logging.getLogger('test')))
+        try:
+            entity = InstrumentedModel(name='slow')
+            entity.put()
+            self.assertEqual(InstrumentedModel.get_by_id(entity.id).name, 'slow')
+            self.assertEqual(list(InstrumentedModel.all()[0])[0].name, 'slow')
+        finally:
+            rdb.remove_instrument(slow)
+
+        stats = slow.stats()
+        self.assertEqual(stats['InstrumentedModel.get_by_id']['count'], 1)
+        self.assertEqual(sum(stats['InstrumentedModel.put']['histogram'].values()), 1)
+        self.assertEqual(len(slow.slow_queries), 3)
+        self.assertIsInstance(slow.slow_queries[-1].profile, list)
+
+    def test_slow_count(self):
+        class Messages(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        logger = logging.getLogger('test.slow_count')
+        logger.propagate = False
+        messages = Messages()
+        logger.addHandler(messages)
+        slow = rdb.add_instrument(rdb.SlowQueryLog(threshold=0, logger=logger))
+        try:
+            InstrumentedModel(name='counted').put()
+            self.assertEqual(InstrumentedModel.count({'name': 'counted'}), 1)
+        finally:
+            rdb.remove_instrument(slow)
+            logger.removeHandler(messages)
+        self.assertEqual(slow.slow_queries[-1].size, 1)
+        self.assertTrue(messages.messages[-1].startswith('Slow query InstrumentedModel.count took'))
+
+    def test_sync_of_several_models(self):
+        self.recorder.clear()
+        rdb.sync_all([InstrumentedModel, OtherInstrumentedModel], force=True)
+        self.assertEqual(set(self.recorder.names), set(['*.sync']))
+        self.assertIn('index_wait', str(self.recorder.after[-1].term))
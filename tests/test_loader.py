@@ -0,0 +1,117 @@
+import json
+import unittest
+
+from StringIO import StringIO
+
+import rethinkdb_rdb as rdb
+from rethinkdb_rdb import loader, model, testing
+
+from nose.tools import *
+
+
+class LoadedModel(rdb.Model):
+    name = rdb.StringProperty()
+    age = rdb.IntegerProperty(indexed=False, required=False)
+    active = rdb.BooleanProperty(indexed=False, required=False)
+
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = model.connections
+        model.connections = testing.FakePool(testing.FakeServer())
+        with model.connections.get() as conn:
+            rdb.db_create(rdb.DATABASE['db']).run(conn)
+        rdb.sync_all([LoadedModel], force=True)
+
+    def tearDown(self):
+        model.connections = self.connections
+
+    def test_jsonl(self):
+        lines = [json.dumps({'name': 'row %d' % i, 'age': i}) for i in range(25)]
+        lines[3] = '{"name": "bad", "age": "old"}'
+        lines[7] = 'not json'
+        lines[9] = '{"name": "x", "unknown": 1}'
+        rejects = StringIO()
+
+        stats = loader.load(LoadedModel, StringIO('\n'.join(lines)), chunk_size=4, max_in_flight=2, rejects=rejects)
+
+        self.assertEqual((stats['read'], stats['inserted'], stats['rejected']), (25, 22, 3))
+        self.assertEqual(stats['chunks'], 6)
+        self.assertEqual(LoadedModel.count(), 22)
+        self.assertEqual([json.loads(line)['line'] for line in rejects.getvalue().splitlines()], [4, 8, 10])
+
+    def test_csv(self):
+        source = StringIO('name,age,active\nann,31,true\nbob,,no\ncid,x,yes\n')
+        rejects = StringIO()
+
+        stats = loader.load(LoadedModel, source, format='csv', rejects=rejects)
+
+        self.assertEqual((stats['inserted'], stats['rejected']), (2, 1))
+        bob = LoadedModel.find(name='bob').get()
+        self.assertEqual((bob.age, bob.active), (None, False))
+        self.assertEqual(json.loads(rejects.getvalue())['row'], {'name': 'cid', 'age': 'x', 'active': 'yes'})
+
+    def test_csv_repeated(self):
+        class TaggedModel(rdb.Model):
+            tags = rdb.StringProperty(repeated=True)
+            scores = rdb.IntegerProperty(repeated=True, indexed=False)
+        rdb.sync_all([TaggedModel], force=True)
+        source = StringIO('tags,scores\n"[""a"", ""b""]","[1, ""2""]"\n"[""c""]",\na,[1]\n')
+        rejects = StringIO()
+
+        stats = loader.load(TaggedModel, source, format='csv', rejects=rejects)
+
+        self.assertEqual((stats['inserted'], stats['rejected']), (2, 1))
+        self.assertEqual(sorted((e.tags, e.scores) for e in TaggedModel.iter()), [(['a', 'b'], [1, 2]), (['c'], [])])
+        self.assertEqual(json.loads(rejects.getvalue())['line'], 4)
+
+    def test_server_rejects(self):
+        LoadedModel(id='taken', name='first').put()
+        source = StringIO('{"id": "taken", "name": "again"}\n{"name": "new"}\n')
+        rejects = StringIO()
+
+        stats = loader.load(LoadedModel, source, conflict='error', rejects=rejects)
+
+        self.assertEqual((stats['inserted'], stats['rejected']), (1, 1))
+        self.assertEqual(LoadedModel.get_by_id('taken').name, 'first')
+        self.assertEqual(json.loads(rejects.getvalue())['line'], 1)
+
+    def test_update_conflicts(self):
+        LoadedModel(id='taken', name='first').put()
+        source = StringIO('{"id": "taken", "name": 5}\n{"name": "new"}\n{"id": "taken", "name": "again"}\n')
+
+        stats = loader.load(LoadedModel, source, rejects=StringIO())
+
+        self.assertEqual((stats['inserted'], stats['replaced'], stats['rejected']), (1, 1, 1))
+        self.assertEqual(LoadedModel.count(), 2)
+
+    def test_retried_chunk_counts(self):
+        source = StringIO('{"id": "%s", "name": "too long"}\n{"name": "new"}\n' % ('x' * 200))
+
+        stats = loader.load(LoadedModel, source, rejects=StringIO())
+
+        self.assertEqual((stats['inserted'], stats['replaced'], stats['rejected']), (1, 0, 1))
+
+    def test_changes_not_returned(self):
+        LoadedModel(id='taken', name='first').put()
+        source = StringIO('{"id": "taken", "name": "again"}\n{"name": "new"}\n{"name": "other"}\n')
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            stats = loader.load(LoadedModel, source, conflict='error', rejects=StringIO())
+        finally:
+            rdb.remove_instrument(operations)
+
+        self.assertEqual((stats['inserted'], stats['rejected']), (2, 1))
+        self.assertFalse([event for event in operations.after if 'return_changes' in str(event.term)])
+        self.assertEqual(LoadedModel.count(), 3)
+
+    def test_validated_once(self):
+        calls = []
+
+        class ValidatedModel(rdb.Model):
+            name = rdb.StringProperty(indexed=False, validator=lambda prop, value: calls.append(value))
+
+        doc = loader.to_db(ValidatedModel, {'name': 'once'})
+        self.assertEqual((doc['name'], calls), ('once', ['once']))
+        self.assertEqual(doc, dict(ValidatedModel(id=doc['id'], name='once')._to_db(), id=doc['id']))
@@ -1,17 +1,42 @@
+import os
+import time
 import pytz
+import itertools
 import rethinkdb_rdb as rdb
 import unittest
 
 from datetime import datetime
+from rethinkdb_rdb import model, testing
 
 from nose.tools import *
 
-with rdb.Model._get_connection() as conn:
-    try:
-        rdb.db_drop('rethink').run(conn)
-    except Exception:
-        pass
-    rdb.db_create('rethink').run(conn)
+TEST_DB = 'rethink_test'
+
+
+def setup_module():
+    """ Run against a scratch database, created here rather than at import so that
+    collecting the tests doesn't touch any data. Set RDB_FAKE_SERVER=1 to use the
+    in-process stand-in server instead of one on localhost.
+    """
+    global _settings
+    _settings = dict(rdb.DATABASE), model.connections
+    if os.environ.get('RDB_FAKE_SERVER'):
+        model.connections = testing.FakePool(testing.FakeServer())
+    rdb.DATABASE['db'] = TEST_DB
+    model.connections.clear()
+    with rdb.Model._get_connection() as conn:
+        if TEST_DB in rdb.db_list().run(conn):
+            rdb.db_drop(TEST_DB).run(conn)
+        rdb.db_create(TEST_DB).run(conn)
+    rdb.sync_all(force=True)
+
+
+def teardown_module():
+    with model.connections.get() as conn:
+        rdb.db_drop(TEST_DB).run(conn)
+    database, model.connections = _settings
+    rdb.DATABASE.update(database)
+    model.connections.clear()
 
 
 class TestModel(rdb.Model):
@@ -49,6 +74,100 @@ class TestRequiredProperty(rdb.Model):
     found_on = rdb.DateTimeProperty(required=True, indexed=False)
 
 
+class TestIterModel(rdb.Model):
+    name = rdb.StringProperty()
+
+
+class TestPageModel(rdb.Model):
+    rank = rdb.IntegerProperty()
+
+
+class TestDirtyModel(rdb.Model):
+    name = rdb.StringProperty()
+    count = rdb.IntegerProperty(indexed=False)
+    payload = rdb.ObjectProperty(indexed=False)
+
+
+class TestCompactModel(rdb.Model):
+    _compact = True
+    name = rdb.StringProperty()
+    count = rdb.IntegerProperty(indexed=False, default=0)
+
+
+class TestProjectionModel(rdb.Model):
+    name = rdb.StringProperty()
+    email = rdb.StringProperty("e", indexed=False)
+    bio = rdb.TextProperty(indexed=False)
+
+
+class TestWatchModel(rdb.Model):
+    name = rdb.StringProperty()
+    count = rdb.IntegerProperty(indexed=False)
+
+
+class TestRoutedModel(rdb.Model):
+    name = rdb.StringProperty()
+    city = rdb.StringProperty()
+    age = rdb.IntegerProperty()
+    note = rdb.StringProperty(indexed=False, required=False)
+
+
+class TestOrderModel(rdb.Model):
+    status = rdb.StringProperty()
+    total = rdb.FloatProperty(indexed=False)
+    items = rdb.IntegerProperty("n", indexed=False)
+
+
+class TestRepeatedModel(rdb.Model):
+    name = rdb.StringProperty()
+    tags = rdb.StringProperty(repeated=True)
+    scores = rdb.PositiveIntegerProperty(repeated=True, indexed=False)
+
+
+class TestComputedModel(rdb.Model):
+    email = rdb.StringProperty()
+    tags = rdb.StringProperty(repeated=True, indexed=False)
+    domain = rdb.ComputedProperty(lambda self: self.email.split('@')[1] if self.email else None)
+    tag_count = rdb.ComputedProperty(lambda self: len(self.tags), indexed=False)
+
+
+class TestBatchModel(rdb.Model):
+    status = rdb.StringProperty()
+    total = rdb.FloatProperty(indexed=False)
+    items = rdb.IntegerProperty(indexed=False)
+
+
+class TestCustomerModel(rdb.Model):
+    name = rdb.StringProperty()
+
+
+class TestInvoiceModel(rdb.Model):
+    number = rdb.IntegerProperty()
+    customer = rdb.ReferenceProperty(TestCustomerModel)
+    reviewers = rdb.ReferenceProperty('TestCustomerModel', repeated=True, indexed=False)
+
+
+class CountingProperty(rdb.ObjectProperty):
+    decoded = 0
+
+    def _from_db(self, value):
+        CountingProperty.decoded += 1
+        return value
+
+
+class TestLazyModel(rdb.Model):
+    name = rdb.StringProperty()
+    first = CountingProperty(indexed=False)
+    second = CountingProperty(indexed=False)
+    third = CountingProperty(indexed=False)
+
+
+class TestEventModel(rdb.Model):
+    _partition_by = 'created'
+    name = rdb.StringProperty()
+    created = rdb.DateTimeProperty()
+
+
 class TestModelFunctions(unittest.TestCase):
 
     def setUp(self):
@@ -170,6 +289,25 @@ class TestModelFunctions(unittest.TestCase):
             # not the PositiveIntegerProperty validator
             self.assertTrue("Expected integer" in e.message)
 
+    def test_validate_mro_repeated(self):
+        # the compiled chain runs base class validators first on every call
+        for i in range(3):
+            try:
+                TestValidatorMRO(children="abcd")
+                self.fail('ValueError not raised')
+            except ValueError as e:
+                self.assertTrue("Expected integer" in e.message)
+
+    def test_compiled_round_trip(self):
+        m = TestModelStringProperty(name="james bond")
+        doc = m._to_db()
+        self.assertEqual(doc, {'n': 'JAMES BOND'})
+
+        doc['id'] = 'compiled'
+        o = TestModelStringProperty._from_db(doc)
+        self.assertEqual(o.id, 'compiled')
+        self.assertEqual(o.to_dict(), {'name': 'JAMES BOND', 'id': 'compiled'})
+
     def test_float_property(self):
         m = TestFloatProperty()
         m.dollars = 12.5
@@ -219,6 +357,7 @@ class TestModelFunctions(unittest.TestCase):
             a_name = rdb.StringProperty()  # indexed by default
             a_very_long_verbose_name = rdb.StringProperty(name='short')
 
+        rdb.sync_all()
         with rdb.Model._get_connection() as conn:
             indexes = rdb.table(TestIndexesModel._table_name()).index_list().run(conn)
         print indexes
@@ -228,6 +367,31 @@ class TestModelFunctions(unittest.TestCase):
         # should use the short codename of a property if provided
         self.assertTrue('short' in indexes)
 
+    def test_lazy_table_sync(self):
+        class TestLazySyncModel(rdb.Model):
+            name = rdb.StringProperty()
+
+        with rdb.Model._get_connection() as conn:
+            self.assertFalse('TestLazySyncModel' in rdb.table_list().run(conn))
+
+        TestLazySyncModel(name='Jack').put()
+        with rdb.Model._get_connection() as conn:
+            self.assertTrue('TestLazySyncModel' in rdb.table_list().run(conn))
+            self.assertTrue('name' in rdb.table('TestLazySyncModel').index_list().run(conn))
+
+    def test_sync_disabled(self):
+        class TestNoSyncModel(rdb.Model):
+            name = rdb.StringProperty()
+
+        rdb.SCHEMA['sync'] = False
+        try:
+            self.assertRaises(rdb.RqlRuntimeError, TestNoSyncModel.get_by_id, 'jack')
+        finally:
+            rdb.SCHEMA['sync'] = True
+
+        rdb.sync_all()
+        self.assertIsNone(TestNoSyncModel.get_by_id('jack'))
+
     def test_to_dict(self):
         m = TestModel(
             name="James Bond"
@@ -269,5 +433,687 @@ class TestModelFunctions(unittest.TestCase):
             count += 1
         self.assertTrue(count == 5)
 
+    def test_put_multi(self):
+        entities = [TestModel(name='multi%d' % i) for i in range(5)]
+        entities.append(TestModel(id='multi-fixed', name='fixed'))
+        ids = TestModel.put_multi(entities, batch_size=2)
+
+        self.assertEqual(ids, [e.id for e in entities])
+        self.assertTrue(all(ids))
+        self.assertEqual(ids[-1], 'multi-fixed')
+
+    def test_put_multi_errors(self):
+        invalid = TestModelStringProperty()
+        invalid._values['n'] = 12345
+        valid = TestModelStringProperty(name='valid')
+        try:
+            TestModelStringProperty.put_multi([valid, invalid])
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertIsNone(e.errors[0])
+            self.assertTrue(isinstance(e.errors[1], ValueError))
+        self.assertTrue(TestModelStringProperty.get_by_id(valid.id))
+
+        first, second = TestModel(name='first'), TestModel(name='second')
+        too_long = TestModel(id='x' * 200, name='too long')
+        try:
+            TestModel.put_multi([first, too_long, second])
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertEqual([error is None for error in e.errors], [True, False, True])
+            self.assertIn('too long', e.errors[1])
+        self.assertEqual([TestModel.get_by_id(e.id).name for e in (first, second)], ['first', 'second'])
+        try:
+            TestModel.put_multi([first, too_long])  # first is unchanged, without a change of its own
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertEqual([error is None for error in e.errors], [True, False])
+
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            TestModel.put_multi([TestModel(name='third'), TestModel(name='fourth')])
+        finally:
+            rdb.remove_instrument(operations)
+        self.assertEqual(operations.names, ['TestModel.put_multi'])
+        self.assertNotIn('return_changes', str(operations.after[0].term))
+
+    def test_get_multi(self):
+        entities = [TestModel(name='get%d' % i) for i in range(3)]
+        TestModel.put_multi(entities)
+
+        ids = [entities[2].id, 'does-not-exist', entities[0].id, None]
+        results = TestModel.get_multi(ids, batch_size=1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0].name, 'get2')
+        self.assertIsNone(results[1])
+        self.assertEqual(results[2].name, 'get0')
+        self.assertIsNone(results[3])
+
+    def test_delete_multi(self):
+        entities = [TestModel(name='delete%d' % i) for i in range(3)]
+        ids = TestModel.put_multi(entities)
+
+        result = TestModel.delete_multi(ids + ['does-not-exist'], batch_size=2)
+        self.assertEqual(result['deleted'], 3)
+        self.assertEqual(TestModel.get_multi(ids), [None, None, None])
+
+        # a delete that the server refuses for one document, which the test server never does
+        locked = TestModel(id='locked', name='locked')
+        ids = TestModel.put_multi([TestModel(name='deleted'), locked])
+        run = TestModel._run
+
+        def refuse_locked(operation, rq, fetch=False, nearest=False):
+            result = run(operation, rq, fetch, nearest)
+            if operation == 'delete_multi' and "'locked'" in str(rq):
+                locked.put()
+                result = dict(result, deleted=result['deleted'] - 1, errors=1, first_error='locked')
+            return result
+        TestModel._run = staticmethod(refuse_locked)
+        try:
+            TestModel.delete_multi([ids[0], None, 'locked'])
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertEqual(e.errors, [None, None, 'locked'])
+        finally:
+            del TestModel._run
+        self.assertEqual(TestModel.get_multi(ids)[0], None)
+
+    def test_iter(self):
+        TestIterModel.put_multi([TestIterModel(name='iter%d' % i) for i in range(5)])
+
+        results = TestIterModel.iter(predicate={'name': 'iter3'})
+        self.assertEqual([m.name for m in results], ['iter3'])
+
+        names = [m.name for m in TestIterModel.iter(order_by={'index': 'name'}, limit=3)]
+        self.assertEqual(names, ['iter0', 'iter1', 'iter2'])
+
+    def test_fetch_page(self):
+        TestPageModel.put_multi([TestPageModel(id='page%d' % i, rank=i // 2) for i in range(7)])
+
+        for descending in (False, True):
+            seen = []
+            cursor = None
+            while True:
+                page, cursor, more = TestPageModel.fetch_page(3, index='rank', cursor=cursor, descending=descending)
+                seen.extend(m.id for m in page)
+                if not more:
+                    break
+                self.assertTrue(cursor)
+            self.assertEqual(seen, sorted(seen, reverse=descending))
+            self.assertEqual(len(seen), 7)
+
+    @raises(ValueError)
+    def test_fetch_page_unindexed(self):
+        TestFloatProperty.fetch_page(10, index='dollars')
+
+    def test_context_cache(self):
+        m = TestModel(name='cached')
+        m.put()
+
+        with rdb.context() as ctx:
+            first = TestModel.get_by_id(m.id)
+            self.assertIs(TestModel.get_by_id(m.id), first)
+            self.assertEqual(ctx.stats()['hits'], 1)
+
+            first.name = 'changed'
+            first.put()
+            self.assertEqual(TestModel.get_by_id(m.id).name, 'changed')
+
+            TestModel.delete(m.id)
+            self.assertIsNone(TestModel.get_by_id(m.id))
+
+        self.assertIsNone(rdb.get_context())
+
+    def test_process_cache(self):
+        rdb.entity_cache.configure(max_size=100, ttl=60)
+        try:
+            m = TestModel(name='cached')
+            m.put()
+
+            TestModel.get_by_id(m.id)
+            hits = rdb.entity_cache.stats()['hits']
+            result = TestModel.get_by_id(m.id)
+            self.assertEqual(rdb.entity_cache.stats()['hits'], hits + 1)
+            self.assertIsNot(result, m)
+            self.assertEqual(result.name, 'cached')
+
+            m.name = 'updated'
+            m.put()
+            self.assertEqual(TestModel.get_by_id(m.id).name, 'updated')
+        finally:
+            rdb.entity_cache.configure(max_size=0)
+            rdb.entity_cache.clear()
+
+    def test_cache_opt_out(self):
+        class TestUncachedModel(rdb.Model):
+            _use_cache = False
+            name = rdb.StringProperty()
+
+        m = TestUncachedModel(name='uncached')
+        m.put()
+        with rdb.context():
+            self.assertIsNot(TestUncachedModel.get_by_id(m.id), TestUncachedModel.get_by_id(m.id))
+
+    def test_put_only_changed(self):
+        m = TestDirtyModel(name='dirty', count=1, payload={'a': 1, 'b': 2})
+        m.put()
+
+        m = TestDirtyModel.get_by_id(m.id)
+        result = m.put()
+        self.assertEqual(result['unchanged'], 1)
+        self.assertEqual(result['replaced'], 0)
+
+        m.count = 2
+        self.assertEqual(m._changes(), {'count': 2})
+        m.put()
+        self.assertEqual(m._dirty, set())
+
+        m = TestDirtyModel.get_by_id(m.id)
+        self.assertEqual(m.count, 2)
+        self.assertEqual(m.name, 'dirty')
+
+    def test_put_object_changed_in_place(self):
+        m = TestDirtyModel(name='dirty', payload={'a': 1, 'b': 2})
+        m.put()
+
+        m = TestDirtyModel.get_by_id(m.id)
+        del m.payload['a']
+        m.put()
+
+        m = TestDirtyModel.get_by_id(m.id)
+        self.assertEqual(m.payload, {'b': 2})
+
+    def test_put_after_delete(self):
+        m = TestDirtyModel(name='dirty', count=1)
+        m.put()
+
+        m = TestDirtyModel.get_by_id(m.id)
+        TestDirtyModel.delete(m.id)
+        m.count = 3
+        m.put()
+
+        m = TestDirtyModel.get_by_id(m.id)
+        self.assertEqual(m.name, 'dirty')
+        self.assertEqual(m.count, 3)
+
+    def test_compact_round_trip(self):
+        m = TestCompactModel(name='compact')
+        self.assertFalse(hasattr(m, '__dict__'))
+        self.assertEqual(m.count, 0)
+        m.put()
+
+        m = TestCompactModel.get_by_id(m.id)
+        self.assertFalse(hasattr(m, '__dict__'))
+        self.assertEqual(m.to_dict(), {'id': m.id, 'name': 'compact', 'count': 0})
+        m.count = 5
+        self.assertEqual(m._changes(), {'count': 5})
+        m.put()
+        self.assertEqual(TestCompactModel.get_by_id(m.id).count, 5)
+
+    def test_compact_unknown_field(self):
+        with rdb.Model._get_connection() as conn:
+            result = rdb.table('TestCompactModel').insert({'name': 'extra', 'colour': {'red': 255}}).run(conn)
+        m = TestCompactModel.get_by_id(result['generated_keys'][0])
+        self.assertEqual(m._to_db()['colour'], {'red': 255})
+
+    def test_projection(self):
+        m = TestProjectionModel(name='projected', email='p@example.com', bio='long text')
+        m.put()
+
+        partial = TestProjectionModel.get_by_id(m.id, fields=['name', 'email'])
+        self.assertEqual(partial.name, 'projected')
+        self.assertEqual(partial.email, 'p@example.com')
+        self.assertEqual(partial.to_dict(), {'id': m.id, 'name': 'projected', 'email': 'p@example.com'})
+        self.assertRaises(rdb.UnprojectedPropertyError, getattr, partial, 'bio')
+
+        entities, more = TestProjectionModel.all(predicate={'name': 'projected'}, fields=['name'])
+        entities = list(entities)
+        self.assertEqual([e.name for e in entities], ['projected'])
+        self.assertRaises(rdb.UnprojectedPropertyError, getattr, entities[0], 'email')
+        self.assertRaises(ValueError, TestProjectionModel.get_by_id, m.id, fields=['missing'])
+
+    def test_projection_put_keeps_unloaded(self):
+        m = TestProjectionModel(name='projected', email='p@example.com', bio='long text')
+        m.put()
+
+        partial = TestProjectionModel.get_by_id(m.id, fields=['name'])
+        partial.email = 'new@example.com'
+        self.assertEqual(partial.email, 'new@example.com')
+        partial.put()
+
+        m = TestProjectionModel.get_by_id(m.id)
+        self.assertEqual(m.email, 'new@example.com')
+        self.assertEqual(m.bio, 'long text')
+
+        TestProjectionModel.delete(m.id)
+        partial.name = 'gone'
+        self.assertRaises(rdb.UnprojectedPropertyError, partial.put)
+
+    def test_watch(self):
+        first = TestWatchModel(name='watched', count=1)
+        first.put()
+
+        with TestWatchModel.watch(predicate={'name': 'watched'}) as feed:
+            self.assertEqual([(old, new.id) for old, new in itertools.islice(feed, 1)], [(None, first.id)])
+
+            first.count = 2
+            first.put()
+            old, new = next(feed)
+            self.assertEqual((old.count, new.count), (1, 2))
+
+            TestWatchModel.delete(first.id)
+            old, new = next(feed)
+            self.assertEqual((old.id, new), (first.id, None))
+
+    def test_watch_invalidates_cache(self):
+        rdb.entity_cache.configure(max_size=100)
+        try:
+            m = TestWatchModel(name='cached', count=1)
+            m.put()
+            TestWatchModel.get_by_id(m.id)
+            with TestWatchModel.watch(include_initial=False) as feed:
+                with rdb.Model._get_connection() as conn:
+                    rdb.table('TestWatchModel').get(m.id).update({'count': 5}).run(conn)
+                next(feed)
+                self.assertEqual(TestWatchModel.get_by_id(m.id).count, 5)
+        finally:
+            rdb.entity_cache.configure(max_size=0)
+
+    def test_mirror(self):
+        m = TestWatchModel(name='mirrored', count=1)
+        m.put()
+        mirror = TestWatchModel.mirror({'name': 'mirrored'})
+        try:
+            self.assertTrue(mirror.ready.wait(5))
+            self.assertEqual(mirror.get(m.id).count, 1)
+
+            added = TestWatchModel(name='mirrored', count=2)
+            added.put()
+            m.name = 'moved'
+            m.put()
+            for _ in range(100):
+                if m.id not in mirror and added.id in mirror:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([e.id for e in mirror.values()], [added.id])
+        finally:
+            mirror.close()
+
+    def test_all_uses_index(self):
+        TestRoutedModel.put_multi([
+            TestRoutedModel(name='routed', city='Oslo', age=30),
+            TestRoutedModel(name='routed', city='Rome', age=40),
+            TestRoutedModel(name='routed', city='Oslo', age=50),
+            TestRoutedModel(name='other', city='Oslo', age=30),
+        ])
+
+        plan = TestRoutedModel.explain({'name': 'routed', 'note': 'x'})
+        self.assertEqual((plan['path'], plan['index'], plan['filter']), ('get_all', 'name', ['note']))
+        self.assertEqual(TestRoutedModel.explain({'note': 'x'})['path'], 'scan')
+        self.assertEqual(TestRoutedModel.explain({'note': 'x'}, order_by={'index': 'age'})['path'], 'order_by')
+        self.assertEqual(TestRoutedModel.explain(lambda doc: doc['age'] > 1)['filter'], 'function')
+
+        entities, more = TestRoutedModel.all({'name': 'routed', 'city': 'Oslo'}, order_by={'index': rdb.desc('age')})
+        self.assertEqual([e.age for e in entities], [50, 30])
+
+        plan = TestRoutedModel.explain({'city': 'Oslo'}, order_by={'index': rdb.desc('name')})
+        self.assertEqual((plan['path'], plan['index'], plan['order_by']), ('get_all', 'city', 'name'))
+
+    def test_query_builder(self):
+        TestRoutedModel.put_multi([
+            TestRoutedModel(name='built', city='Oslo', age=1),
+            TestRoutedModel(name='built', city='Oslo', age=2),
+            TestRoutedModel(name='built', city='Rome', age=3),
+        ])
+        query = TestRoutedModel.find(name='built').filter(city='Oslo')
+        self.assertEqual(query.explain()['path'], 'get_all')
+        self.assertEqual(sorted(e.age for e in query.fetch()), [1, 2])
+        self.assertEqual(query.order('city').limit(1).get().city, 'Oslo')
+        self.assertEqual(query.project('city').fetch()[0].to_dict().keys(), ['city', 'id'])
+        self.assertRaises(ValueError, query.filter, missing=1)
+
+    def test_count_and_aggregate(self):
+        self.assertEqual(TestOrderModel.count(), 0)
+        self.assertEqual(TestOrderModel.aggregate(avg='total'), {'count': 0, 'avg': {'total': None}})
+
+        TestOrderModel.put_multi([
+            TestOrderModel(status='open', total=10.0, items=1),
+            TestOrderModel(status='open', total=20.0, items=2),
+            TestOrderModel(status='paid', total=5.0, items=5),
+        ])
+        self.assertEqual(TestOrderModel.count(), 3)
+        self.assertEqual(TestOrderModel.count({'status': 'open'}), 2)
+
+        totals = TestOrderModel.aggregate(sum=['total', 'items'], max='total', predicate={'status': 'open'})
+        self.assertEqual(totals, {'count': 2, 'sum': {'total': 30.0, 'items': 3}, 'max': {'total': 20.0}})
+
+        groups = TestOrderModel.aggregate(group_by='status', sum='total', avg='items')
+        self.assertEqual(groups, {
+            'open': {'count': 2, 'sum': {'total': 30.0}, 'avg': {'items': 1.5}},
+            'paid': {'count': 1, 'sum': {'total': 5.0}, 'avg': {'items': 5.0}},
+        })
+        self.assertRaises(ValueError, TestOrderModel.aggregate, sum='missing')
+
+    def test_repeated(self):
+        m = TestRepeatedModel(name='repeated', tags=['a', 'b'], scores=(1, 2))
+        self.assertEqual(m.scores, [1, 2])
+        self.assertRaises(ValueError, setattr, m, 'scores', [1, -2])
+        self.assertRaises(ValueError, setattr, m, 'tags', 'a')
+        self.assertEqual(TestRepeatedModel(name='empty').tags, [])
+        m.put()
+
+        m = TestRepeatedModel.get_by_id(m.id)
+        m.tags.append('c')
+        m.put()
+        self.assertEqual(TestRepeatedModel.get_by_id(m.id).tags, ['a', 'b', 'c'])
+
+        creates, drops = TestRepeatedModel._indexes()
+        self.assertIn('multi=True', str(creates['tags']))
+        self.assertNotIn('scores', creates)
+
+    def test_repeated_membership(self):
+        TestRepeatedModel.put_multi([
+            TestRepeatedModel(name='member', tags=['red', 'blue'], scores=[1]),
+            TestRepeatedModel(name='member', tags=['blue'], scores=[2, 3]),
+            TestRepeatedModel(name='other', tags=['red'], scores=[3]),
+        ])
+        plan = TestRepeatedModel.explain({'tags': 'red'})
+        self.assertEqual((plan['path'], plan['index']), ('get_all', 'tags'))
+        entities, more = TestRepeatedModel.all({'tags': 'red'})
+        self.assertEqual(sorted(e.name for e in entities), ['member', 'other'])
+
+        self.assertEqual(TestRepeatedModel.count({'name': 'member', 'scores': 3}), 1)
+        self.assertEqual(TestRepeatedModel.find(name='member', tags='blue').explain()['index'], 'name')
+        self.assertEqual(len(TestRepeatedModel.find(name='member', tags='blue').fetch()), 2)
+
+    def test_computed(self):
+        m = TestComputedModel(email='ann@example.com')
+        self.assertEqual(m.domain, 'example.com')
+        self.assertRaises(AttributeError, setattr, m, 'domain', 'other.com')
+        self.assertRaises(AttributeError, TestComputedModel, domain='other.com')
+        m.email = 'ann@example.org'
+        self.assertEqual(m.domain, 'example.org')
+        m.tags.append('a')
+        self.assertEqual(m.tag_count, 1)
+        self.assertEqual(m.to_dict()['domain'], 'example.org')
+        m.put()
+
+        m = TestComputedModel.get_by_id(m.id)
+        m.tags.extend(['b', 'c'])
+        m.put()
+        self.assertEqual(TestComputedModel.get_by_id(m.id).tag_count, 3)
+
+        creates, drops = TestComputedModel._indexes()
+        self.assertIn('domain', creates)
+        self.assertNotIn('tag_count', creates)
+        plan = TestComputedModel.explain({'domain': 'example.org'})
+        self.assertEqual((plan['path'], plan['index']), ('get_all', 'domain'))
+        self.assertEqual([e.id for e in TestComputedModel.find(domain='example.org')], [m.id])
+
+        partial = TestComputedModel.get_by_id(m.id, fields=['tags'])
+        partial.tags.append('d')
+        partial.put()
+        stored = TestComputedModel.get_by_id(m.id)
+        self.assertEqual((stored.tag_count, stored.domain), (4, 'example.org'))
+
+    def test_batch(self):
+        old = TestBatchModel(status='old', total=1.0, items=1)
+        old.put()
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            with rdb.batch():
+                first = TestBatchModel(status='batch', total=2.0, items=2)
+                self.assertIsNone(first.put())
+                TestBatchModel(status='batch', total=3.0, items=3).put()
+                contact = TestComputedModel(email='bob@example.com')
+                contact.put()
+                TestBatchModel.delete(old.id)
+                self.assertIsNone(first.id)
+                self.assertEqual(operations.names, [])
+        finally:
+            rdb.remove_instrument(operations)
+        self.assertEqual(sorted(operations.names), [
+            'TestBatchModel.delete_multi', 'TestBatchModel.put_multi', 'TestComputedModel.put_multi'])
+        self.assertEqual(TestBatchModel.get_by_id(first.id).total, 2.0)
+        self.assertEqual(TestComputedModel.get_by_id(contact.id).domain, 'example.com')
+        self.assertIsNone(TestBatchModel.get_by_id(old.id))
+
+        def fail():
+            with rdb.batch():
+                TestBatchModel(status='never', total=1.0, items=1).put()
+                raise KeyError('abandoned')
+        self.assertRaises(KeyError, fail)
+        self.assertEqual(TestBatchModel.count({'status': 'never'}), 0)
+
+        bad = TestRequiredProperty(name='no found_on')
+        try:
+            with rdb.batch():
+                TestBatchModel(status='good', total=1.0, items=1).put()
+                bad.put()
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertIsNone(e.errors[0])
+            self.assertIsInstance(e.errors[1], ValueError)
+            self.assertIn('1 of 2 operations failed', str(e))
+        self.assertEqual(TestBatchModel.count({'status': 'good'}), 1)
+
+    def test_batch_updates(self):
+        m = TestDirtyModel(name='batched', count=1, payload={'a': 1, 'b': 2})
+        m.put()
+        loaded = TestDirtyModel.get_by_id(m.id)
+        m.count = 2
+        m.put()  # written after loaded was read, only the properties loaded changes are sent
+        del loaded.payload['a']
+        loaded.name = 'updated'
+        with rdb.batch():
+            loaded.put()
+        stored = TestDirtyModel.get_by_id(m.id)
+        self.assertEqual((stored.name, stored.count, stored.payload), ('updated', 2, {'b': 2}))
+
+        partial = TestDirtyModel.get_by_id(m.id, fields=['name'])
+        TestDirtyModel.delete(m.id)
+        partial.name = 'gone'
+        try:
+            TestDirtyModel.put_multi([partial])
+            self.fail('BatchError not raised')
+        except rdb.BatchError as e:
+            self.assertIsInstance(e.errors[0], rdb.UnprojectedPropertyError)
+        self.assertIsNone(TestDirtyModel.get_by_id(m.id))
+
+    def test_query_cache(self):
+        rdb.query_cache.configure(max_size=100, ttl=60)
+        try:
+            TestBatchModel(status='cached', total=1.0, items=1).put()
+            entities, more = TestBatchModel.all({'status': 'cached'})
+            self.assertEqual(len(list(entities)), 1)
+            entities, more = TestBatchModel.all({'status': 'cached'})
+            entities = list(entities)
+            self.assertEqual([e.total for e in entities], [1.0])
+            entities[0].total = 5.0  # changes a copy, not the cached result
+            entities, more = TestBatchModel.all({'status': 'cached'})
+            self.assertEqual([e.total for e in entities], [1.0])
+            self.assertEqual(TestBatchModel.count({'status': 'cached'}), 1)
+            stats = rdb.query_cache.stats()
+            self.assertEqual((stats['hits'], stats['size']), (2, 2))
+            self.assertGreater(stats['bytes'], 0)
+
+            TestBatchModel(status='cached', total=2.0, items=2).put()
+            self.assertEqual(rdb.query_cache.stats()['size'], 0)
+            self.assertEqual(TestBatchModel.count({'status': 'cached'}), 2)
+        finally:
+            rdb.query_cache.configure(max_size=0)
+            rdb.query_cache.clear()
+        self.assertEqual(rdb.query_cache.stats()['bytes'], 0)
+
+        table = rdb.table('t')
+        self.assertEqual(rdb.cache.fingerprint(table.filter(lambda doc: doc['a'] == 1)),
+                         rdb.cache.fingerprint(table.filter(lambda doc: doc['a'] == 1)))
+        self.assertNotEqual(rdb.cache.fingerprint(table.filter({'a': 1})),
+                            rdb.cache.fingerprint(table.filter({'a': 2})))
+        self.assertIsNone(rdb.cache.fingerprint(table.filter({'at': rdb.now()})))
+
+    def test_read_mode(self):
+        self.assertEqual(TestRoutedModel.query('outdated').optargs.keys(), ['use_outdated'])
+        self.assertEqual(TestRoutedModel.query().optargs, {})
+        self.assertRaises(ValueError, TestRoutedModel.query, 'majority')
+
+        TestRoutedModel(name='outdated', city='Oslo', age=40).put()
+        query = TestRoutedModel.find(name='outdated').read_mode('outdated')
+        self.assertEqual([e.city for e in query], ['Oslo'])
+        self.assertEqual(TestRoutedModel.count({'name': 'outdated'}, read_mode='outdated'), 1)
+        entities, more = TestRoutedModel.all({'name': 'outdated'}, read_mode='outdated')
+        self.assertEqual(len(list(entities)), 1)
+
+    def test_reference(self):
+        ann, bob = TestCustomerModel(name='Ann'), TestCustomerModel(name='Bob')
+        invoice = TestInvoiceModel(number=1, customer=ann)
+        self.assertRaises(ValueError, invoice.put)  # ann has no id yet
+        self.assertRaises(ValueError, setattr, invoice, 'customer', TestInvoiceModel())
+        TestCustomerModel.put_multi([ann, bob])
+        invoice.reviewers = [bob.id, ann]
+        invoice.put()
+        self.assertEqual(invoice.to_dict()['customer'], ann.id)
+        self.assertEqual(invoice.to_dict()['reviewers'], [bob.id, ann.id])
+
+        loaded = TestInvoiceModel.get_by_id(invoice.id)
+        self.assertEqual(loaded.customer.name, 'Ann')
+        self.assertEqual([c.name for c in loaded.reviewers], ['Bob', 'Ann'])
+        self.assertEqual([e.id for e in TestInvoiceModel.find(customer=ann.id)], [invoice.id])
+
+    def test_missing_reference(self):
+        invoice = TestInvoiceModel(number=200, customer=5)
+        invoice.put()
+        loaded = TestInvoiceModel.get_by_id(invoice.id)
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            self.assertIsNone(loaded.customer)
+            self.assertIsNone(loaded.customer)
+            self.assertEqual(operations.names, ['TestCustomerModel.get_by_id'])
+        finally:
+            rdb.remove_instrument(operations)
+        self.assertEqual(loaded.to_dict()['customer'], 5)
+        loaded.number = 201
+        loaded.put()
+        self.assertEqual(TestInvoiceModel.get_by_id(invoice.id)._values['customer'], 5)
+
+    def test_prefetch(self):
+        customers = [TestCustomerModel(name='prefetch %d' % i) for i in range(3)]
+        TestCustomerModel.put_multi(customers)
+        invoices = [TestInvoiceModel(number=100 + i, customer=customers[i % 3].id, reviewers=[customers[0].id])
+                    for i in range(6)]
+        invoices.append(TestInvoiceModel(number=106, customer='missing'))
+        TestInvoiceModel.put_multi(invoices)
+
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            entities = TestInvoiceModel.get_multi([i.id for i in invoices], prefetch=['customer', 'reviewers'])
+            self.assertEqual(operations.names, ['TestInvoiceModel.get_multi', 'TestCustomerModel.get_multi'])
+            self.assertEqual([e.customer.name for e in entities[:3]], ['prefetch 0', 'prefetch 1', 'prefetch 2'])
+            self.assertEqual(entities[1].reviewers[0].name, 'prefetch 0')
+            self.assertIsNone(entities[6].customer)
+            self.assertIsNone(entities[6].customer)
+            self.assertEqual(len(operations.names), 2)
+            self.assertEqual(entities[6].to_dict()['customer'], 'missing')
+            self.assertEqual(entities[6]._to_db()['customer'], 'missing')
+
+            operations.clear()
+            page, more = TestInvoiceModel.all(page=0, page_size=10, prefetch=['customer'])
+            self.assertEqual(len(operations.names), 2)
+            self.assertTrue(set(e.customer.name for e in page if e.number < 106) >= set(['prefetch 0']))
+            self.assertEqual(len(operations.names), 2)
+        finally:
+            rdb.remove_instrument(operations)
+        self.assertRaises(ValueError, TestInvoiceModel.get_multi, [invoices[0].id], prefetch=['number'])
+
+    def test_lazy_hydration(self):
+        doc = {'id': 'lazy', 'name': 'lazy', 'first': {'a': 1}, 'second': [1, 2], 'third': {'b': 2}}
+        CountingProperty.decoded = 0
+        entity = TestLazyModel._from_db(doc)
+        self.assertEqual(doc['id'], 'lazy')
+        self.assertEqual((entity.id, entity.name, CountingProperty.decoded), ('lazy', 'lazy', 0))
+        self.assertEqual(entity.first, {'a': 1})
+        self.assertEqual(entity.first, {'a': 1})
+        self.assertEqual(CountingProperty.decoded, 1)
+
+        entity.second = [3]
+        self.assertEqual(entity.second, [3])
+        self.assertEqual(CountingProperty.decoded, 1)
+        self.assertEqual(entity._to_db()['third'], {'b': 2})
+        self.assertEqual(CountingProperty.decoded, 2)
+
+        entity.put()
+        stored = TestLazyModel.get_by_id('lazy')
+        self.assertEqual((stored.first, stored.second, stored.third), ({'a': 1}, [3], {'b': 2}))
+        self.assertEqual(stored.to_dict()['name'], 'lazy')
+
+    def test_partitions(self):
+        events = [TestEventModel(name='event %d' % i, created=datetime(2014, 9 + i % 3, 1 + i, 12)) for i in range(9)]
+        events[0].put()
+        self.assertTrue(events[0].id.startswith('2014_09-'))
+        TestEventModel.put_multi(events[1:])
+        self.assertEqual([m._table_name() for m in TestEventModel.partitions()],
+                         ['TestEventModel_2014_09', 'TestEventModel_2014_10', 'TestEventModel_2014_11'])
+        self.assertEqual(TestEventModel.partition(datetime(2014, 10, 30)).count(), 3)
+        self.assertRaises(ValueError, TestEventModel(name='no date').put)
+
+        found = TestEventModel.get_by_id(events[4].id)
+        self.assertEqual((found.name, type(found).__name__), ('event 4', 'TestEventModel_2014_10'))
+        found.name = 'renamed'
+        found.put()
+        found.created = datetime(2014, 12, 20)
+        self.assertRaises(ValueError, found.put)
+        self.assertRaises(rdb.BatchError, type(found).put_multi, [found])
+        moved = TestEventModel(id=found.id, name='moved', created=datetime(2014, 12, 20))
+        self.assertRaises(ValueError, moved.put)
+        found.created = datetime(2014, 10, 30)  # another day of the same month is fine
+        self.assertEqual(TestEventModel.get_multi([events[4].id, events[5].id, 'missing'])[0].name, 'renamed')
+
+        newest = rdb.desc('created')
+        page, more = TestEventModel.all(order_by={'index': newest}, page=1, page_size=3)
+        self.assertEqual([e.name for e in page], ['event 7', 'renamed', 'event 1'])
+        self.assertTrue(more)
+        self.assertEqual([e.name for e in TestEventModel.find().order('created').fetch(2)], ['event 0', 'event 3'])
+        TestEventModel._batch_size = 2
+        try:
+            names = []
+            for entity in TestEventModel.iter(order_by={'index': newest}):
+                self.assertEqual(model.connections.stats()['in_use'], 0)  # held only while a page is read
+                names.append(entity.name)
+        finally:
+            del TestEventModel._batch_size
+        self.assertEqual(names[:4], ['event 8', 'event 5', 'event 2', 'event 7'])
+        self.assertEqual(len(names), 9)
+        window = {'created': (datetime(2014, 10, 5), datetime(2014, 11, 7))}
+        self.assertEqual(TestEventModel.partitions(*window['created'])[0]._partition_suffix, '2014_10')
+        self.assertEqual(TestEventModel.count(window), 4)
+        self.assertEqual(TestEventModel.partition(datetime(2014, 10, 1)).explain(window)['path'], 'between')
+
+        # the partitions are fetched inline on a worker, fewer workers than calls can't deadlock
+        rdb.executor.shutdown()
+        rdb.executor.configure(max_workers=2)
+        try:
+            futures = [TestEventModel.all_async(page=0, page_size=10) for _ in range(5)]
+            self.assertTrue(all(future.wait(2) for future in futures))
+            self.assertEqual([len(future.get_result()[0]) for future in futures], [9] * 5)
+        finally:
+            rdb.executor.configure(max_workers=5)
+
+        TestEventModel.delete(events[0].id)
+        self.assertEqual(TestEventModel.count(), 8)
+        self.assertEqual(TestEventModel.drop_partitions(datetime(2014, 10, 15)), ['TestEventModel_2014_09'])
+        self.assertEqual(TestEventModel.count(), 6)
+        self.assertIsNone(TestEventModel.get_by_id(events[3].id))
+        # neither the sync of other models nor a read creates a partition table again
+        rdb.sync_all()
+        self.assertRaises(rdb.RqlRuntimeError, TestEventModel.partition(datetime(2015, 3, 1)).count)
+        self.assertEqual([m._partition_suffix for m in TestEventModel.partitions(refresh=True)], ['2014_10', '2014_11'])
+        self.assertRaises(TypeError, TestEventModel.aggregate)
+
+        def auto_now_partitions():
+            class TestAutoNowEventModel(rdb.Model):
+                _partition_by = 'updated'
+                updated = rdb.DateTimeProperty(auto_now=True)
+        self.assertRaises(TypeError, auto_now_partitions)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
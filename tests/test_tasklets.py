@@ -0,0 +1,153 @@
+import time
+import unittest
+
+import rethinkdb_rdb as rdb
+from rethinkdb_rdb import model, testing
+
+from nose.tools import *
+
+
+class AsyncModel(rdb.Model):
+    name = rdb.StringProperty()
+    count = rdb.IntegerProperty(indexed=False)
+    payload = rdb.ObjectProperty(indexed=False)
+
+
+class TestFuture(unittest.TestCase):
+
+    def test_result(self):
+        future = rdb.Future()
+        calls = []
+        future.add_callback(calls.append, 1)
+        self.assertFalse(future.done())
+        future.set_result('done')
+        self.assertEqual(future.get_result(), 'done')
+        future.add_callback(calls.append, 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_exception(self):
+        future = rdb.Future()
+        future.set_exception(ValueError('bad'))
+        self.assertRaises(ValueError, future.get_result)
+        self.assertIsInstance(future.get_exception(), ValueError)
+
+    def test_executor_bounded(self):
+        executor = rdb.Executor(max_workers=2)
+        futures = [executor.submit(time.sleep, 0.05) for _ in range(6)]
+        rdb.wait_all(futures)
+        self.assertLessEqual(executor.stats()['workers'], 2)
+        executor.shutdown()
+
+    def test_executor_nested(self):
+        executor = rdb.Executor(max_workers=1)
+        future = executor.submit(lambda: executor.submit(lambda: 'inner').get_result())
+        self.assertTrue(future.wait(1))
+        self.assertEqual(future.get_result(), 'inner')
+        executor.shutdown()
+
+    def test_executor_context(self):
+        executor = rdb.Executor(max_workers=1)
+        with rdb.context() as ctx:
+            self.assertIs(executor.submit(rdb.get_context).get_result(), ctx)
+        self.assertIs(executor.submit(rdb.get_context).get_result(), None)
+        executor.shutdown()
+
+
+class TestAsyncModel(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = model.connections
+        model.connections = testing.FakePool(testing.FakeServer(latency=0.01), max_size=10)
+        rdb.executor.configure(max_workers=10)
+        with model.connections.get() as conn:
+            rdb.db_create(rdb.DATABASE['db']).run(conn)
+        rdb.sync_all([AsyncModel], force=True)
+
+    def tearDown(self):
+        model.connections = self.connections
+        rdb.executor.configure(max_workers=5)
+
+    def test_put_get_delete(self):
+        entity = AsyncModel(name='async')
+        entity.put_async().get_result()
+
+        found = AsyncModel.get_by_id_async(entity.id).get_result()
+        self.assertEqual(found.name, 'async')
+
+        AsyncModel.delete_async(entity.id).get_result()
+        self.assertIsNone(AsyncModel.get_by_id_async(entity.id).get_result())
+
+    def test_concurrent(self):
+        entities = [AsyncModel(name=str(i)) for i in range(20)]
+        started = time.time()
+        rdb.wait_all([entity.put_async() for entity in entities])
+        futures = [AsyncModel.get_by_id_async(entity.id) for entity in entities]
+        self.assertEqual([f.get_result().name for f in futures], [e.name for e in entities])
+        # 40 round trips of 10ms each, overlapped on 10 workers
+        self.assertLess(time.time() - started, 0.3)
+
+    def test_all_async(self):
+        AsyncModel(name='listed').put()
+        entities, more = AsyncModel.all_async(predicate={'name': 'listed'}).get_result()
+        self.assertEqual([e.name for e in entities], ['listed'])
+
+    def test_validation_error(self):
+        entity = AsyncModel(name='x')
+        entity._values['name'] = 5
+        self.assertRaises(ValueError, entity.put_async().get_result)
+
+    def test_autobatcher(self):
+        operations = rdb.add_instrument(testing.Recorder())
+        batches = rdb.autobatcher.batches
+        rdb.autobatcher.configure(window=0.05)
+        try:
+            entities = [AsyncModel(name=str(i)) for i in range(10)]
+            bad = AsyncModel(name='bad')
+            bad._values['name'] = 5
+            futures = [entity.put_async() for entity in entities + [bad]]
+            self.assertRaises(ValueError, futures[-1].get_result)
+            self.assertEqual([f.get_result() for f in futures[:-1]], [e.id for e in entities])
+            self.assertEqual(operations.names, ['AsyncModel.put_multi'])
+
+            operations.clear()
+            futures = [AsyncModel.get_by_id_async(id) for id in [entities[0].id, 'missing', entities[0].id]]
+            self.assertEqual([f.get_result() and f.get_result().name for f in futures], ['0', None, '0'])
+            self.assertEqual(operations.names, ['AsyncModel.get_multi'])
+            self.assertEqual(rdb.autobatcher.batches - batches, 2)
+        finally:
+            rdb.autobatcher.configure(window=0.001)
+            rdb.remove_instrument(operations)
+
+    def test_async_on_workers(self):
+        entity = AsyncModel(name='worker')
+        entity.put()
+
+        def work():
+            AsyncModel(name='put on a worker').put_async().get_result()
+            return AsyncModel.get_by_id_async(entity.id).get_result().name
+
+        rdb.autobatcher.configure(window=0.05)
+        try:
+            futures = [rdb.executor.submit(work) for _ in range(12)]  # more than the 10 workers
+            self.assertTrue(all(future.wait(2) for future in futures))
+            self.assertEqual([future.get_result() for future in futures], ['worker'] * 12)
+        finally:
+            rdb.autobatcher.configure(window=0.001)
+
+    def test_autobatched_update(self):
+        entity = AsyncModel(name='first', count=1, payload={'a': 1, 'b': 2})
+        entity.put()
+        loaded = AsyncModel.get_by_id(entity.id)
+        entity.count = 2
+        entity.put()  # written after loaded was read, the batched put only sends what loaded changed
+        del loaded.payload['a']
+        loaded.name = 'second'
+        operations = rdb.add_instrument(testing.Recorder())
+        try:
+            self.assertEqual(loaded.put_async().get_result(), entity.id)
+            self.assertEqual(operations.names, ['AsyncModel.put_multi'])
+            self.assertIn('update', str(operations.after[0].term))
+        finally:
+            rdb.remove_instrument(operations)
+        stored = AsyncModel.get_by_id(entity.id)
+        self.assertEqual((stored.name, stored.count, stored.payload), ('second', 2, {'b': 2}))